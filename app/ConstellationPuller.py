@@ -1,7 +1,11 @@
+import time
 import typing
 
+import numpy as np
+
 from app.constellation.ConstellationFinder import ConstellationFinder
-from app.db import get_all_rows, update_many
+from app.db import get_all_rows
+from app.storage.StoreRepository import StoreRepository
 
 
 def translate_points(point_string):
@@ -22,50 +26,83 @@ def translate_points(point_string):
 
 
 def get_constellation_string_as_points(constellation_string: str, store_lookup: typing.Dict):
-    points = []
-    for store in constellation_string.split('|'):
-        store_deats = store_lookup.get(store)
-        points.append([store_deats['longitude'], store_deats['latitude']])
-    return points
+    return [store_lookup.get(store) for store in constellation_string.split('|')]
 
 
-def set_size_of_points():
-    stores = get_all_rows(
-        """
-        SELECT id, company_name, latitude, longitude FROM store_list
-        """
-    )
-    stores_as_lookup = {str(p['id']): p for p in stores}
-    points = get_all_rows(
-        """
-        SELECT id, constellation_string
-        FROM cf_raw_constellations
-        WHERE size IS NULL
-        ORDER BY when_created DESC
-        LIMIT 1000
-        """
-    )
-    if len(points) == 0:
-        return
-    to_update = []
+def get_store_arrays(repository: StoreRepository) -> typing.Tuple[typing.Dict[str, int], np.ndarray]:
+    """Each store's row in an (N, 2) array of [longitude, latitude], by string id."""
+    store_coordinates = repository.get_store_coordinates()
+    store_rows = {store_id: row for row, store_id in enumerate(store_coordinates)}
+    coordinates = np.array(list(store_coordinates.values()), dtype=float).reshape(-1, 2)
+    return store_rows, coordinates
+
 
+def get_sizes(points: typing.List[typing.Dict],
+              store_rows: typing.Dict[str, int],
+              coordinates: np.ndarray
+) -> typing.Tuple[typing.List[typing.Dict], int]:
+    """
+    {'id', 'size'} for each row whose stores are all known, plus how many rows were not.
+    Rows are grouped by store count so each group is sized in one get_constellation_sizes call.
+    """
+    groups: typing.Dict[int, typing.Tuple[typing.List, typing.List]] = {}
+    unknown = 0
     for point in points:
-        as_coordinates = get_constellation_string_as_points(point.get('constellation_string'), stores_as_lookup)
-        to_update.append(
-            {
-                'id': point['id'],
-                'size': ConstellationFinder.get_constellation_size(as_coordinates)
-            }
-        )
-
-    update_many(
-        """
-        UPDATE cf_raw_constellations
-        SET size = %(size)s
-        WHERE id = %(id)s
-        """,
-        to_update
-    )
-    return len(to_update)
+        rows = [store_rows.get(store) for store in point['constellation_string'].split('|')]
+        if None in rows:
+            unknown += 1
+            continue
+        ids, group_rows = groups.setdefault(len(rows), ([], []))
+        ids.append(point['id'])
+        group_rows.append(rows)
+    sizes = []
+    for ids, group_rows in groups.values():
+        group_sizes = ConstellationFinder.get_constellation_sizes(coordinates[np.array(group_rows, dtype=np.intp)])
+        sizes.extend({'id': point_id, 'size': float(size)} for point_id, size in zip(ids, group_sizes))
+    return sizes, unknown
+
+
+def set_size_of_points(repository: typing.Optional[StoreRepository] = None,
+                       batch_size: int = 10000,
+                       report_interval: float = 10,
+                       report: typing.Callable[[str], None] = print
+) -> typing.Dict:
+    """
+    Fills in cf_raw_constellations.size until no row is left without one.
+
+    The store coordinates are loaded once. Pending rows are streamed in batches of
+    `batch_size`, sized with array arithmetic and written back batch by batch. Rows found while
+    this runs are picked up by another pass, which repeats until a pass updates nothing; rows
+    naming unknown stores stay unsized and are counted. Progress and rows/sec go to `report`
+    every `report_interval` seconds and at the end.
+    """
+    repository = repository or StoreRepository.from_url('mysql')
+    store_rows, coordinates = get_store_arrays(repository)
+    start = time.monotonic()
+    last_report = start
+    totals = {'updated': 0, 'unknown': 0, 'passes': 0}
+
+    def get_rate() -> float:
+        return totals['updated'] / max(time.monotonic() - start, 1e-9)
 
-translate_points('5856887|565244|565274|2919435|7643985|417423|72064|417468|7561810|565831|2985502|565954|565997|2953672|1991436|1701332|7820687')
+    while True:
+        totals['passes'] += 1
+        totals['unknown'] = 0
+        updated = 0
+        for points in repository.iterate_unsized_constellations(batch_size):
+            sizes, unknown = get_sizes(points, store_rows, coordinates)
+            repository.set_sizes(sizes)
+            updated += len(sizes)
+            totals['updated'] += len(sizes)
+            totals['unknown'] += unknown
+            if time.monotonic() - last_report >= report_interval:
+                report('sized %d rows, %.0f rows/sec' % (totals['updated'], get_rate()))
+                last_report = time.monotonic()
+        if updated == 0:
+            break
+    totals['seconds'] = time.monotonic() - start
+    totals['rows_per_second'] = get_rate()
+    report('sized %d rows in %.1fs, %.0f rows/sec; %d rows name unknown stores' % (
+        totals['updated'], totals['seconds'], totals['rows_per_second'], totals['unknown']
+    ))
+    return totals
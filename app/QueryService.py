@@ -0,0 +1,192 @@
+import collections
+import gc
+import http.server
+import json
+import multiprocessing
+import threading
+import time
+import typing
+import urllib.parse
+
+import numpy as np
+
+from app.benchmark.Engines import Engines
+from app.constellation.ConstellationFinder import ConstellationFinder
+from app.constellation.StorePoint import StorePoint
+
+#   The service forked workers answer from; set before the pool forks, so they inherit it warm.
+worker_service: typing.Optional['QueryService'] = None
+
+
+def find_in_worker(query: typing.Dict) -> typing.Dict:
+    return worker_service.find(**query)
+
+
+class QueryService:
+    """
+    Answers "which constellations pass through this store or this place?" on demand, from
+    indexes and templates built once and kept warm for the life of the process.
+
+    A place is snapped to the nearest store within ACCEPTABLE_DISTANCE, the same match the
+    template's anchor point gets, so answers are those a batch run finds for that store.
+    The default engine visits candidates largest first with the occupancy filter, so a
+    time budget cuts off the smallest candidates rather than an arbitrary tail. The budget
+    is shared out across the requested constellations, each pass getting an equal part of
+    what the ones before it left over; passes cut short are run again, further this time,
+    with whatever the passes that finished early did not use.
+
+    serve() answers GET /find and /stats over HTTP, a thread per request. With workers, the
+    searches run in a forked pool, so concurrent requests use more than one core.
+    """
+    ENGINE = 'largest-first-occupancy'
+    #   Latest requests p50/p99 are taken over.
+    LATENCY_WINDOW = 10000
+
+    def __init__(self, store_list: typing.List[StorePoint], engine: str = ENGINE):
+        self.engine: str = engine
+        self.engines: Engines = Engines(store_list)
+        self.constellations = {c.name: c for c in self.engines.constellations}
+        self.stores: typing.Dict[str, StorePoint] = {store.get_store_id(): store for store in store_list}
+        self.pool = None
+        self.lock: threading.Lock = threading.Lock()
+        self.latencies: typing.Deque[float] = collections.deque(maxlen=self.LATENCY_WINDOW)
+        self.requests: int = 0
+
+    def start_workers(self, workers: int):
+        global worker_service
+        worker_service = self
+        #   Keep the collector from touching (and so copying) the inherited indexes in every child.
+        gc.freeze()
+        self.pool = multiprocessing.get_context('fork').Pool(workers)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def get_anchor(self, longitude: typing.Optional[float] = None, latitude: typing.Optional[float] = None,
+                   store_id: typing.Optional[str] = None) -> typing.Optional[StorePoint]:
+        if store_id is not None:
+            return self.stores.get(str(store_id))
+        return self.engines.spherical_index.get_nearest_within(
+            (longitude, latitude), ConstellationFinder.ACCEPTABLE_DISTANCE
+        )
+
+    def find(self,
+             longitude: typing.Optional[float] = None,
+             latitude: typing.Optional[float] = None,
+             constellations: typing.Optional[typing.List[str]] = None,
+             time_budget_ms: typing.Optional[float] = None,
+             store_id: typing.Optional[str] = None
+    ) -> typing.Dict:
+        """
+        Constellations through the store at (longitude, latitude), or `store_id`, largest first.
+        `complete` is False when the budget ran out before every pass finished.
+        """
+        start = time.monotonic()
+        names = constellations or list(self.constellations)
+        unknown = [name for name in names if name not in self.constellations]
+        if unknown:
+            raise ValueError('unknown constellations: %s' % ', '.join(unknown))
+        if store_id is None and (longitude is None or latitude is None):
+            raise ValueError('either store_id or both longitude and latitude are needed')
+        anchor = self.get_anchor(longitude, latitude, store_id)
+        found = {}
+        timed_out = list(names) if anchor is not None else []
+        deadline = start + time_budget_ms / 1000 if time_budget_ms is not None else None
+        while timed_out:
+            pending, timed_out = timed_out, []
+            for position, name in enumerate(pending):
+                pass_deadline = None
+                if deadline is not None:
+                    pass_deadline = time.monotonic() + (deadline - time.monotonic()) / (len(pending) - position)
+                finder = self.engines.get_finder(self.engine, anchor, [self.constellations[name]], pass_deadline)
+                finder.run()
+                found[name] = finder.results
+                if finder.timed_out:
+                    timed_out.append(name)
+            if len(timed_out) == len(pending):
+                #   Every pass used up its share, so there is nothing left over to give them another go.
+                break
+        results = [record for records in found.values() for record in records]
+        results.sort(key=lambda record: -record['size'])
+        return {
+            'store': None if anchor is None else {'store_id': anchor.get_store_id(), 'longitude': anchor.x, 'latitude': anchor.y},
+            'results': results,
+            'complete': len(timed_out) == 0,
+            'timed_out': timed_out,
+            'search_ms': (time.monotonic() - start) * 1000,
+        }
+
+    def answer(self, query: typing.Dict) -> typing.Dict:
+        """find, in the worker pool when there is one, timed into the latency window."""
+        start = time.monotonic()
+        try:
+            if self.pool is None:
+                return self.find(**query)
+            return self.pool.apply(find_in_worker, (query,))
+        finally:
+            with self.lock:
+                self.latencies.append(time.monotonic() - start)
+                self.requests += 1
+
+    def get_stats(self) -> typing.Dict:
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64) * 1000
+            requests = self.requests
+        stats = {'engine': self.engine, 'requests': requests, 'window': len(latencies)}
+        if len(latencies) > 0:
+            stats.update(
+                p50_ms=float(np.percentile(latencies, 50)),
+                p99_ms=float(np.percentile(latencies, 99)),
+                max_ms=float(latencies.max())
+            )
+        return stats
+
+    @staticmethod
+    def get_query(parameters: typing.Dict[str, typing.List[str]]) -> typing.Dict:
+        """find arguments from a /find query string."""
+        query = {}
+        for name, key in (('longitude', 'lon'), ('latitude', 'lat'), ('time_budget_ms', 'time_budget_ms')):
+            if key in parameters:
+                query[name] = float(parameters[key][0])
+        if 'store_id' in parameters:
+            query['store_id'] = parameters['store_id'][0]
+        if 'constellations' in parameters:
+            query['constellations'] = [name for name in parameters['constellations'][0].split(',') if name]
+        return query
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> http.server.ThreadingHTTPServer:
+        """
+        A server for GET /find?lon=&lat=[&constellations=a,b][&time_budget_ms=] (or store_id=
+        instead of lon/lat) and GET /stats; the caller runs serve_forever.
+        """
+        service = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def send_json(self, status: int, content: typing.Dict):
+                body = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                if url.path == '/stats':
+                    self.send_json(200, service.get_stats())
+                    return
+                if url.path != '/find':
+                    self.send_error(404)
+                    return
+                try:
+                    query = service.get_query(urllib.parse.parse_qs(url.query))
+                    self.send_json(200, service.answer(query))
+                except ValueError as error:
+                    self.send_json(400, {'error': str(error)})
+
+            def log_message(self, format, *args):
+                pass
+
+        return http.server.ThreadingHTTPServer((host, port), Handler)
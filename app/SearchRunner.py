@@ -0,0 +1,314 @@
+import cProfile
+import gc
+import multiprocessing
+import os
+import queue
+import time
+import typing
+
+from app.constellation.Constellation import Constellation
+from app.constellation.ConstellationFinder import ConstellationFinder
+from app.constellation.ConstellationsFinder import ConstellationsFinder
+from app.constellation.CoverageScheduler import CoverageScheduler
+from app.constellation.GridIndex import GridIndex
+from app.constellation.OccupancyFilter import OccupancyFilter
+from app.constellation.PlanarIndex import PlanarIndex
+from app.constellation.ResultFilter import ResultFilter
+from app.constellation.ResultSink import ResultSink
+from app.constellation.StoreCheckpoints import StoreCheckpoints
+from app.constellation.StorePoint import StorePoint
+from app.constellation.StoreSnapshot import StoreSnapshot
+from app.constellation.StoreTable import StoreTable
+from app.metrics import metrics
+from app.storage.StoreRepository import StoreRepository
+
+#   The runner forked workers search with; set before the pool forks, so they inherit it built.
+worker_runner: typing.Optional['SearchRunner'] = None
+
+
+def process_in_worker(store_to_examine: StorePoint) -> typing.Tuple[StorePoint, typing.List[typing.Dict], typing.Dict]:
+    return worker_runner.process_store(store_to_examine)
+
+
+class SearchOptions:
+    """How main.py runs the search; one attribute per command line option, with the same defaults."""
+
+    def __init__(self,
+                 storage: str = 'mysql',
+                 import_stores: bool = False,
+                 vectorized: bool = False,
+                 prune: bool = False,
+                 occupancy_filter: bool = False,
+                 largest_first: bool = False,
+                 fused: bool = False,
+                 planar_lookup: bool = False,
+                 grid_lookup: bool = False,
+                 workers: int = 1,
+                 lease_batch: int = 0,
+                 coverage_scheduler: bool = False,
+                 seed_leases: bool = False,
+                 flush_stores: int = 50,
+                 flush_interval: float = 5,
+                 dedup: bool = False,
+                 dedup_capacity: int = 10000000,
+                 dedup_error_rate: float = 1e-6,
+                 suppress_degrees: float = 0,
+                 checkpoint_interval: float = 0,
+                 metrics_file: typing.Optional[str] = None,
+                 metrics_port: int = 0,
+                 profile_every: int = 0,
+                 profile_dir: str = 'profiles'
+    ):
+        self.storage: str = storage
+        self.import_stores: bool = import_stores
+        #   --prune and --occupancy-filter work on the vectorized search.
+        self.vectorized: bool = vectorized or prune or occupancy_filter
+        self.prune: bool = prune
+        self.occupancy_filter: bool = occupancy_filter
+        self.largest_first: bool = largest_first
+        self.fused: bool = fused
+        self.planar_lookup: bool = planar_lookup
+        self.grid_lookup: bool = grid_lookup
+        self.workers: int = workers
+        self.lease_batch: int = lease_batch
+        self.coverage_scheduler: bool = coverage_scheduler
+        self.seed_leases: bool = seed_leases
+        self.flush_stores: int = flush_stores
+        self.flush_interval: float = flush_interval
+        self.dedup: bool = dedup
+        self.dedup_capacity: int = dedup_capacity
+        self.dedup_error_rate: float = dedup_error_rate
+        self.suppress_degrees: float = suppress_degrees
+        self.checkpoint_interval: float = checkpoint_interval
+        self.metrics_file: typing.Optional[str] = metrics_file
+        self.metrics_port: int = metrics_port
+        self.profile_every: int = profile_every
+        self.profile_dir: str = profile_dir
+
+    def validate(self):
+        """Raises ValueError, in command line terms, for options that cannot be used together."""
+        if self.storage != 'mysql' and self.checkpoint_interval > 0:
+            #   StoreCheckpoints writes through the MySQL pool, with MySQL's upsert.
+            raise ValueError('--checkpoint-interval needs --storage mysql')
+        if self.coverage_scheduler and self.lease_batch > 0:
+            raise ValueError('--coverage-scheduler and --lease-batch are alternatives')
+        if self.suppress_degrees > 0 and not self.dedup:
+            raise ValueError('--suppress-degrees needs --dedup')
+        if self.dedup and self.checkpoint_interval > 0:
+            raise ValueError('--dedup filters results on their way to the writer, which checkpointed results bypass')
+        if self.grid_lookup and self.planar_lookup:
+            raise ValueError('--grid-lookup and --planar-lookup are alternatives')
+        if self.fused and self.vectorized:
+            raise ValueError(
+                '--fused applies to the scalar search and cannot be combined with --vectorized, --prune or --occupancy-filter'
+            )
+        if self.import_stores and not self.storage.startswith('sqlite:'):
+            raise ValueError('--import-stores needs --storage sqlite:<path>')
+
+
+class SearchRunner:
+    """
+    Searches every unchecked store as an anchor, the batch run main.py starts.
+
+    Anchors are claimed in this process, from the repository, leases or the coverage scheduler,
+    and searched here or in a forked pool; results go through a ResultSink, which writes them
+    with the stores' checked rows. The indexes and templates (`finder_options`) are built once,
+    before any fork, so workers inherit them.
+    """
+
+    def __init__(self, options: SearchOptions, repository: typing.Optional[StoreRepository] = None):
+        self.options: SearchOptions = options
+        self.repository: StoreRepository = repository or StoreRepository.from_url(options.storage)
+        #   ConstellationsFinder arguments shared by every anchor; see build.
+        self.finder_options: typing.Dict = {}
+        #   Stores this process has searched, for --profile-every.
+        self.stores_seen: int = 0
+
+    def build(self):
+        options = self.options
+        store_list, store_index, spherical_index = StoreSnapshot.get_stores_and_indexes(self.repository)
+        if options.planar_lookup:
+            store_lookup = PlanarIndex(store_index)
+        elif options.grid_lookup:
+            store_lookup = GridIndex.from_store_points(store_list, ConstellationFinder.ACCEPTABLE_DISTANCE)
+        else:
+            store_lookup = spherical_index
+        store_coordinates = (
+            StorePoint.get_coordinate_array(store_list) if options.vectorized or options.largest_first else None
+        )
+        constellations = Constellation.get_constellations()
+        occupancy_filter = OccupancyFilter(
+            store_coordinates, constellations, ConstellationFinder.ACCEPTABLE_DISTANCE, ConstellationFinder.BOUNDARIES
+        ) if options.occupancy_filter else None
+        #   Built before the workers fork, so they inherit one copy of the query mirrors.
+        for tree in (getattr(store_lookup, 'tree', None), store_index if options.prune else None):
+            if tree is not None:
+                tree.load_mirrors()
+        checkpoints = None
+        if options.checkpoint_interval > 0:
+            checkpoints = StoreCheckpoints(options.checkpoint_interval)
+            checkpoints.create_tables()
+        self.finder_options = dict(
+            constellations=constellations,
+            store_list=store_list,
+            store_lookup=store_lookup,
+            store_coordinates=store_coordinates,
+            vectorized=options.vectorized,
+            candidate_index=store_index if options.prune else None,
+            occupancy_filter=occupancy_filter,
+            checkpoints=checkpoints,
+            largest_first=options.largest_first,
+            fused=options.fused
+        )
+
+    def get_result_filter(self) -> typing.Optional[ResultFilter]:
+        if not self.options.dedup:
+            return None
+        return ResultFilter(
+            capacity=self.options.dedup_capacity,
+            error_rate=self.options.dedup_error_rate,
+            suppression_degrees=self.options.suppress_degrees,
+            store_coordinates=StoreTable.from_store_points(self.finder_options['store_list']).get_coordinates_by_id()
+        )
+
+    def get_store_source(self):
+        """
+        Where anchors come from: leases when --lease-batch is set, the in-memory coverage grid with
+        --coverage-scheduler, else the repository's claim_store.
+        """
+        if self.options.coverage_scheduler:
+            return CoverageScheduler(self.finder_options['store_list'], self.repository.get_checked_store_ids())
+        if self.options.lease_batch > 0:
+            worker_id = '%s-%s' % (os.getenv('PROCESSOR_NAME'), os.getpid())
+            return self.repository.get_leases(worker_id, batch_size=self.options.lease_batch)
+        return None
+
+    def claim_store(self, store_source, sink: ResultSink,
+                    in_flight: typing.Collection[str] = ()) -> typing.Optional[StorePoint]:
+        """
+        The next anchor. Stores being searched or waiting in the sink are not on cf_stores_checked
+        yet, so the repository is told to skip them; leases and the coverage scheduler already do.
+        """
+        if store_source is None:
+            return self.repository.claim_store(set(in_flight) | sink.get_pending_ids())
+        return store_source.get_store()
+
+    @staticmethod
+    def release_stores(store_source, stores: typing.Iterable[StorePoint]):
+        """
+        Give back anchors that will not be finished. Repository claims are only the stores not on
+        cf_stores_checked, so they need nothing; StoreLeases gives its leases back on close.
+        """
+        if isinstance(store_source, CoverageScheduler):
+            for store in stores:
+                store_source.release(store)
+
+    def process_store(self, store_to_examine: StorePoint) -> typing.Tuple[StorePoint, typing.List[typing.Dict], typing.Dict]:
+        """Returns the store, its results and the metrics recorded while finding them."""
+        start = time.monotonic()
+        finder = ConstellationsFinder(store_to_examine=store_to_examine, collect_results=True, **self.finder_options)
+        self.stores_seen += 1
+        profile_every = self.options.profile_every
+        if profile_every and self.stores_seen % profile_every == 0:
+            profile = cProfile.Profile()
+            profile.runcall(finder.run)
+            os.makedirs(self.options.profile_dir, exist_ok=True)
+            profile.dump_stats(os.path.join(self.options.profile_dir, 'store-%s.pstats' % store_to_examine.store_id))
+        else:
+            finder.run()
+        metrics.counters['stores_processed'] += 1
+        metrics.observe('store_seconds', time.monotonic() - start)
+        return store_to_examine, finder.results, metrics.take()
+
+    def publish_metrics(self, taken: typing.Dict):
+        metrics.merge(taken)
+        #   Whatever this process recorded itself, e.g. ResultSink write latency.
+        metrics.merge(metrics.take())
+        if self.options.metrics_file:
+            metrics.write(self.options.metrics_file)
+
+    def run_single(self, store_source, sink: ResultSink):
+        store_to_examine = self.claim_store(store_source, sink)
+        while store_to_examine is not None:
+            store_to_examine, results, taken = self.process_store(store_to_examine)
+            sink.submit(store_to_examine, results)
+            self.publish_metrics(taken)
+            store_to_examine = self.claim_store(store_source, sink)
+
+    def run_workers(self, store_source, sink: ResultSink):
+        """
+        Fan anchor stores out to a forked pool. Claiming stores and handing results to
+        the sink both stay in this process.
+        """
+        global worker_runner
+        worker_runner = self
+        workers = self.options.workers
+        #   Keep the collector from touching (and so copying) the inherited objects in every child.
+        gc.freeze()
+        completed = queue.Queue()
+        #   store_id: store handed to the pool and not yet submitted to the sink.
+        in_flight = {}
+        exhausted = False
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            while True:
+                while not exhausted and len(in_flight) < workers * 2:
+                    store_to_examine = self.claim_store(store_source, sink, in_flight)
+                    if store_to_examine is None:
+                        exhausted = True
+                        break
+                    in_flight[store_to_examine.get_store_id()] = store_to_examine
+                    pool.apply_async(
+                        process_in_worker, (store_to_examine,), callback=completed.put, error_callback=completed.put
+                    )
+                if len(in_flight) == 0:
+                    break
+                finished = completed.get()
+                if isinstance(finished, BaseException):
+                    #   The pool is torn down with it, so none of the stores still out will finish.
+                    self.release_stores(store_source, in_flight.values())
+                    raise finished
+                store_to_examine, results, taken = finished
+                #   Submitted before it leaves in_flight, so the sink's pending set covers it from here on.
+                sink.submit(store_to_examine, results)
+                self.publish_metrics(taken)
+                in_flight.pop(store_to_examine.get_store_id(), None)
+
+    def seed_leases(self):
+        leases = self.repository.get_leases('seed')
+        leases.create_tables()
+        with self.repository.transaction():
+            leases.seed(self.repository.get_stores(), self.repository.get_checked_store_ids())
+
+    def run(self):
+        """Does what the options ask: seed leases, import stores, or search until no store is left."""
+        options = self.options
+        try:
+            if options.seed_leases:
+                self.seed_leases()
+                return
+            if options.import_stores:
+                self.repository.import_stores(StoreRepository.from_url('mysql'))
+                return
+            if options.metrics_port:
+                metrics.serve(options.metrics_port)
+            self.build()
+            store_source = self.get_store_source()
+            sink = ResultSink(
+                batch_stores=options.flush_stores,
+                flush_interval=options.flush_interval,
+                complete_store=store_source.complete if store_source is not None else None,
+                repository=self.repository,
+                result_filter=self.get_result_filter()
+            )
+            try:
+                if options.workers > 1:
+                    self.run_workers(store_source, sink)
+                else:
+                    self.run_single(store_source, sink)
+            finally:
+                sink.close()
+                if store_source is not None:
+                    store_source.close()
+                self.publish_metrics(metrics.take())
+        finally:
+            self.repository.close()
@@ -0,0 +1,221 @@
+import os
+import platform
+import random
+import statistics
+import tempfile
+import time
+import typing
+
+import numpy as np
+
+from app.benchmark.Engines import Engines
+from app.benchmark.SyntheticStores import SyntheticStores
+from app.constellation.ArrayKDTree import ArrayKDTree
+from app.constellation.ConstellationFinder import ConstellationFinder
+from app.constellation.GridIndex import GridIndex
+from app.constellation.KDTree import KDTree
+from app.constellation.SphericalIndex import SphericalIndex
+from app.constellation.StorePoint import StorePoint
+from app.storage.SQLiteRepository import SQLiteRepository
+
+
+class Benchmark:
+    """
+    Micro and macro benchmarks of the constellation pipeline over SyntheticStores.
+
+    Every measurement is repeated and reported as a dict of seconds (min, median, mean)
+    plus the operation count, so results from different runs can be compared by key.
+    check_regressions compares a run against a stored baseline of the same shape.
+    """
+    VERSION = 1
+
+    def __init__(self, store_count: int = 20000, seed: int = 0, anchor_count: int = 1,
+                 operations: int = 1000, repeat: int = 3):
+        self.store_count: int = store_count
+        self.seed: int = seed
+        self.operations: int = operations
+        self.repeat: int = repeat
+        self.store_list: typing.List[StorePoint] = SyntheticStores(store_count, seed).get_stores()
+        self.engines: Engines = Engines(self.store_list)
+        generator = random.Random(seed)
+        self.anchors: typing.List[StorePoint] = generator.sample(self.store_list, anchor_count)
+        #   Query points and candidate pairs shared by the micro benchmarks.
+        self.query_points: typing.List[typing.Tuple[float, float]] = [
+            (s.x + generator.gauss(0, 0.05), s.y + generator.gauss(0, 0.05))
+            for s in generator.sample(self.store_list, operations)
+        ]
+        self.candidates: typing.List[StorePoint] = generator.sample(self.store_list, operations)
+        #   Tolerance queries where stores are dense (metro cores) and sparse (anywhere in the lower 48).
+        self.region_points: typing.Dict[str, typing.List[typing.Tuple[float, float]]] = {
+            'urban': [
+                (longitude + generator.gauss(0, spread / 4), latitude + generator.gauss(0, spread / 4))
+                for longitude, latitude, _, spread in generator.choices(SyntheticStores.CLUSTERS, k=operations)
+            ],
+            'rural': [
+                (generator.uniform(SyntheticStores.EXTENT[0][0], SyntheticStores.EXTENT[1][0]),
+                 generator.uniform(SyntheticStores.EXTENT[0][1], SyntheticStores.EXTENT[1][1]))
+                for _ in range(operations)
+            ],
+        }
+
+    def time_call(self, call: typing.Callable, operations: int = 1) -> typing.Dict:
+        timings = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+        return {
+            'operations': operations,
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'mean': statistics.mean(timings),
+        }
+
+    def get_index_benchmarks(self) -> typing.Dict[str, typing.Dict]:
+        coordinates = [s.get_point() for s in self.store_list]
+        kd_tree = KDTree(list(coordinates), 2)
+        array_tree = self.engines.store_index
+        spherical_index = self.engines.spherical_index
+        grid_index = self.engines.grid_index
+        points = self.query_points
+        tolerance = ConstellationFinder.ACCEPTABLE_DISTANCE
+
+        def query_all(get_nearest):
+            return lambda: [get_nearest(point) for point in points]
+
+        benchmarks = {
+            'KDTree.build': self.time_call(lambda: KDTree(list(coordinates), 2)),
+            'ArrayKDTree.build': self.time_call(lambda: ArrayKDTree.from_store_points(self.store_list)),
+            'SphericalIndex.build': self.time_call(lambda: SphericalIndex.from_store_points(self.store_list)),
+            'GridIndex.build': self.time_call(lambda: GridIndex.from_store_points(self.store_list, tolerance)),
+            'KDTree.get_nearest': self.time_call(query_all(kd_tree.get_nearest), len(points)),
+            'ArrayKDTree.get_nearest': self.time_call(query_all(array_tree.get_nearest), len(points)),
+            'SphericalIndex.get_nearest_within': self.time_call(
+                query_all(lambda point: spherical_index.get_nearest_within(point, tolerance)), len(points)
+            ),
+            'GridIndex.get_nearest_within': self.time_call(
+                query_all(lambda point: grid_index.get_nearest_within(point, tolerance)), len(points)
+            ),
+        }
+        #   Head to head on the matcher's question, where the tree is deep and where it is shallow.
+        for region, region_points in self.region_points.items():
+            for name, index in (('SphericalIndex', spherical_index), ('GridIndex', grid_index)):
+                benchmarks['%s.get_nearest_within[%s]' % (name, region)] = self.time_call(
+                    lambda index=index, region_points=region_points: [
+                        index.get_nearest_within(point, tolerance) for point in region_points
+                    ],
+                    len(region_points)
+                )
+        return benchmarks
+
+    def get_constellation_benchmarks(self) -> typing.Dict[str, typing.Dict]:
+        anchor = self.anchors[0]
+        constellations = self.engines.constellations
+        candidates = self.candidates
+        candidate_coordinates = StorePoint.get_coordinate_array(candidates)
+        operations = len(candidates) * len(constellations)
+
+        def project():
+            for constellation in constellations:
+                for candidate in candidates:
+                    constellation.get_projected_constellation(anchor, candidate)
+
+        def project_vectorized():
+            for constellation in constellations:
+                constellation.get_projected_constellations(anchor, candidate_coordinates)
+
+        def process():
+            for constellation in constellations:
+                for candidate in candidates:
+                    ConstellationFinder(
+                        point_1=anchor, point_2=candidate, constellation=constellation,
+                        minimum_constellation_size=250, store_lookup=self.engines.spherical_index,
+                        found_constellations=[]
+                    ).process()
+
+        return {
+            'Constellation.get_projected_constellation': self.time_call(project, operations),
+            'Constellation.get_projected_constellations': self.time_call(project_vectorized, operations),
+            'ConstellationFinder.process': self.time_call(process, operations),
+        }
+
+    def get_storage_benchmarks(self) -> typing.Dict[str, typing.Dict]:
+        """The repository operations of a run against a throwaway SQLite database, i.e. DB overhead alone."""
+        records = [
+            {'constellation_name': 'Benchmark', 'constellation_string': '|'.join(str(i) for i in range(12)), 'size': 100}
+        ] * self.operations
+        stores = self.candidates
+        with tempfile.TemporaryDirectory() as directory:
+            repository = SQLiteRepository(os.path.join(directory, 'benchmark.sqlite'))
+            try:
+                benchmarks = {
+                    'SQLiteRepository.load_stores': self.time_call(
+                        lambda: repository.load_stores(self.store_list), len(self.store_list)
+                    ),
+                    'SQLiteRepository.write_results': self.time_call(
+                        lambda: repository.write_results(records), len(records)
+                    ),
+                    'SQLiteRepository.set_many_as_processed': self.time_call(
+                        lambda: repository.set_many_as_processed(stores), len(stores)
+                    ),
+                    'SQLiteRepository.claim_store': self.time_call(repository.claim_store),
+                }
+            finally:
+                repository.close()
+        return benchmarks
+
+    def get_engine_benchmarks(self, engine_names: typing.List[str]) -> typing.Dict[str, typing.Dict]:
+        """ConstellationsFinder.run over every anchor and all templates, per engine."""
+        benchmarks = {}
+        for engine in engine_names:
+            def run_anchors():
+                for anchor in self.anchors:
+                    self.engines.get_finder(engine, anchor).run()
+            benchmarks['ConstellationsFinder.run[%s]' % engine] = self.time_call(run_anchors, len(self.anchors))
+        return benchmarks
+
+    def run(self, engine_names: typing.List[str], micro: bool = True) -> typing.Dict:
+        benchmarks = {}
+        if micro:
+            benchmarks.update(self.get_index_benchmarks())
+            benchmarks.update(self.get_constellation_benchmarks())
+            benchmarks.update(self.get_storage_benchmarks())
+        benchmarks.update(self.get_engine_benchmarks(engine_names))
+        return {
+            'version': self.VERSION,
+            'settings': {
+                'store_count': self.store_count,
+                'seed': self.seed,
+                'anchors': [anchor.store_id for anchor in self.anchors],
+                'operations': self.operations,
+                'repeat': self.repeat,
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+            },
+            'benchmarks': benchmarks,
+        }
+
+    @staticmethod
+    def check_regressions(report: typing.Dict, baseline: typing.Dict, tolerance: float = 0.2) -> typing.List[typing.Dict]:
+        """
+        Benchmarks whose median is more than `tolerance` slower than in `baseline`.
+        Only benchmarks present in both are compared, and only when both ran the same settings.
+        """
+        if report['settings'] != baseline.get('settings'):
+            raise ValueError('Baseline was recorded with different settings: %s' % baseline.get('settings'))
+        regressions = []
+        for name, result in report['benchmarks'].items():
+            expected = baseline['benchmarks'].get(name)
+            if expected is None:
+                continue
+            if result['median'] > expected['median'] * (1 + tolerance):
+                regressions.append({
+                    'benchmark': name,
+                    'baseline': expected['median'],
+                    'median': result['median'],
+                    'ratio': result['median'] / expected['median'],
+                })
+        return regressions
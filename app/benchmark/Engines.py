@@ -0,0 +1,116 @@
+import typing
+
+from app.constellation.ArrayKDTree import ArrayKDTree
+from app.constellation.Constellation import Constellation
+from app.constellation.ConstellationFinder import ConstellationFinder
+from app.constellation.ConstellationsFinder import ConstellationsFinder
+from app.constellation.GridIndex import GridIndex
+from app.constellation.KDTree import KDTree
+from app.constellation.OccupancyFilter import OccupancyFilter
+from app.constellation.PlanarIndex import PlanarIndex
+from app.constellation.SphericalIndex import SphericalIndex
+from app.constellation.StorePoint import StorePoint
+from app.constellation.StoreTable import StoreTable
+
+
+class Engines:
+    """
+    The ConstellationsFinder configurations main.py can run, built once over a store_list
+    so benchmarks and the equivalence harness compare like with like.
+
+    An engine is a name mapped to the options main.py would pass; results are collected
+    in memory, so nothing touches the database.
+
+    BASELINE is the search as it shipped before any of them: the plain scalar loop over the
+    original recursive KDTree, sweeping a list of plain StorePoints in the order that tree's
+    constructor sorted it into, in place. It is what production writes today, and the
+    equivalence harness holds every other engine to it.
+    """
+    BASELINE = 'baseline'
+    ENGINES = {
+        BASELINE: {'planar_lookup': True, 'original_tree': True},
+        'scalar': {},
+        'vectorized': {'vectorized': True},
+        'prune': {'vectorized': True, 'prune': True},
+        'occupancy': {'vectorized': True, 'prune': True, 'occupancy': True},
+        'planar-scalar': {'planar_lookup': True},
+        'planar-vectorized': {'planar_lookup': True, 'vectorized': True},
+        'planar-occupancy': {'planar_lookup': True, 'vectorized': True, 'prune': True, 'occupancy': True},
+        'largest-first': {'largest_first': True},
+        'planar-largest-first': {'planar_lookup': True, 'largest_first': True},
+        'largest-first-occupancy': {'largest_first': True, 'vectorized': True, 'prune': True, 'occupancy': True},
+        'fused': {'fused': True},
+        'largest-first-fused': {'largest_first': True, 'fused': True},
+        'grid': {'grid_lookup': True},
+        'grid-fused': {'grid_lookup': True, 'fused': True},
+    }
+    #   Options that change what is found rather than how fast; engines are only comparable when these match.
+    SEMANTIC_OPTIONS = ['planar_lookup', 'largest_first']
+
+    def __init__(self, store_list: typing.List[StorePoint]):
+        #   BASELINE's copy of the list as given, e.g. by get_stores; built on first use.
+        self.original_stores: typing.List[typing.Tuple] = [(s.store_id, s.x, s.y) for s in store_list]
+        self.baseline: typing.Optional[typing.Tuple[typing.List[StorePoint], PlanarIndex]] = None
+        #   Swept in the order main.py sweeps its store list.
+        store_list = StoreTable.in_search_order(store_list).get_stores()
+        self.store_list: typing.List[StorePoint] = store_list
+        self.store_index: ArrayKDTree = ArrayKDTree.from_store_points(store_list)
+        self.planar_index: PlanarIndex = PlanarIndex(self.store_index)
+        self.spherical_index: SphericalIndex = SphericalIndex.from_store_points(store_list)
+        self.grid_index: GridIndex = GridIndex.from_store_points(store_list, ConstellationFinder.ACCEPTABLE_DISTANCE)
+        self.store_coordinates = StorePoint.get_coordinate_array(store_list)
+        self.constellations: typing.List[Constellation] = Constellation.get_constellations()
+        self.occupancy_filter: OccupancyFilter = OccupancyFilter(
+            self.store_coordinates, self.constellations,
+            ConstellationFinder.ACCEPTABLE_DISTANCE, ConstellationFinder.BOUNDARIES
+        )
+
+    def get_baseline(self) -> typing.Tuple[typing.List[StorePoint], PlanarIndex]:
+        """BASELINE's store_list and lookup, built as the original main.py built them."""
+        if self.baseline is None:
+            store_list = [StorePoint.from_values(*store) for store in self.original_stores]
+            #   Sorts store_list in place, which is what set the original sweep order.
+            store_lookup = PlanarIndex(KDTree(store_list, dim=2))
+            self.baseline = store_list, store_lookup
+        return self.baseline
+
+    def get_store_lookup(self, options: typing.Dict):
+        if options.get('planar_lookup'):
+            return self.planar_index
+        if options.get('grid_lookup'):
+            return self.grid_index
+        return self.spherical_index
+
+    def get_finder(self, engine: str, store_to_examine: StorePoint,
+                   constellations: typing.Optional[typing.List[Constellation]] = None,
+                   deadline: typing.Optional[float] = None) -> ConstellationsFinder:
+        options = self.ENGINES[engine]
+        if options.get('original_tree'):
+            store_list, store_lookup = self.get_baseline()
+            return ConstellationsFinder(
+                store_to_examine=store_to_examine,
+                constellations=constellations or self.constellations,
+                store_list=store_list,
+                store_lookup=store_lookup,
+                collect_results=True,
+                deadline=deadline
+            )
+        return ConstellationsFinder(
+            store_to_examine=store_to_examine,
+            constellations=constellations or self.constellations,
+            store_list=self.store_list,
+            store_lookup=self.get_store_lookup(options),
+            store_coordinates=self.store_coordinates,
+            vectorized=options.get('vectorized', False),
+            candidate_index=self.store_index if options.get('prune') else None,
+            occupancy_filter=self.occupancy_filter if options.get('occupancy') else None,
+            collect_results=True,
+            largest_first=options.get('largest_first', False),
+            fused=options.get('fused', False),
+            deadline=deadline
+        )
+
+    def get_results(self, engine: str, store_to_examine: StorePoint) -> typing.List[typing.Dict]:
+        finder = self.get_finder(engine, store_to_examine)
+        finder.run()
+        return finder.results
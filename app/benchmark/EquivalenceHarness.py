@@ -0,0 +1,112 @@
+import typing
+
+from app.benchmark.Engines import Engines
+from app.constellation.StorePoint import StorePoint
+
+
+class EquivalenceHarness:
+    """
+    Runs engines over the same anchors and checks each finds exactly what its reference
+    finds: the same constellations, stores and sizes, in the same order for each constellation.
+    Fused engines interleave templates, so results are compared grouped by constellation.
+
+    Each engine is held to the engine with the same Engines.SEMANTIC_OPTIONS and nothing else,
+    e.g. 'occupancy' to 'scalar', the plain loop in ConstellationsFinder.process_constellation.
+    Engines with the original semantics, e.g. 'planar-scalar' and 'planar-occupancy', are held to
+    Engines.BASELINE, the shipped search over the original KDTree.
+
+    A semantic option is meant to find something different, so the references that use one
+    are not failures but are not taken on trust either: each is compared with the engine one
+    option closer to BASELINE, e.g. 'largest-first' with 'planar-largest-first' (the spherical
+    lookup) and that with BASELINE (largest-first ordering). Those differences are reported
+    apart from the mismatches, each under the option that accounts for it.
+    """
+
+    def __init__(self, engines: Engines, anchors: typing.List[StorePoint]):
+        self.engines: Engines = engines
+        self.anchors: typing.List[StorePoint] = anchors
+
+    @staticmethod
+    def get_semantics(engine: str) -> typing.Dict[str, bool]:
+        options = Engines.ENGINES[engine]
+        return {name: True for name in Engines.SEMANTIC_OPTIONS if options.get(name)}
+
+    @classmethod
+    def get_engine(cls, semantics: typing.Dict[str, bool]) -> str:
+        if semantics == cls.get_semantics(Engines.BASELINE):
+            return Engines.BASELINE
+        return next(name for name, options in Engines.ENGINES.items() if options == semantics)
+
+    @classmethod
+    def get_reference(cls, engine: str) -> str:
+        return cls.get_engine(cls.get_semantics(engine))
+
+    @classmethod
+    def get_steps(cls, reference: str) -> typing.List[typing.Tuple[str, str, str]]:
+        """(engine, engine one option closer to BASELINE, that option) from `reference` to BASELINE."""
+        steps = []
+        semantics = cls.get_semantics(reference)
+        target = cls.get_semantics(Engines.BASELINE)
+        for option in Engines.SEMANTIC_OPTIONS:
+            if semantics.get(option, False) == target.get(option, False):
+                continue
+            closer = {name: True for name in Engines.SEMANTIC_OPTIONS if name != option and semantics.get(name)}
+            if target.get(option):
+                closer[option] = True
+            steps.append((cls.get_engine(semantics), cls.get_engine(closer), option))
+            semantics = closer
+        return steps
+
+    def get_grouped_results(self, engine: str, anchor: StorePoint) -> typing.List[typing.Dict]:
+        #   A stable sort, so each constellation's results keep the order they were found in.
+        return sorted(self.engines.get_results(engine, anchor), key=lambda record: record['constellation_name'])
+
+    @staticmethod
+    def get_difference(expected: typing.List[typing.Dict], found: typing.List[typing.Dict]) -> typing.Dict:
+        return {
+            'missing': [r for r in expected if r not in found],
+            'unexpected': [r for r in found if r not in expected],
+        }
+
+    def run(self, engine_names: typing.List[str]) -> typing.Dict[str, typing.List[typing.Dict]]:
+        """
+        'mismatches': one entry per (engine, anchor) whose results differ from its reference, empty
+        when all agree. 'intended_differences': one per step from a reference towards BASELINE and
+        anchor where the step's semantic `option` changes what is found.
+        """
+        mismatches = []
+        intended_differences = []
+        results = {}
+
+        def get_results(engine: str, anchor: StorePoint) -> typing.List[typing.Dict]:
+            key = (engine, anchor.store_id)
+            if key not in results:
+                results[key] = self.get_grouped_results(engine, anchor)
+            return results[key]
+
+        steps = []
+        for engine in engine_names:
+            for step in self.get_steps(self.get_reference(engine)):
+                if step not in steps:
+                    steps.append(step)
+        for anchor in self.anchors:
+            for engine in engine_names:
+                reference = self.get_reference(engine)
+                if engine == reference:
+                    continue
+                expected = get_results(reference, anchor)
+                found = get_results(engine, anchor)
+                if found != expected:
+                    mismatches.append(dict(
+                        {'engine': engine, 'reference': reference, 'anchor': anchor.store_id},
+                        **self.get_difference(expected, found)
+                    ))
+            for engine, closer, option in steps:
+                expected = get_results(closer, anchor)
+                found = get_results(engine, anchor)
+                if found != expected:
+                    intended_differences.append(dict(
+                        {'engine': engine, 'compared_to': closer, 'option': option, 'anchor': anchor.store_id},
+                        **self.get_difference(expected, found)
+                    ))
+        return {'mismatches': mismatches, 'intended_differences': intended_differences}
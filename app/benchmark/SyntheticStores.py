@@ -0,0 +1,75 @@
+import random
+import typing
+
+from app.constellation.StorePoint import StorePoint
+from app.constellation.StoreTable import StoreTable
+
+
+class SyntheticStores:
+    """
+    Seeded stand-in for store_list: most stores sit in metro clusters weighted roughly by
+    population, the rest are scattered over the lower 48 so the sparse interior is covered too.
+    The same (count, seed) always gives the same stores, ids 1..count.
+    """
+    #   (longitude, latitude, weight, spread in degrees)
+    CLUSTERS = [
+        (-74.00, 40.71, 20, 0.9),   # New York
+        (-118.24, 34.05, 13, 0.8),  # Los Angeles
+        (-87.63, 41.88, 9, 0.6),    # Chicago
+        (-96.80, 32.78, 7, 0.6),    # Dallas
+        (-95.37, 29.76, 7, 0.6),    # Houston
+        (-77.04, 38.91, 6, 0.5),    # Washington
+        (-80.19, 25.76, 6, 0.4),    # Miami
+        (-75.17, 39.95, 6, 0.4),    # Philadelphia
+        (-84.39, 33.75, 6, 0.6),    # Atlanta
+        (-71.06, 42.36, 5, 0.5),    # Boston
+        (-112.07, 33.45, 5, 0.5),   # Phoenix
+        (-122.42, 37.77, 5, 0.5),   # San Francisco
+        (-83.05, 42.33, 4, 0.5),    # Detroit
+        (-122.33, 47.61, 4, 0.5),   # Seattle
+        (-93.27, 44.98, 4, 0.5),    # Minneapolis
+        (-117.16, 32.72, 3, 0.3),   # San Diego
+        (-82.46, 27.95, 3, 0.5),    # Tampa
+        (-104.99, 39.74, 3, 0.4),   # Denver
+        (-90.20, 38.63, 3, 0.5),    # St. Louis
+        (-76.61, 39.29, 3, 0.3),    # Baltimore
+        (-80.84, 35.23, 3, 0.5),    # Charlotte
+        (-81.38, 28.54, 3, 0.4),    # Orlando
+        (-98.49, 29.42, 3, 0.4),    # San Antonio
+        (-122.68, 45.52, 3, 0.4),   # Portland
+        (-115.14, 36.17, 2, 0.3),   # Las Vegas
+        (-86.16, 39.77, 2, 0.5),    # Indianapolis
+        (-97.74, 30.27, 2, 0.4),    # Austin
+        (-82.99, 39.96, 2, 0.5),    # Columbus
+        (-86.78, 36.16, 2, 0.5),    # Nashville
+        (-111.89, 40.76, 2, 0.4),   # Salt Lake City
+    ]
+    #   Share of stores scattered uniformly outside the clusters.
+    RURAL_SHARE = 0.25
+    #   Lower 48 bounding box used for the scattered stores and to clip cluster tails.
+    EXTENT = [[-124.5, 25.0], [-67.0, 49.0]]
+
+    def __init__(self, count: int, seed: int = 0):
+        self.count: int = count
+        self.seed: int = seed
+
+    def get_coordinates(self) -> typing.List[typing.Tuple[float, float]]:
+        generator = random.Random(self.seed)
+        weights = [cluster[2] for cluster in self.CLUSTERS]
+        coordinates = []
+        while len(coordinates) < self.count:
+            if generator.random() < self.RURAL_SHARE:
+                x = generator.uniform(self.EXTENT[0][0], self.EXTENT[1][0])
+                y = generator.uniform(self.EXTENT[0][1], self.EXTENT[1][1])
+            else:
+                longitude, latitude, _, spread = generator.choices(self.CLUSTERS, weights)[0]
+                x = generator.gauss(longitude, spread)
+                y = generator.gauss(latitude, spread * 0.75)
+                if not (self.EXTENT[0][0] <= x <= self.EXTENT[1][0] and self.EXTENT[0][1] <= y <= self.EXTENT[1][1]):
+                    continue
+            coordinates.append((round(x, 6), round(y, 6)))
+        return coordinates
+
+    def get_stores(self) -> typing.List[StorePoint]:
+        coordinates = self.get_coordinates()
+        return StoreTable(range(1, len(coordinates) + 1), coordinates).get_stores()
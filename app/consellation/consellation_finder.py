@@ -3,18 +3,36 @@ import typing
 from math import radians, cos, sin, asin, sqrt
 
 from app.consellation.constellation_utils import get_projected_constellation
-from app.constellation.KDTree import KDTree
+from app.consellation.shards import ShardCheckpoint, get_shard_rows
+from app.constellation.ArrayKDTree import ArrayKDTree
 from app.constellation.StorePoint import StorePoint
+from app.constellation.StoreSnapshot import StoreSnapshot
 
 
 class ConsellationFinder:
 
     ACCEPTABLE_DISTANCE = 25
 
-    def __init__(self, constellation_name,  constellation_points):
+    def __init__(self, constellation_name,  constellation_points,
+                 shard: typing.Tuple[int, int] = (1, 1),
+                 output: typing.Optional[typing.IO] = None,
+                 checkpoint: typing.Optional[ShardCheckpoint] = None,
+                 checkpoint_interval: float = 60,
+                 repository=None):
         self.constellation_name: str = constellation_name
+        #   (k, M): scan only the k-th of M equal-work slices of the pairs.
+        self.shard: typing.Tuple[int, int] = shard
+        #   Where found constellations go, one line each; points.txt when not given.
+        self.output: typing.Optional[typing.IO] = output
+        #   When set, progress is saved there every checkpoint_interval seconds, at row boundaries.
+        self.checkpoint: typing.Optional[ShardCheckpoint] = checkpoint
+        self.checkpoint_interval: float = checkpoint_interval
+        #   The StoreRepository to read stores from, StorePoint's MySQL queries by default.
+        self.repository = repository
+        if checkpoint is not None and output is None:
+            raise ValueError('Checkpoints record how much of `output` is written, so they need one')
         self.store_list: typing.List[StorePoint] = []
-        self.store_kd_tree: typing.Optional[KDTree] = None
+        self.store_kd_tree: typing.Optional[ArrayKDTree] = None
         self.constellation_points: list = constellation_points
 
         #   Boundaries
@@ -25,14 +43,15 @@ class ConsellationFinder:
         self.y_min: typing.Optional[float] = None
 
     def set_store_points(self):
-        self.store_list = StorePoint.get_stores()
-        self.store_kd_tree = KDTree(self.store_list, dim=2)
+        if self.store_kd_tree is not None:
+            #   Handed over by the caller, e.g. shared by the finders of several constellations.
+            return
+        self.store_list, self.store_kd_tree = StoreSnapshot.get_stores_and_index(self.repository)
 
     def set_boundaries(self):
-        self.x_min = min([s.x for s in self.store_list])
-        self.x_max = max([s.x for s in self.store_list])
-        self.y_min = min([s.y for s in self.store_list])
-        self.y_max = max([s.y for s in self.store_list])
+        coordinates = StorePoint.get_coordinate_array(self.store_list)
+        self.x_min, self.y_min = coordinates.min(axis=0).tolist()
+        self.x_max, self.y_max = coordinates.max(axis=0).tolist()
 
         print(self.x_min, self.x_max, self.y_min, self.y_max)
 
@@ -121,18 +140,43 @@ class ConsellationFinder:
         return self.get_recursive_constellation(projected_constellation, [])
 
     def write_consellation(self, consellation_points):
+        line = '%s,%s\n' % (
+            self.constellation_name,
+            ','.join([x.get_store_id() for x in consellation_points])
+        )
+        if self.output is not None:
+            self.output.write(line)
+            return
         with open('points.txt', 'a') as record:
-            record.write('%s,%s\n' % (
-                self.constellation_name,
-                ','.join([x.get_store_id() for x in consellation_points])
-            ))
+            record.write(line)
+
+    def get_rows(self) -> typing.Tuple[int, int]:
+        """The rows [start, stop) this shard still has to scan."""
+        start, stop = get_shard_rows(len(self.store_list), *self.shard)
+        if self.checkpoint is not None:
+            progress = self.checkpoint.get_progress(self.constellation_name)
+            if progress['completed']:
+                return stop, stop
+            if progress['next_row'] is not None:
+                start = progress['next_row']
+        return start, stop
 
     def run(self):
         self.setup()
         permutations_checked = 0
         start_time = time.time()
-        for i, store_1 in enumerate(self.store_list):
-            for store_2 in self.store_list[i + 1:]:
+        last_checkpoint = time.monotonic()
+        start, stop = self.get_rows()
+        store_count = len(self.store_list)
+        #   Pairs are projected from plain coordinates; the stores found come from store_kd_tree.
+        longitudes, latitudes = StorePoint.get_coordinate_values(self.store_list)
+        for i in range(start, stop):
+            store_1 = (longitudes[i], latitudes[i])
+            if self.checkpoint is not None and time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                self.checkpoint.save(self.constellation_name, i, False, self.output)
+                last_checkpoint = time.monotonic()
+            for j in range(i + 1, store_count):
+                store_2 = (longitudes[j], latitudes[j])
                 #   distance = self.haversine_from_points(store_1, store_2)
                 result = self.get_consellation(store_1, store_2)
                 if result is not None:
@@ -144,4 +188,8 @@ class ConsellationFinder:
                     print('Took %s seconds' % (time.time() - start_time))
                     start_time = time.time()
             self.boundary_fails = 0
+        if self.checkpoint is not None:
+            self.checkpoint.save(self.constellation_name, stop, True, self.output)
+        elif self.output is not None:
+            self.output.flush()
 
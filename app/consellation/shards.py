@@ -0,0 +1,91 @@
+import json
+import os
+import re
+import tempfile
+import typing
+
+
+def parse_shard(spec: str) -> typing.Tuple[int, int]:
+    """'k/M', with 1 <= k <= M, as (k, M)."""
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', spec)
+    if match is None:
+        raise ValueError('Shard must look like k/M, not %r' % spec)
+    shard_index, shard_count = int(match.group(1)), int(match.group(2))
+    if not 1 <= shard_index <= shard_count:
+        raise ValueError('Shard %s is not one of 1/%s to %s/%s' % (spec, shard_count, shard_count, shard_count))
+    return shard_index, shard_count
+
+
+def get_pairs_before(row: int, store_count: int) -> int:
+    """Pairs (i, j), i < j, whose first store comes before `row`: the work done once `row` is reached."""
+    return row * (store_count - 1) - row * (row - 1) // 2
+
+
+def get_shard_rows(store_count: int, shard_index: int, shard_count: int) -> typing.Tuple[int, int]:
+    """
+    The rows [start, stop) of the triangular all-pairs scan that make up shard k of M.
+
+    Row i pairs store i with the stores after it, so early rows are long and late ones
+    short; boundaries are placed where the pairs before them cross k/M of the total, which
+    gives every shard the same number of pairs, give or take a row.
+    """
+
+    def get_boundary(k: int) -> int:
+        if k == shard_count:
+            return store_count
+        target = get_pairs_before(store_count, store_count) * k // shard_count
+        low, high = 0, store_count
+        while low < high:
+            middle = (low + high) // 2
+            if get_pairs_before(middle, store_count) < target:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    return get_boundary(shard_index - 1), get_boundary(shard_index)
+
+
+class ShardCheckpoint:
+    """
+    Progress of one shard, kept as JSON at `path`.
+
+    Per constellation it records the next row to scan and whether the shard is done with it,
+    plus the size of the output file once everything before that row had been written. A
+    resumed shard truncates its output to that size, so results of rows scanned after the
+    last checkpoint are neither lost nor written twice. The checkpoint also pins the shard
+    spec and the store_list signature, since rows only mean the same stores while both hold.
+    """
+
+    def __init__(self, path: str, shard: str, signature: typing.Dict):
+        self.path: str = path
+        #   Round-tripped so it compares equal to what was saved.
+        signature = json.loads(json.dumps(signature, default=str))
+        self.exists: bool = os.path.exists(path)
+        if self.exists:
+            with open(path) as saved:
+                self.state: typing.Dict = json.load(saved)
+            if self.state['shard'] != shard or self.state['signature'] != signature:
+                raise ValueError('Checkpoint %s is for shard %s of %s, not shard %s of %s' % (
+                    path, self.state['shard'], self.state['signature'], shard, signature
+                ))
+        else:
+            self.state = {'shard': shard, 'signature': signature, 'output_size': 0, 'constellations': {}}
+
+    def get_progress(self, constellation_name: str) -> typing.Dict:
+        return self.state['constellations'].get(constellation_name, {'next_row': None, 'completed': False})
+
+    def get_output_size(self) -> int:
+        return self.state['output_size']
+
+    def save(self, constellation_name: str, next_row: int, completed: bool, output: typing.IO):
+        """Flush `output` to disk, then atomically record it along with the progress."""
+        output.flush()
+        os.fsync(output.fileno())
+        self.state['output_size'] = output.tell()
+        self.state['constellations'][constellation_name] = {'next_row': next_row, 'completed': completed}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, staging = tempfile.mkstemp(prefix='.checkpoint-', dir=directory)
+        with os.fdopen(handle, 'w') as staged:
+            json.dump(self.state, staged)
+        os.replace(staging, self.path)
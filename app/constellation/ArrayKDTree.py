@@ -0,0 +1,309 @@
+import heapq
+import math
+import typing
+
+import numpy as np
+
+
+class ArrayKDTree:
+
+    """
+    KD-Tree over a contiguous (N, dim) coordinate array.
+
+    The tree is built without recursion: nodes live in flat arrays and every leaf
+    owns a contiguous range of a permutation of the input rows. Queries answer with
+    integer row indexes into the original points, so callers can address their own
+    arrays (store ids, coordinates, ...) directly.
+
+    Usage:
+    1. Make the tree:
+        `tree = ArrayKDTree(coordinates)` or `ArrayKDTree.from_store_points(store_list)`
+    2. Query it:
+        `query(point)`, `query_batch(points)`, `query_knn(points, k)`, `query_radius(point, r)`
+
+    `get_nearest` and `get_knn` keep the signatures of `KDTree`, returning the
+    objects passed as `items` instead of indexes.
+
+    Ties on distance are broken towards the lowest row index.
+    """
+
+    def __init__(self, points, leaf_size: int = 8, items: typing.Optional[typing.Sequence] = None):
+        """Makes the tree.
+
+        Parameters
+        ----------
+        points : array-like, shape (N, dim)
+            The coordinates to index.
+        leaf_size : int
+            The maximum number of points held by a leaf.
+        items : sequence, optional
+            Objects aligned with `points`, returned by `get_nearest` and `get_knn`.
+        """
+        self.data: np.ndarray = np.ascontiguousarray(points, dtype=np.float64)
+        if self.data.ndim != 2:
+            self.data = self.data.reshape(len(self.data), -1)
+        self.dim: int = self.data.shape[1]
+        self.leaf_size: int = max(1, leaf_size)
+        self.items: typing.Optional[typing.Sequence] = items
+        #   Nodes visited by query() so far; read by the finder's metrics.
+        self.node_visits: int = 0
+
+        self.order: np.ndarray = np.arange(len(self.data), dtype=np.intp)
+        self.split_dim: np.ndarray = np.zeros(0, dtype=np.intp)
+        self.split_value: np.ndarray = np.zeros(0, dtype=np.float64)
+        self.left: np.ndarray = np.zeros(0, dtype=np.intp)
+        self.right: np.ndarray = np.zeros(0, dtype=np.intp)
+        self.start: np.ndarray = np.zeros(0, dtype=np.intp)
+        self.end: np.ndarray = np.zeros(0, dtype=np.intp)
+        self.build()
+
+    @classmethod
+    def from_store_points(cls, store_list: typing.List, leaf_size: int = 8) -> 'ArrayKDTree':
+        table = getattr(store_list, 'table', None)
+        if table is not None:
+            #   Rows of a StoreTable, whose coordinates array is already what is needed.
+            coordinates = table.coordinates
+        else:
+            coordinates = np.array([[s.x, s.y] for s in store_list], dtype=np.float64).reshape(-1, 2)
+        return cls(coordinates, leaf_size=leaf_size, items=store_list)
+
+    def __len__(self):
+        return len(self.data)
+
+    def build(self):
+        split_dim, split_value, left, right, start, end = [], [], [], [], [], []
+
+        def new_node(node_start, node_end):
+            split_dim.append(-1)
+            split_value.append(0.0)
+            left.append(-1)
+            right.append(-1)
+            start.append(node_start)
+            end.append(node_end)
+            return len(start) - 1
+
+        order = self.order
+        stack = [new_node(0, len(order))] if len(order) else []
+        while stack:
+            node = stack.pop()
+            node_start, node_end = start[node], end[node]
+            if node_end - node_start <= self.leaf_size:
+                continue
+            rows = order[node_start:node_end]
+            coordinates = self.data[rows]
+            spread = coordinates.max(axis=0) - coordinates.min(axis=0)
+            dimension = int(np.argmax(spread))
+            if spread[dimension] == 0:
+                #   Every point is identical; keep them in one leaf.
+                continue
+            middle = (node_end - node_start) >> 1
+            partition = np.argpartition(coordinates[:, dimension], middle, kind='introselect')
+            order[node_start:node_end] = rows[partition]
+            split_dim[node] = dimension
+            split_value[node] = float(self.data[order[node_start + middle], dimension])
+            left[node] = new_node(node_start, node_start + middle)
+            right[node] = new_node(node_start + middle, node_end)
+            stack.append(left[node])
+            stack.append(right[node])
+
+        self.split_dim = np.array(split_dim, dtype=np.intp)
+        self.split_value = np.array(split_value, dtype=np.float64)
+        self.left = np.array(left, dtype=np.intp)
+        self.right = np.array(right, dtype=np.intp)
+        self.start = np.array(start, dtype=np.intp)
+        self.end = np.array(end, dtype=np.intp)
+        self.set_mirrors()
+
+    #   Node arrays, in the order from_arrays takes them.
+    ARRAYS = ['order', 'split_dim', 'split_value', 'left', 'right', 'start', 'end']
+
+    @classmethod
+    def from_arrays(cls, data: np.ndarray, arrays: typing.Dict[str, np.ndarray], leaf_size: int,
+                    items: typing.Optional[typing.Sequence] = None) -> 'ArrayKDTree':
+        """Rebuilds a tree from the arrays of an earlier build, e.g. memory-mapped from a snapshot, without re-sorting."""
+        tree = cls.__new__(cls)
+        tree.data = data
+        tree.dim = data.shape[1]
+        tree.leaf_size = leaf_size
+        tree.items = items
+        tree.node_visits = 0
+        for name in cls.ARRAYS:
+            setattr(tree, name, arrays[name])
+        #   Mirrors are left to the first query, so opening a memory-mapped tree costs no O(N) copy.
+        return tree
+
+    #   Plain Python mirrors of the node arrays, built by set_mirrors.
+    MIRRORS = ['_split_dim', '_split_value', '_left', '_right', '_start', '_end', '_order', '_points']
+
+    def __getattr__(self, name: str):
+        #   Only reached for attributes not yet set, i.e. mirrors of a tree from from_arrays before its first query.
+        if name in ArrayKDTree.MIRRORS and 'order' in self.__dict__:
+            self.set_mirrors()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def load_mirrors(self):
+        """Builds the mirrors now unless they exist, e.g. in a parent before it forks its workers."""
+        if '_order' not in self.__dict__:
+            self.set_mirrors()
+
+    def set_mirrors(self):
+        """
+        Scalar traversal is several times faster over Python lists than over numpy scalars, so
+        queries run on list copies of the node arrays. They are the one O(N) cost of a
+        memory-mapped tree, paid on the first query unless load_mirrors runs first: main.py
+        builds them in the parent, so forked workers inherit that one copy rather than each
+        building their own.
+        """
+        self._split_dim = self.split_dim.tolist()
+        self._split_value = self.split_value.tolist()
+        self._left = self.left.tolist()
+        self._right = self.right.tolist()
+        self._start = self.start.tolist()
+        self._end = self.end.tolist()
+        self._order = self.order.tolist()
+        self._points = [tuple(p) for p in self.data[self.order].tolist()]
+
+    def query(self, point, max_distance: float = math.inf) -> typing.Tuple[float, int]:
+        """
+        Returns (distance, index) of the nearest point, or (inf, -1) if the tree is empty.
+        With `max_distance`, only points at most that far away are considered and (max_distance, -1)
+        is returned when there are none; the search never leaves that radius.
+        """
+        point = tuple(point)
+        best_distance, best_index = max_distance, -1
+        if not self._start:
+            return best_distance, best_index
+        split_dim, split_value = self._split_dim, self._split_value
+        left, right, start, end = self._left, self._right, self._start, self._end
+        order, points, dist = self._order, self._points, math.dist
+
+        stack = [(0, 0.0)]
+        visits = 0
+        while stack:
+            node, bound = stack.pop()
+            if bound > best_distance:
+                continue
+            visits += 1
+            if left[node] == -1:
+                for j in range(start[node], end[node]):
+                    distance = dist(points[j], point)
+                    if distance < best_distance or (
+                        distance == best_distance and (best_index == -1 or order[j] < best_index)
+                    ):
+                        best_distance, best_index = distance, order[j]
+                continue
+            diff = point[split_dim[node]] - split_value[node]
+            if diff < 0:
+                stack.append((right[node], -diff))
+                stack.append((left[node], bound))
+            else:
+                stack.append((left[node], diff))
+                stack.append((right[node], bound))
+        self.node_visits += visits
+        return best_distance, best_index
+
+    def query_batch(self, points) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Nearest neighbour for every row of `points`; returns (distances, indexes) arrays."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.dim).tolist()
+        distances = np.empty(len(points), dtype=np.float64)
+        indexes = np.empty(len(points), dtype=np.intp)
+        query = self.query
+        for i, point in enumerate(points):
+            distances[i], indexes[i] = query(point)
+        return distances, indexes
+
+    def _knn(self, point, k: int) -> typing.List[typing.Tuple[float, int]]:
+        point = tuple(point)
+        if not self._start or k < 1:
+            return []
+        split_dim, split_value = self._split_dim, self._split_value
+        left, right, start, end = self._left, self._right, self._start, self._end
+        order, points, dist = self._order, self._points, math.dist
+
+        #   Max-heap on (distance, index) so the worst of the current k is on top.
+        heap = []
+        stack = [(0, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if len(heap) == k and bound > -heap[0][0]:
+                continue
+            if left[node] == -1:
+                for j in range(start[node], end[node]):
+                    entry = (-dist(points[j], point), -order[j])
+                    if len(heap) < k:
+                        heapq.heappush(heap, entry)
+                    elif entry > heap[0]:
+                        heapq.heapreplace(heap, entry)
+                continue
+            diff = point[split_dim[node]] - split_value[node]
+            if diff < 0:
+                stack.append((right[node], -diff))
+                stack.append((left[node], bound))
+            else:
+                stack.append((left[node], diff))
+                stack.append((right[node], bound))
+        return sorted((-d, -i) for d, i in heap)
+
+    def query_knn(self, points, k: int) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        k nearest neighbours for every row of `points`.
+        Returns (distances, indexes) arrays of shape (M, k), nearest first; missing neighbours are (inf, -1).
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.dim).tolist()
+        distances = np.full((len(points), k), np.inf, dtype=np.float64)
+        indexes = np.full((len(points), k), -1, dtype=np.intp)
+        for i, point in enumerate(points):
+            for j, (distance, index) in enumerate(self._knn(point, k)):
+                distances[i, j] = distance
+                indexes[i, j] = index
+        return distances, indexes
+
+    def query_radius(self, point, r: float) -> np.ndarray:
+        """Indexes of every point within distance `r` of `point`, in ascending order."""
+        point = tuple(point)
+        found = []
+        if not self._start:
+            return np.array(found, dtype=np.intp)
+        split_dim, split_value = self._split_dim, self._split_value
+        left, right, start, end = self._left, self._right, self._start, self._end
+        order, points, dist = self._order, self._points, math.dist
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if left[node] == -1:
+                for j in range(start[node], end[node]):
+                    if dist(points[j], point) <= r:
+                        found.append(order[j])
+                continue
+            diff = point[split_dim[node]] - split_value[node]
+            if diff <= r:
+                stack.append(left[node])
+            if diff >= -r:
+                stack.append(right[node])
+        found.sort()
+        return np.array(found, dtype=np.intp)
+
+    def query_radius_batch(self, points, r: float) -> typing.List[np.ndarray]:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.dim).tolist()
+        return [self.query_radius(point, r) for point in points]
+
+    def get_item(self, index: int):
+        return index if self.items is None else self.items[index]
+
+    def get_knn(self, point, k, return_dist_sq=True):
+        """KDTree compatible k nearest neighbours; returns [(dist_sq, item), ...] or [item, ...]."""
+        neighbours = self._knn(point, k)
+        if return_dist_sq:
+            return [(distance * distance, self.get_item(index)) for distance, index in neighbours]
+        return [self.get_item(index) for distance, index in neighbours]
+
+    def get_nearest(self, point, return_dist_sq=True):
+        """KDTree compatible nearest neighbour; returns (dist_sq, item), item, or None if empty."""
+        distance, index = self.query(point)
+        if index == -1:
+            return None
+        if return_dist_sq:
+            return distance * distance, self.get_item(index)
+        return self.get_item(index)
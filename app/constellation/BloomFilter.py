@@ -0,0 +1,42 @@
+import hashlib
+import math
+import typing
+
+
+class BloomFilter:
+    """
+    Fixed-size set membership with no false negatives and a tunable false positive rate.
+
+    Sized up front for `capacity` keys at `error_rate`; past capacity the false positive
+    rate climbs. Each key is hashed once with blake2b and the bit positions are derived
+    from the two halves of the digest (double hashing).
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 1e-6):
+        self.capacity: int = capacity
+        self.error_rate: float = error_rate
+        self.bit_count: int = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hash_count: int = max(1, int(round(self.bit_count / capacity * math.log(2))))
+        self.bits: bytearray = bytearray((self.bit_count + 7) // 8)
+        self.count: int = 0
+
+    def get_positions(self, key: str) -> typing.List[int]:
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        hash_1 = int.from_bytes(digest[:8], 'little')
+        hash_2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(hash_1 + i * hash_2) % self.bit_count for i in range(self.hash_count)]
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.get_positions(key))
+
+    def add(self, key: str) -> bool:
+        """Adds key; returns False when it was (probably) already there."""
+        added = False
+        for p in self.get_positions(key):
+            mask = 1 << (p & 7)
+            if not self.bits[p >> 3] & mask:
+                self.bits[p >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
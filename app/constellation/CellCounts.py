@@ -0,0 +1,64 @@
+import typing
+
+import numpy as np
+
+
+class CellCounts:
+    """
+    Store counts on a regular longitude/latitude grid, with 2D prefix sums over it, so whether
+    any store lies in an axis-aligned box takes four array lookups whatever the box size.
+    has_store answers that for many boxes at once, and get_pairs lists the stores in each box.
+
+    A box is widened to whole cells, so both are necessary conditions only: no store in the
+    widened box means none in the box itself.
+    """
+
+    def __init__(self, coordinates: np.ndarray, cell_size: float):
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        self.cell_size: float = cell_size
+        self.origin: np.ndarray = coordinates.min(axis=0) if len(coordinates) else np.zeros(2)
+        cells = np.floor((coordinates - self.origin) / cell_size).astype(np.intp)
+        self.shape: typing.Tuple[int, int] = tuple(int(n) + 1 for n in cells.max(axis=0)) if len(cells) else (0, 0)
+        counts = np.zeros(self.shape, dtype=np.int64)
+        np.add.at(counts, (cells[:, 0], cells[:, 1]), 1)
+        #   Store indexes by cell, column by column, and where each cell starts in that order.
+        self.order: np.ndarray = np.argsort(cells[:, 0] * self.shape[1] + cells[:, 1], kind='stable')
+        self.cell_starts: np.ndarray = np.concatenate([[0], counts.ravel().cumsum()])
+        #   sums[i, j]: stores in cells [0, i) x [0, j).
+        self.sums: np.ndarray = np.zeros((self.shape[0] + 1, self.shape[1] + 1), dtype=np.int64)
+        self.sums[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+
+    def get_cell_range(self, low: np.ndarray, high: np.ndarray, axis: int) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """First and one past the last cell along `axis` overlapping [low, high], clipped to the grid."""
+        first = np.floor((low - self.origin[axis]) / self.cell_size)
+        last = np.floor((high - self.origin[axis]) / self.cell_size) + 1
+        size = self.shape[axis]
+        return (
+            np.clip(first, 0, size).astype(np.intp),
+            np.clip(last, 0, size).astype(np.intp),
+        )
+
+    def has_store(self, x: np.ndarray, y: np.ndarray, radius) -> np.ndarray:
+        """For every (x, y), whether a store may lie within `radius` (scalar or per point) along both axes."""
+        x_first, x_last = self.get_cell_range(x - radius, x + radius, 0)
+        y_first, y_last = self.get_cell_range(y - radius, y + radius, 1)
+        sums = self.sums
+        count = sums[x_last, y_last] - sums[x_first, y_last] - sums[x_last, y_first] + sums[x_first, y_first]
+        return count > 0
+
+    def get_pairs(self, x: np.ndarray, y: np.ndarray, radius) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        (box, store) index pairs for every store in the cells the box around each (x, y) overlaps.
+        A column of cells is one slice of `order`, so the pairs are gathered without a Python loop.
+        """
+        x_first, x_last = self.get_cell_range(x - radius, x + radius, 0)
+        y_first, y_last = self.get_cell_range(y - radius, y + radius, 1)
+        column_counts = x_last - x_first
+        boxes = np.repeat(np.arange(len(x_first)), column_counts)
+        column_offsets = np.arange(len(boxes)) - np.repeat(np.cumsum(column_counts) - column_counts, column_counts)
+        columns = (x_first[boxes] + column_offsets) * self.shape[1]
+        starts = self.cell_starts[columns + y_first[boxes]]
+        lengths = self.cell_starts[columns + y_last[boxes]] - starts
+        pair_boxes = np.repeat(boxes, lengths)
+        positions = np.arange(len(pair_boxes)) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+        return pair_boxes, self.order[positions]
@@ -1,12 +1,86 @@
 import math
+import threading
 import typing
 
+import numpy as np
+
+from app.constellation.ConstellationBounds import ConstellationBounds
+
 
 class Constellation:
+    #   Matcher statistics are folded into the evaluation order this often.
+    REORDER_EVERY = 1000
 
-    def __init__(self, name:str, points: typing.List):
+    def __init__(self, name:str, points: typing.List, anchor_pair: typing.Tuple[int, int] = (0, 1)):
         self.name = name
         self.points: typing.List = points
+        #   Template points placed on point_1 and point_2; (0, 1) is the original behaviour.
+        self.anchor_pair: typing.Tuple[int, int] = anchor_pair
+        self.bounds: typing.Optional[ConstellationBounds] = None
+        #   Angle of the anchor segment, which every projection rotates against.
+        self.anchor_angle: float = self.get_angle(points[anchor_pair[0]], points[anchor_pair[1]])
+
+        #   Per template point, how often the matcher looked for a store there and found none.
+        self.attempts: typing.List[int] = [0] * len(points)
+        self.misses: typing.List[int] = [0] * len(points)
+        self.evaluations: int = 0
+        #   Templates are shared by every finder, including QueryService's request threads.
+        self.stats_lock: threading.Lock = threading.Lock()
+        self.geometric_order: typing.List[int] = self.get_geometric_order()
+        self.evaluation_order: typing.List[int] = list(self.geometric_order)
+
+    def get_bounds(self) -> ConstellationBounds:
+        if self.bounds is None:
+            self.bounds = ConstellationBounds(self.points, self.anchor_pair)
+        return self.bounds
+
+    def get_geometric_order(self) -> typing.List[int]:
+        """
+        Prior evaluation order: the points furthest from the anchors first, since they swing
+        furthest as the candidate moves and are the likeliest to land away from any store.
+        The anchors project onto point_1 and point_2 themselves, so they go last.
+        """
+        anchor_1, anchor_2 = (self.points[i] for i in self.anchor_pair)
+        others = [i for i in range(len(self.points)) if i not in self.anchor_pair]
+        others.sort(key=lambda i: -min(math.dist(self.points[i], anchor_1), math.dist(self.points[i], anchor_2)))
+        return others + list(self.anchor_pair)
+
+    def get_evaluation_order(self) -> typing.List[int]:
+        return self.evaluation_order
+
+    def get_match_counts(self) -> typing.Tuple[typing.List[int], typing.List[int]]:
+        """Empty per template point (attempts, misses) lists, for one pass to count its lookups into."""
+        return [0] * len(self.points), [0] * len(self.points)
+
+    def record_matches(self, attempts: typing.List[int], misses: typing.List[int]):
+        """
+        Folds a pass's lookup counts into the statistics, once per pass rather than per lookup,
+        and reorders whenever they pass another REORDER_EVERY evaluations.
+        """
+        with self.stats_lock:
+            evaluations = self.evaluations
+            for point_index, count in enumerate(attempts):
+                self.attempts[point_index] += count
+            for point_index, count in enumerate(misses):
+                self.misses[point_index] += count
+            self.evaluations += sum(attempts)
+            if self.evaluations // self.REORDER_EVERY > evaluations // self.REORDER_EVERY:
+                self.set_evaluation_order()
+
+    def update_evaluation_order(self):
+        with self.stats_lock:
+            self.set_evaluation_order()
+
+    def set_evaluation_order(self):
+        """
+        Most-likely-to-miss first, by smoothed miss rate; the geometric order breaks ties and keeps
+        anchors last. Callers hold stats_lock; the new order replaces the old list rather than
+        changing it, so a finder part way through the old one is not disturbed.
+        """
+        prior_rank = {point_index: rank for rank, point_index in enumerate(self.geometric_order)}
+        others = [i for i in self.geometric_order if i not in self.anchor_pair]
+        others.sort(key=lambda i: (-(self.misses[i] + 1) / (self.attempts[i] + 2), prior_rank[i]))
+        self.evaluation_order = others + list(self.anchor_pair)
 
     @staticmethod
     def get_angle(point_1, point_2):
@@ -28,9 +102,9 @@ class Constellation:
         return store_angle - constellation_angle
 
     @staticmethod
-    def get_rotated_constellation(constellation, location_1, location_2):
+    def get_rotated_constellation(constellation, location_1, location_2, anchor_pair=(0, 1)):
         angle_of_locations = Constellation.get_angle(location_1, location_2)
-        angle_of_constellation = Constellation.get_angle(constellation[0], constellation[1])
+        angle_of_constellation = Constellation.get_angle(constellation[anchor_pair[0]], constellation[anchor_pair[1]])
         angle_to_rotate = Constellation.get_angle_to_rotate(angle_of_locations, angle_of_constellation)
         return [Constellation.rotate_along_point((point[0], point[1]), angle_to_rotate) for point in constellation]
 
@@ -42,27 +116,75 @@ class Constellation:
         return scaled_x, scaled_y
 
     @staticmethod
-    def get_shifted_constellation(constellation, location_1):
-        shift_x = (constellation[0][0] - location_1[0])
-        shift_y = (constellation[0][1] - location_1[1])
+    def get_shifted_constellation(constellation, location_1, anchor=0):
+        shift_x = (constellation[anchor][0] - location_1[0])
+        shift_y = (constellation[anchor][1] - location_1[1])
         return [[point[0] - shift_x, point[1] - shift_y] for point in constellation]
 
     @staticmethod
-    def get_scaled_constellation(constellation, location_1, location_2):
+    def get_scaled_constellation(constellation, location_1, location_2, anchor_pair=(0, 1)):
         distance_between_locations = math.dist(location_1, location_2)
-        distance_between_constellation = math.dist(constellation[0], constellation[1])
+        distance_between_constellation = math.dist(constellation[anchor_pair[0]], constellation[anchor_pair[1]])
         scaled_size = distance_between_locations / distance_between_constellation
         scaled_constellation = [Constellation.scale(x, scaled_size) for x in constellation]
         return scaled_constellation
 
     def get_projected_constellation(self, point_1, point_2):
-        constellation = self.get_rotated_constellation(self.points, point_1, point_2)
-        constellation = self.get_scaled_constellation(constellation, point_1, point_2)
-        constellation = self.get_shifted_constellation(constellation, point_1)
-        return constellation
+        return self.get_projected_constellation_at(point_1, self.get_angle(point_1, point_2), math.dist(point_1, point_2))
+
+    def get_projected_constellation_at(self, point_1, angle_of_locations: float, distance_between_locations: float):
+        """
+        get_projected_constellation for a point_2 given only by its angle and distance from point_1,
+        so a fused sweep can work those out once per pair and project every template against them.
+        Same arithmetic, step for step, as the rotate/scale/shift helpers.
+        """
+        angler = self.get_angle_to_rotate(angle_of_locations, self.anchor_angle)*math.pi/180
+        cos_angle = math.cos(angler)
+        sin_angle = math.sin(angler)
+        rotated = [(x*cos_angle - y*sin_angle, x*sin_angle + y*cos_angle) for x, y in self.points]
+        #   Measured after rotating, as get_scaled_constellation does, to keep the result bit for bit.
+        scaled_size = distance_between_locations / math.dist(rotated[self.anchor_pair[0]], rotated[self.anchor_pair[1]])
+        constellation = [(x * scaled_size, y * scaled_size) for x, y in rotated]
+        anchor = constellation[self.anchor_pair[0]]
+        shift_x = (anchor[0] - point_1[0])
+        shift_y = (anchor[1] - point_1[1])
+        return [[point[0] - shift_x, point[1] - shift_y] for point in constellation]
+
+    def get_projected_constellations(self, point_1, points_2: np.ndarray) -> np.ndarray:
+        """
+        Project the constellation against many point_2 candidates at once.
+        Mirrors get_projected_constellation step for step; returns an array of shape
+        (len(points_2), len(self.points), 2).
+        """
+        points_2 = np.asarray(points_2, dtype=float)
+        template = np.asarray(self.points, dtype=float)
+        anchor_1, anchor_2 = self.anchor_pair
+
+        #   Rotate.
+        angle_of_locations = np.degrees(np.arctan2(points_2[:, 1] - point_1[1], points_2[:, 0] - point_1[0]))
+        angle_of_constellation = self.get_angle(self.points[anchor_1], self.points[anchor_2])
+        angler = self.get_angle_to_rotate(angle_of_locations, angle_of_constellation) * math.pi / 180
+        cos_angle = np.cos(angler)[:, None]
+        sin_angle = np.sin(angler)[:, None]
+        rotated_x = template[:, 0] * cos_angle - template[:, 1] * sin_angle
+        rotated_y = template[:, 0] * sin_angle + template[:, 1] * cos_angle
+
+        #   Scale.
+        distance_between_locations = np.hypot(points_2[:, 0] - point_1[0], points_2[:, 1] - point_1[1])
+        distance_between_constellation = math.dist(self.points[anchor_1], self.points[anchor_2])
+        scaled_size = (distance_between_locations / distance_between_constellation)[:, None]
+        scaled_x = rotated_x * scaled_size
+        scaled_y = rotated_y * scaled_size
+
+        #   Shift.
+        shift_x = scaled_x[:, anchor_1:anchor_1 + 1] - point_1[0]
+        shift_y = scaled_y[:, anchor_1:anchor_1 + 1] - point_1[1]
+        return np.stack([scaled_x - shift_x, scaled_y - shift_y], axis=-1)
 
     @staticmethod
-    def get_constellations():
+    def get_constellations(anchor_pairs: typing.Optional[typing.Dict[str, typing.Tuple[int, int]]] = None):
+        """All templates; anchor_pairs maps a constellation name to the template points placed on point_1 and point_2."""
+        anchor_pairs = anchor_pairs or {}
         constellations = [
             ['Aries', [[2.0, 98.0], [84.0, 77.0], [119.0, 59.0], [124.0, 40.0]]],
             ['Gemini', [[17.0, 98.0], [26.0, 96.0], [40.0, 94.0], [2.0, 74.0], [6.0, 59.0], [31.0, 49.0], [52.0, 43.0], [80.0, 71.0], [105.0, 62.0], [117.0, 61.0], [100.0, 46.0], [90.0, 27.0], [83.0, 5.0]]],
@@ -79,5 +201,7 @@ class Constellation:
         ]
         constellation_list = []
         for constellation in constellations:
-            constellation_list.append(Constellation(constellation[0], constellation[1]))
+            constellation_list.append(
+                Constellation(constellation[0], constellation[1], anchor_pairs.get(constellation[0], (0, 1)))
+            )
         return constellation_list
\ No newline at end of file
@@ -0,0 +1,103 @@
+import math
+import typing
+
+import numpy as np
+
+
+class ConstellationBounds:
+    """
+    Similarity-invariant geometry of a constellation template, used to work out which point_2
+    candidates can possibly produce a projection that passes the boundary and size checks.
+
+    For a fixed point_1 the projection scale is dist(point_1, point_2) / anchor_distance, so the
+    size check gives a minimum anchor distance and the boundary box gives, per direction of
+    point_2, a maximum one. Directions are bucketed into SECTOR_COUNT sectors and every bound is
+    conservative: a candidate outside the region can never pass set_projected_constellation.
+    """
+    SECTOR_COUNT = 64
+    EARTH_RADIUS = 3956
+    #   Relative slack applied to the radii so floating point noise never drops a valid candidate.
+    TOLERANCE = 1e-9
+
+    def __init__(self, points: typing.List, anchor_pair: typing.Tuple[int, int] = (0, 1)):
+        template = np.asarray(points, dtype=float)
+        anchor_1, anchor_2 = points[anchor_pair[0]], points[anchor_pair[1]]
+        offsets = template - template[anchor_pair[0]]
+        self.anchor_distance: float = math.dist(anchor_1, anchor_2)
+        self.anchor_angle: float = math.atan2(anchor_2[1] - anchor_1[1], anchor_2[0] - anchor_1[0])
+        self.offset_lengths: np.ndarray = np.hypot(offsets[:, 0], offsets[:, 1])
+        self.offset_angles: np.ndarray = np.arctan2(offsets[:, 1], offsets[:, 0])
+        pairwise = template[:, None, :] - template[None, :, :]
+        self.diameter: float = float(np.hypot(pairwise[..., 0], pairwise[..., 1]).max())
+
+        self.sector_edges: np.ndarray = np.linspace(-math.pi, math.pi, self.SECTOR_COUNT + 1)
+        #   Lower bound, per sector, of the template's reach towards east, west, north and south.
+        self.sector_reach: np.ndarray = np.stack([
+            self.get_minimum_reach(direction) for direction in (0.0, math.pi, math.pi / 2, -math.pi / 2)
+        ], axis=1)
+
+    @staticmethod
+    def get_minimum_cos(lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+        """Minimum of cos over each interval [lower, upper], intervals shorter than a full turn."""
+        #   cos reaches -1 inside the interval if it contains an odd multiple of pi.
+        contains_pi = np.floor((upper - math.pi) / (2 * math.pi)) >= np.ceil((lower - math.pi) / (2 * math.pi))
+        return np.where(contains_pi, -1.0, np.minimum(np.cos(lower), np.cos(upper)))
+
+    def get_minimum_reach(self, direction: float) -> np.ndarray:
+        """
+        For every sector of point_2 directions, a lower bound of max_k |v_k| cos(theta + beta_k - direction)
+        at unit scale: how far the rotated template must extend towards `direction`.
+        """
+        rotation_lower = self.sector_edges[:-1] - self.anchor_angle
+        rotation_upper = self.sector_edges[1:] - self.anchor_angle
+        shift = self.offset_angles[None, :] - direction
+        minimum_cos = self.get_minimum_cos(rotation_lower[:, None] + shift, rotation_upper[:, None] + shift)
+        return (self.offset_lengths[None, :] * minimum_cos).max(axis=1)
+
+    def get_minimum_anchor_distance(self, minimum_constellation_size: float) -> float:
+        """
+        The size check measures the bounding box diagonal with haversine, which never exceeds the
+        earth radius times the diagonal in radians, and the diagonal is at most sqrt(2) * diameter * scale.
+        """
+        largest_size_per_scale = self.EARTH_RADIUS * math.radians(math.sqrt(2) * self.diameter)
+        minimum_scale = minimum_constellation_size / largest_size_per_scale
+        return self.anchor_distance * minimum_scale * (1 - self.TOLERANCE)
+
+    def get_maximum_anchor_distances(self, point_1, boundaries) -> np.ndarray:
+        """Maximum dist(point_1, point_2) per sector for the projection to stay inside `boundaries`."""
+        margins = np.array([
+            boundaries[1][0] - point_1[0],
+            point_1[0] - boundaries[0][0],
+            boundaries[1][1] - point_1[1],
+            point_1[1] - boundaries[0][1],
+        ])
+        if (margins < 0).any():
+            #   point_1 is always part of the projection.
+            return np.zeros(self.SECTOR_COUNT)
+        with np.errstate(divide='ignore'):
+            maximum_scale = np.where(self.sector_reach > 0, margins[None, :] / self.sector_reach, np.inf).min(axis=1)
+        return self.anchor_distance * maximum_scale * (1 + self.TOLERANCE) + self.TOLERANCE
+
+    def get_sector(self, angles: np.ndarray) -> np.ndarray:
+        sectors = np.floor((angles + math.pi) / (2 * math.pi) * self.SECTOR_COUNT).astype(np.intp)
+        return np.clip(sectors, 0, self.SECTOR_COUNT - 1)
+
+    def get_feasible_candidates(self, point_1, store_index, boundaries, minimum_constellation_size) -> np.ndarray:
+        """
+        Row indexes of `store_index` (an ArrayKDTree over the candidate coordinates) lying inside the
+        feasible annulus/sectors around point_1, in ascending order.
+        """
+        minimum_distance = self.get_minimum_anchor_distance(minimum_constellation_size)
+        maximum_distances = self.get_maximum_anchor_distances(point_1, boundaries)
+        maximum_distance = float(maximum_distances.max())
+        if not maximum_distance >= minimum_distance:
+            return np.zeros(0, dtype=np.intp)
+        if math.isinf(maximum_distance):
+            candidates = np.arange(len(store_index), dtype=np.intp)
+        else:
+            candidates = store_index.query_radius(point_1, maximum_distance)
+        offsets = store_index.data[candidates] - np.array([point_1[0], point_1[1]], dtype=float)
+        distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        sectors = self.get_sector(np.arctan2(offsets[:, 1], offsets[:, 0]))
+        keep = (distances >= minimum_distance) & (distances <= maximum_distances[sectors])
+        return candidates[keep]
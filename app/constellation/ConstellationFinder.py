@@ -1,14 +1,30 @@
 import typing
 from math import radians, cos, sin, asin, sqrt
 
+import numpy as np
+
 from app.constellation.Constellation import Constellation
 from app.constellation.StorePoint import StorePoint
-from app.db import insert
+from app.db import insert, insert_many
+from app.metrics import metrics
 
 
 class ConstellationFinder:
     ACCEPTABLE_DISTANCE = 5
     BOUNDARIES = [[-157.80430603, 17.69149971 ], [-64.70480347, 61.19303131]]
+    #   Slack for the vectorised pre-filter so floating point noise never drops a candidate the scalar path keeps.
+    MASK_TOLERANCE = 1e-9
+    INSERT_CONSTELLATION = """
+        INSERT INTO cf_raw_constellations (
+            constellation_name, constellation_string, size, when_created
+        ) VALUES (
+            %(constellation_name)s,  %(constellation_string)s, %(size)s, CURRENT_TIMESTAMP
+        )
+        """
+    DELETE_CONSTELLATION = """
+        DELETE FROM cf_raw_constellations
+        WHERE id = %(id)s
+        """
 
     def __init__(self, **kwargs):
         self.point_1: StorePoint = kwargs.get('point_1')
@@ -17,8 +33,18 @@ class ConstellationFinder:
         self.projected_constellation: typing.Optional[typing.List] = None
         self.minimum_constellation_size: float = kwargs.get('minimum_constellation_size', 500)
 
+        #   Any index with get_nearest_within(coordinates, miles): SphericalIndex, GridIndex, DynamicIndex or PlanarIndex.
         self.store_lookup = kwargs.get('store_lookup')
-        self.set_projected_constellation()
+        #   Per template point (attempts, misses) lists by constellation name, counted into for the caller
+        #   to merge once per pass; see Constellation.record_matches. Lookups go uncounted without it.
+        self.match_counts: typing.Optional[typing.Dict[str, typing.Tuple[typing.List[int], typing.List[int]]]] = (
+            kwargs.get('match_counts')
+        )
+        #   When a list is given, found constellations are collected into it instead of written to the database.
+        self.found_constellations: typing.Optional[typing.List[typing.Dict]] = kwargs.get('found_constellations')
+        #   Without point_2 the finder waits for set_candidate, so one instance can serve a whole sweep.
+        if self.point_2 is not None:
+            self.set_projected_constellation()
 
     @staticmethod
     def haversine(lon1, lat1, lon2, lat2):
@@ -43,6 +69,37 @@ class ConstellationFinder:
         lon2, lat2 = point_2
         return ConstellationFinder.haversine(lon1, lat1, lon2, lat2)
 
+    @staticmethod
+    def haversine_many(lon1, lat1, lon2, lat2) -> np.ndarray:
+        """
+        Vectorised haversine over arrays of decimal degrees, in miles.
+        """
+        lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+        dlon = lon2 - lon1
+        dlat = lat2 - lat1
+        a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+        c = 2 * np.arcsin(np.sqrt(a))
+        r = 3956
+        return c * r
+
+    @staticmethod
+    def get_feasible_mask(projected_constellations: np.ndarray, minimum_constellation_size: float) -> np.ndarray:
+        """
+        Array version of the boundary and size checks in set_projected_constellation.
+        Takes the (M, P, 2) output of Constellation.get_projected_constellations and returns
+        a boolean mask of the projections that may survive. The mask is deliberately a little
+        generous; survivors are re-checked by the scalar path.
+        """
+        tolerance = ConstellationFinder.MASK_TOLERANCE
+        min_x, min_y = projected_constellations.min(axis=1).T
+        max_x, max_y = projected_constellations.max(axis=1).T
+        mask = min_x >= ConstellationFinder.BOUNDARIES[0][0] - tolerance
+        mask &= max_x <= ConstellationFinder.BOUNDARIES[1][0] + tolerance
+        mask &= min_y >= ConstellationFinder.BOUNDARIES[0][1] - tolerance
+        mask &= max_y <= ConstellationFinder.BOUNDARIES[1][1] + tolerance
+        mask &= ConstellationFinder.get_constellation_sizes(projected_constellations) > minimum_constellation_size - tolerance
+        return mask
+
     @staticmethod
     def is_constellation_within_boundary(projected_constellation) -> bool:
         #   Validate constellation is within boundary.
@@ -64,55 +121,95 @@ class ConstellationFinder:
         min_y = min([c[1] for c in projected_constellation])
         return ConstellationFinder.haversine(max_x, max_y, min_x, min_y)
 
+    @staticmethod
+    def get_constellation_sizes(constellations: np.ndarray) -> np.ndarray:
+        """get_constellation_size for every row of an (M, P, 2) array, in one haversine_many call."""
+        min_x, min_y = constellations.min(axis=1).T
+        max_x, max_y = constellations.max(axis=1).T
+        return ConstellationFinder.haversine_many(max_x, max_y, min_x, min_y)
+
     def set_projected_constellation(self):
-        projected_constellation = self.constellation.get_projected_constellation(self.point_1, self.point_2)
+        self.set_checked_projection(self.constellation.get_projected_constellation(self.point_1, self.point_2))
+
+    def set_candidate(self,
+                      point_2: StorePoint,
+                      constellation: Constellation,
+                      minimum_constellation_size: float,
+                      projected_constellation: typing.List
+    ):
+        """
+        Point the finder at another pair and template whose projection the caller has already made.
+        point_2 only has to index as (longitude, latitude), e.g. a row's coordinates.
+        """
+        self.point_2 = point_2
+        self.constellation = constellation
+        self.minimum_constellation_size = minimum_constellation_size
+        self.set_checked_projection(projected_constellation)
+
+    def set_checked_projection(self, projected_constellation: typing.List):
+        self.projected_constellation = None
+        metrics.counters['pairs_evaluated'] += 1
         if not self.is_constellation_within_boundary(projected_constellation):
+            metrics.counters['boundary_rejects'] += 1
             return
         if not self.get_constellation_size(projected_constellation) > self.minimum_constellation_size:
+            metrics.counters['size_rejects'] += 1
             return
         self.projected_constellation = projected_constellation
 
     def get_store_near_coordinates(self, coordinates) -> typing.Optional[StorePoint]:
-        distance, point = self.store_lookup.get_nearest(coordinates)
-        if ConstellationFinder.haversine_from_points(point, coordinates) <= ConstellationFinder.ACCEPTABLE_DISTANCE:
-            return point
-
-    def get_recursive_constellation(self, stores_in_constellation: typing.List):
-        point_to_check = self.projected_constellation[len(stores_in_constellation)]
-        closest_store = self.get_store_near_coordinates(point_to_check)
-        if closest_store is None:
-            return
-        stores_in_constellation.append(closest_store)
-        if len(stores_in_constellation) == len(self.projected_constellation):
-            if len(set(stores_in_constellation)) == len(stores_in_constellation):
-                return stores_in_constellation
-            else:
+        return self.store_lookup.get_nearest_within(coordinates, ConstellationFinder.ACCEPTABLE_DISTANCE)
+
+    def get_matched_constellation(self) -> typing.Optional[typing.List[StorePoint]]:
+        """
+        Finds a store near every projected point, in the constellation's evaluation order so the
+        likeliest misses are tried first. Returns the stores in template order, or None if any point
+        has no store or a store is matched twice.
+        """
+        stores_in_constellation = [None] * len(self.projected_constellation)
+        counts = self.match_counts.get(self.constellation.name) if self.match_counts is not None else None
+        for depth, point_index in enumerate(self.constellation.get_evaluation_order(), 1):
+            closest_store = self.get_store_near_coordinates(self.projected_constellation[point_index])
+            if counts is not None:
+                counts[0][point_index] += 1
+                if closest_store is None:
+                    counts[1][point_index] += 1
+            if closest_store is None:
+                metrics.observe('matcher_depth', depth)
                 return
-        return self.get_recursive_constellation(stores_in_constellation)
+            stores_in_constellation[point_index] = closest_store
+        metrics.observe('matcher_depth', len(stores_in_constellation))
+        if len(set(stores_in_constellation)) == len(stores_in_constellation):
+            return stores_in_constellation
+
+    def get_constellation_record(self, found_constellation: typing.List[StorePoint], size: float) -> typing.Dict:
+        return {
+            'constellation_name': self.constellation.name,
+            'constellation_string': '|'.join([x.get_store_id() for x in found_constellation]),
+            'size': size
+        }
 
     def write_constellation(self, found_constellation: typing.List[StorePoint], size: float):
-        insert(
-            """
-            INSERT INTO cf_raw_constellations (
-                constellation_name, constellation_string, size, when_created
-            ) VALUES (
-                %(constellation_name)s,  %(constellation_string)s, %(size)s, CURRENT_TIMESTAMP
-            )
-            """, {
-                'constellation_name': self.constellation.name,
-                'constellation_string': '|'.join([x.get_store_id() for x in found_constellation]),
-                'size': size
-            }
-        )
+        insert(self.INSERT_CONSTELLATION, self.get_constellation_record(found_constellation, size))
+
+    @staticmethod
+    def write_constellations(records: typing.List[typing.Dict]):
+        if len(records) == 0:
+            return
+        insert_many(ConstellationFinder.INSERT_CONSTELLATION, records)
 
     def process(self) -> typing.Optional[float]:
         if self.projected_constellation is None:
             return
-        found_constellation = self.get_recursive_constellation([])
+        found_constellation = self.get_matched_constellation()
         if found_constellation is None:
             return
         found_constellation_size = ConstellationFinder.get_constellation_size(found_constellation)
         if found_constellation_size < 100:
             return
-        self.write_constellation(found_constellation, found_constellation_size)
+        metrics.counters['constellations_found'] += 1
+        if self.found_constellations is not None:
+            self.found_constellations.append(self.get_constellation_record(found_constellation, found_constellation_size))
+        else:
+            self.write_constellation(found_constellation, found_constellation_size)
         return found_constellation_size
@@ -1,43 +1,371 @@
+import math
+import time
 import typing
 
+import numpy as np
+
+from app.constellation.ArrayKDTree import ArrayKDTree
 from app.constellation.Constellation import Constellation
 from app.constellation.ConstellationFinder import ConstellationFinder
-from app.constellation.KDTree import KDTree
+from app.constellation.DynamicIndex import DynamicIndex
+from app.constellation.GridIndex import GridIndex
+from app.constellation.OccupancyFilter import OccupancyFilter
+from app.constellation.PlanarIndex import PlanarIndex
+from app.constellation.SphericalIndex import SphericalIndex
+from app.constellation.StoreCheckpoints import StoreCheckpoints
 from app.constellation.StorePoint import StorePoint
+from app.metrics import metrics
 
 
 class ConstellationsFinder:
+    #   Candidates projected per numpy batch in vectorized mode; bounds peak memory.
+    VECTORIZED_CHUNK_SIZE = 8192
+    #   Found constellations must beat this size; every find raises it for the rest of the pass.
+    MINIMUM_CONSTELLATION_SIZE = 250
 
     def __init__(self,
                  store_to_examine: StorePoint,
                  constellations: typing.List[Constellation],
                  store_list: typing.List[StorePoint],
-                 store_lookup: KDTree
+                 store_lookup: typing.Union[SphericalIndex, GridIndex, DynamicIndex, PlanarIndex],
+                 store_coordinates: typing.Optional[np.ndarray] = None,
+                 vectorized: bool = False,
+                 candidate_index: typing.Optional[ArrayKDTree] = None,
+                 occupancy_filter: typing.Optional[OccupancyFilter] = None,
+                 collect_results: bool = False,
+                 checkpoints: typing.Optional[StoreCheckpoints] = None,
+                 largest_first: bool = False,
+                 fused: bool = False,
+                 deadline: typing.Optional[float] = None
     ):
         self.store_to_examine: StorePoint = store_to_examine
         self.constellations: typing.List[Constellation] = constellations
         self.store_list: typing.List[StorePoint] = store_list
-        self.store_lookup: KDTree = store_lookup
+        #   Nearest store lookups for ConstellationFinder; all but PlanarIndex match by great circle distance.
+        self.store_lookup: typing.Union[SphericalIndex, GridIndex, DynamicIndex, PlanarIndex] = store_lookup
+        self.vectorized: bool = vectorized
+        #   Index over store_list coordinates; when set, vectorized mode only projects stores in the feasible region.
+        self.candidate_index: typing.Optional[ArrayKDTree] = candidate_index
+        #   When set, vectorized mode only hands over candidates whose template points all land near stores.
+        self.occupancy_filter: typing.Optional[OccupancyFilter] = occupancy_filter
+        self.store_coordinates: typing.Optional[np.ndarray] = store_coordinates
+        #   Collect found constellations in `results` and leave writing them, and set_as_processed, to the caller.
+        self.collect_results: bool = collect_results
+        self.results: typing.Optional[typing.List[typing.Dict]] = [] if collect_results else None
+        #   When set, each pass resumes from and saves its progress there; checkpointed results leave `results`.
+        self.checkpoints: typing.Optional[StoreCheckpoints] = checkpoints
+        self.last_checkpoint: float = 0
+        #   Visit candidates furthest from the anchor first and stop once none left can beat the minimum size.
+        self.largest_first: bool = largest_first
+        #   In largest-first mode: store indexes in visiting order, each store's position in it and its anchor distance.
+        self.visit_order: typing.Optional[np.ndarray] = None
+        self.visit_positions: typing.Optional[np.ndarray] = None
+        self.anchor_distances: typing.Optional[np.ndarray] = None
+        #   Scalar mode only: sweep store_list once for all templates instead of once per template.
+        self.fused: bool = fused
+        #   time.monotonic() at which passes stop where they are, keeping what they found; timed_out tells.
+        self.deadline: typing.Optional[float] = deadline
+        self.timed_out: bool = False
+        #   Lookup counts of the pass under way, merged into its templates when it ends; see run_pass.
+        self.match_counts: typing.Optional[typing.Dict[str, typing.Tuple[typing.List[int], typing.List[int]]]] = None
+        #   Rows of store_list holding the anchor itself, which is never its own candidate.
+        self.anchor_rows: typing.Set[int] = self.get_anchor_rows()
+        if (self.vectorized or self.largest_first) and self.store_coordinates is None:
+            self.store_coordinates = StorePoint.get_coordinate_array(self.store_list)
+        #   The sweeps read anchor and candidates as plain (longitude, latitude) floats by row,
+        #   so they make no store objects; views of store_list are only for the edges.
+        self.anchor_point: typing.Tuple[float, float] = (store_to_examine.x, store_to_examine.y)
+        self.longitude_values, self.latitude_values = StorePoint.get_coordinate_values(
+            self.store_list, self.store_coordinates
+        )
+
+    def get_anchor_rows(self) -> typing.Set[int]:
+        table = getattr(self.store_list, 'table', None)
+        if table is None:
+            return {i for i, store in enumerate(self.store_list) if store.store_id == self.store_to_examine.store_id}
+        row = table.get_row(self.store_to_examine.store_id)
+        return set() if row is None else {row}
+
+    def is_past_deadline(self) -> bool:
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.timed_out = True
+        return self.timed_out
+
+    def get_candidate_indexes(self, constellation: Constellation, minimum_constellation_size: float) -> np.ndarray:
+        """Rows of store_list to project, in ascending order, without the anchor's own."""
+        if self.candidate_index is None:
+            indexes = range(len(self.store_list))
+        else:
+            indexes = constellation.get_bounds().get_feasible_candidates(
+                self.store_to_examine, self.candidate_index, ConstellationFinder.BOUNDARIES, minimum_constellation_size
+            )
+        return np.array(
+            [i for i in indexes if i not in self.anchor_rows],
+            dtype=np.intp
+        )
+
+    def get_finder(self) -> ConstellationFinder:
+        """One matcher for a whole pass, pointed at each candidate in turn with set_candidate."""
+        return ConstellationFinder(
+            point_1=self.anchor_point, store_lookup=self.store_lookup, found_constellations=self.results,
+            match_counts=self.match_counts
+        )
+
+    def process_candidate(self,
+                          finder: ConstellationFinder,
+                          constellation: Constellation,
+                          store_index: int,
+                          minimum_constellation_size: float
+    ) -> typing.Optional[float]:
+        point_2 = (self.longitude_values[store_index], self.latitude_values[store_index])
+        finder.set_candidate(
+            point_2, constellation, minimum_constellation_size,
+            constellation.get_projected_constellation(self.anchor_point, point_2)
+        )
+        return finder.process()
+
+    def checkpoint(self,
+                   constellation: Constellation,
+                   next_index: int,
+                   minimum_constellation_size: float,
+                   completed: bool = False
+    ):
+        self.save_checkpoint([{
+            'constellation_name': constellation.name,
+            'next_index': next_index,
+            'minimum_size': minimum_constellation_size,
+            'completed': completed,
+        }], completed)
+
+    def save_checkpoint(self, passes: typing.List[typing.Dict], force: bool = False):
+        if not force and self.checkpoints.clock() - self.last_checkpoint < self.checkpoints.interval:
+            return
+        records = list(self.results) if self.results is not None else []
+        self.checkpoints.save_passes(self.store_to_examine, passes, records)
+        if self.results is not None:
+            del self.results[:len(records)]
+        self.last_checkpoint = self.checkpoints.clock()
+
+    def set_visit_order(self):
+        """
+        Largest-first order: the projection scale, and with it the size a candidate can reach, grows
+        with its distance from the anchor, so big constellations come up first and raise the minimum
+        size early. Positions in this order stand in for store indexes in checkpoints.
+        """
+        offsets = self.store_coordinates - np.array([self.store_to_examine.x, self.store_to_examine.y], dtype=float)
+        self.anchor_distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        self.visit_order = np.argsort(-self.anchor_distances, kind='stable')
+        self.visit_positions = np.empty(len(self.visit_order), dtype=np.intp)
+        self.visit_positions[self.visit_order] = np.arange(len(self.visit_order), dtype=np.intp)
+
+    def get_stop_distance(self, constellation: Constellation, minimum_constellation_size: float) -> float:
+        """In largest-first mode, the anchor distance below which no candidate can beat minimum_constellation_size."""
+        if not self.largest_first:
+            return -1
+        return constellation.get_bounds().get_minimum_anchor_distance(minimum_constellation_size)
 
-    def process_constellation(self, constellation: Constellation):
-        minimum_constellation_size = 250
-        for store_to_test in self.store_list:
+    def process_constellation(self,
+                              constellation: Constellation,
+                              start_index: int = 0,
+                              minimum_constellation_size: float = MINIMUM_CONSTELLATION_SIZE
+    ):
+        finder = self.get_finder()
+        visit_order = self.visit_order.tolist() if self.largest_first else None
+        anchor_distances = self.anchor_distances.tolist() if self.largest_first else None
+        stop_distance = self.get_stop_distance(constellation, minimum_constellation_size)
+        for position in range(start_index, len(self.store_list)):
+            store_index = position if visit_order is None else visit_order[position]
+            if anchor_distances is not None and anchor_distances[store_index] < stop_distance:
+                #   Candidates only get closer from here on.
+                break
+            if self.is_past_deadline():
+                return
             #   Don't check a store against itself.
-            if store_to_test.store_id == self.store_to_examine.store_id:
+            if store_index in self.anchor_rows:
                 continue
-            discovered_constellation = ConstellationFinder(
-                point_1=self.store_to_examine,
-                point_2=store_to_test,
-                constellation=constellation,
-                minimum_constellation_size=minimum_constellation_size,
-                store_lookup=self.store_lookup
-            ).process()
-            if discovered_constellation is None:
+            discovered_constellation = self.process_candidate(
+                finder, constellation, store_index, minimum_constellation_size
+            )
+            if discovered_constellation is not None:
+                minimum_constellation_size = discovered_constellation
+                stop_distance = self.get_stop_distance(constellation, minimum_constellation_size)
+            if self.checkpoints is not None:
+                self.checkpoint(constellation, position + 1, minimum_constellation_size)
+        if self.checkpoints is not None:
+            self.checkpoint(constellation, len(self.store_list), minimum_constellation_size, completed=True)
+
+    def process_constellation_vectorized(self,
+                                         constellation: Constellation,
+                                         start_index: int = 0,
+                                         minimum_constellation_size: float = MINIMUM_CONSTELLATION_SIZE
+    ):
+        """
+        Same search as process_constellation, but candidates are projected in numpy batches and
+        only those passing the boundary/size mask are handed to ConstellationFinder.
+        Survivors reach the matcher in ascending row order, which is store_list order and so the
+        order the scalar path, and the original search, visit them in (see StoreTable.in_search_order);
+        the adaptive minimum size therefore evolves exactly as there.
+        With a candidate_index, stores outside the feasible annulus/sectors are never projected at all,
+        and with an occupancy_filter the survivors are further filtered by its grid lookups.
+        """
+        candidate_indexes = self.get_candidate_indexes(constellation, minimum_constellation_size)
+        if self.largest_first:
+            positions = self.visit_positions[candidate_indexes]
+            candidate_indexes = candidate_indexes[np.argsort(positions, kind='stable')]
+            candidate_indexes = candidate_indexes[self.visit_positions[candidate_indexes] >= start_index]
+        else:
+            candidate_indexes = candidate_indexes[candidate_indexes >= start_index]
+        stop_distance = self.get_stop_distance(constellation, minimum_constellation_size)
+        finder = self.get_finder()
+        stopped = False
+        for start in range(0, len(candidate_indexes), self.VECTORIZED_CHUNK_SIZE):
+            if self.is_past_deadline():
+                return
+            chunk = candidate_indexes[start:start + self.VECTORIZED_CHUNK_SIZE]
+            if self.largest_first:
+                #   Drop the tail no candidate of which can beat the current minimum size.
+                chunk = chunk[self.anchor_distances[chunk] >= stop_distance]
+                stopped = len(chunk) < min(self.VECTORIZED_CHUNK_SIZE, len(candidate_indexes) - start)
+                if len(chunk) == 0:
+                    break
+            projected_constellations = constellation.get_projected_constellations(
+                self.store_to_examine, self.store_coordinates[chunk]
+            )
+            mask = ConstellationFinder.get_feasible_mask(projected_constellations, minimum_constellation_size)
+            metrics.counters['mask_rejects'] += len(mask) - int(mask.sum())
+            if self.occupancy_filter is not None:
+                feasible = int(mask.sum())
+                mask[mask] = self.occupancy_filter.get_candidate_mask(
+                    constellation, self.store_to_examine, self.store_coordinates[chunk[mask]]
+                )
+                metrics.counters['occupancy_rejects'] += feasible - int(mask.sum())
+            for store_index in chunk[mask].tolist():
+                if self.largest_first and self.anchor_distances[store_index] < stop_distance:
+                    stopped = True
+                    break
+                if self.is_past_deadline():
+                    return
+                discovered_constellation = self.process_candidate(
+                    finder, constellation, store_index, minimum_constellation_size
+                )
+                if discovered_constellation is not None:
+                    minimum_constellation_size = discovered_constellation
+                    stop_distance = self.get_stop_distance(constellation, minimum_constellation_size)
+                if self.checkpoints is not None:
+                    self.checkpoint(constellation, self.get_position(store_index) + 1, minimum_constellation_size)
+            if stopped:
+                break
+            if self.checkpoints is not None:
+                self.checkpoint(constellation, self.get_position(chunk[-1]) + 1, minimum_constellation_size)
+        if self.checkpoints is not None:
+            self.checkpoint(constellation, len(self.store_list), minimum_constellation_size, completed=True)
+
+    def process_fused(self, passes: typing.List[typing.Tuple[Constellation, int, float]]):
+        """
+        Same search as process_constellation for every (constellation, start_index, minimum size)
+        pass at once: one sweep over store_list, working out each candidate's angle and distance
+        from the anchor once and projecting every template against them with a single reused
+        ConstellationFinder. Each template keeps its own minimum size, stop distance and start
+        index, so it finds exactly what its own pass would; only the order of `results` differs,
+        being by candidate rather than by template.
+        """
+        point_1 = self.anchor_point
+        finder = self.get_finder()
+        longitude_values, latitude_values = self.longitude_values, self.latitude_values
+        start_indexes = {constellation.name: start_index for constellation, start_index, _ in passes}
+        minimum_sizes = {constellation.name: minimum_size for constellation, _, minimum_size in passes}
+        stop_distances = {
+            constellation.name: self.get_stop_distance(constellation, minimum_size)
+            for constellation, _, minimum_size in passes
+        }
+        active = [constellation for constellation, _, _ in passes]
+        visit_order = self.visit_order.tolist() if self.largest_first else None
+        anchor_distances = self.anchor_distances.tolist() if self.largest_first else None
+
+        def get_passes(next_index: int, completed: bool) -> typing.List[typing.Dict]:
+            return [{
+                'constellation_name': constellation.name,
+                'next_index': max(next_index, start_indexes[constellation.name]),
+                'minimum_size': minimum_sizes[constellation.name],
+                'completed': completed,
+            } for constellation, _, _ in passes]
+
+        for position in range(min(start_indexes.values(), default=len(self.store_list)), len(self.store_list)):
+            store_index = position if visit_order is None else visit_order[position]
+            if anchor_distances is not None:
+                #   Templates stop one by one as candidates get closer.
+                active = [c for c in active if anchor_distances[store_index] >= stop_distances[c.name]]
+                if len(active) == 0:
+                    break
+            if self.is_past_deadline():
+                return
+            #   Don't check a store against itself.
+            if store_index in self.anchor_rows:
                 continue
-            minimum_constellation_size = discovered_constellation
+            store_to_test = (longitude_values[store_index], latitude_values[store_index])
+            angle_of_locations = Constellation.get_angle(point_1, store_to_test)
+            distance_between_locations = math.dist(point_1, store_to_test)
+            for constellation in active:
+                if position < start_indexes[constellation.name]:
+                    continue
+                finder.set_candidate(
+                    store_to_test, constellation, minimum_sizes[constellation.name],
+                    constellation.get_projected_constellation_at(point_1, angle_of_locations, distance_between_locations)
+                )
+                discovered_constellation = finder.process()
+                if discovered_constellation is not None:
+                    minimum_sizes[constellation.name] = discovered_constellation
+                    stop_distances[constellation.name] = self.get_stop_distance(constellation, discovered_constellation)
+            if self.checkpoints is not None:
+                self.save_checkpoint(get_passes(position + 1, False))
+        if self.checkpoints is not None:
+            self.save_checkpoint(get_passes(len(self.store_list), True), force=True)
+
+    def get_position(self, store_index: int) -> int:
+        """Where store_index comes in the visiting order."""
+        if self.largest_first:
+            return int(self.visit_positions[store_index])
+        return int(store_index)
+
+    def run_pass(self, constellations: typing.List[Constellation], process: typing.Callable, *args):
+        """
+        Calls process(*args) with fresh lookup counts for `constellations`, and merges them into the
+        shared templates once it returns, so the matcher's inner loop never takes their lock.
+        """
+        self.match_counts = {constellation.name: constellation.get_match_counts() for constellation in constellations}
+        try:
+            process(*args)
+        finally:
+            for constellation in constellations:
+                constellation.record_matches(*self.match_counts[constellation.name])
+            self.match_counts = None
 
     def run(self):
+        node_visits = self.store_lookup.node_visits
+        if self.largest_first:
+            self.set_visit_order()
+        progress = self.checkpoints.get_progress(self.store_to_examine) if self.checkpoints is not None else {}
+        passes = []
         for constellation in self.constellations:
-            self.process_constellation(constellation)
-        self.store_to_examine.set_as_processed()
-
+            start_index, minimum_constellation_size = 0, self.MINIMUM_CONSTELLATION_SIZE
+            saved = progress.get(constellation.name)
+            if saved is not None:
+                if saved['completed']:
+                    continue
+                start_index, minimum_constellation_size = int(saved['next_index']), float(saved['minimum_size'])
+            passes.append((constellation, start_index, minimum_constellation_size))
+        if self.fused and not self.vectorized:
+            if self.checkpoints is not None:
+                self.last_checkpoint = self.checkpoints.clock()
+            self.run_pass([constellation for constellation, _, _ in passes], self.process_fused, passes)
+            passes = []
+        for constellation, start_index, minimum_constellation_size in passes:
+            if self.is_past_deadline():
+                break
+            if self.checkpoints is not None:
+                self.last_checkpoint = self.checkpoints.clock()
+            process = self.process_constellation_vectorized if self.vectorized else self.process_constellation
+            self.run_pass([constellation], process, constellation, start_index, minimum_constellation_size)
+        metrics.counters['kd_node_visits'] += self.store_lookup.node_visits - node_visits
+        if not self.collect_results and not self.timed_out:
+            self.store_to_examine.set_as_processed()
@@ -0,0 +1,126 @@
+import random
+import threading
+import typing
+
+from app.constellation.StoreLeases import StoreLeases
+from app.constellation.StorePoint import StorePoint
+
+
+class CoverageScheduler:
+    """
+    In-memory replacement for StorePoint.get_store's spatial balancing.
+
+    The 1x1 degree coverage grid is built once from the store list and the checked
+    stores, then kept up to date as stores are handed out and finished. A cell's
+    coverage counts its checked stores plus those handed out and not yet finished, so
+    parallel workers spread out instead of piling into the same empty cell.
+
+    Cells with unchecked stores sit in buckets by coverage. get_store takes a random
+    store from a random cell of the lowest non-empty bucket and moves that cell up one
+    bucket, so every call is O(1) and no query runs after the initial seed.
+
+    The grid lives in one process: use it where a single coordinator hands out work,
+    as main.py does, and StoreLeases when several hosts share the queue.
+    """
+
+    def __init__(self,
+                 stores: typing.List[StorePoint],
+                 checked_store_ids: typing.Iterable,
+                 generator: typing.Optional[random.Random] = None
+    ):
+        self.generator: random.Random = generator or random.Random()
+        self.lock: threading.Lock = threading.Lock()
+        #   cell: stores not yet handed out, in random order.
+        self.unchecked: typing.Dict[typing.Tuple[int, int], typing.List[StorePoint]] = {}
+        #   cell: checked + in flight stores.
+        self.coverage: typing.Dict[typing.Tuple[int, int], int] = {}
+        #   coverage: cells with unchecked stores at that coverage, and each cell's slot in its list.
+        self.buckets: typing.Dict[int, typing.List[typing.Tuple[int, int]]] = {}
+        self.slots: typing.Dict[typing.Tuple[int, int], int] = {}
+        self.lowest: int = 0
+        #   store_id: every store handed out and not yet completed or released.
+        self.in_flight: typing.Dict[typing.Any, StorePoint] = {}
+
+        checked_store_ids = {str(s) for s in checked_store_ids}
+        for store in stores:
+            cell = self.get_cell(store)
+            self.coverage.setdefault(cell, 0)
+            if store.get_store_id() in checked_store_ids:
+                self.coverage[cell] += 1
+            else:
+                self.unchecked.setdefault(cell, []).append(store)
+        for cell, cell_stores in self.unchecked.items():
+            self.generator.shuffle(cell_stores)
+            self.add_to_bucket(cell)
+        self.lowest = min(self.buckets, default=0)
+
+    @classmethod
+    def from_repository(cls, repository) -> 'CoverageScheduler':
+        return cls(repository.get_stores(), repository.get_checked_store_ids())
+
+    @staticmethod
+    def get_cell(store: StorePoint) -> typing.Tuple[int, int]:
+        return StoreLeases.get_cell(store.y), StoreLeases.get_cell(store.x)
+
+    def add_to_bucket(self, cell: typing.Tuple[int, int]):
+        bucket = self.buckets.setdefault(self.coverage[cell], [])
+        self.slots[cell] = len(bucket)
+        bucket.append(cell)
+        self.lowest = min(self.lowest, self.coverage[cell])
+
+    def remove_from_bucket(self, cell: typing.Tuple[int, int]):
+        bucket = self.buckets[self.coverage[cell]]
+        slot = self.slots.pop(cell)
+        last = bucket.pop()
+        if last != cell:
+            bucket[slot] = last
+            self.slots[last] = slot
+        if len(bucket) == 0:
+            del self.buckets[self.coverage[cell]]
+
+    def set_coverage(self, cell: typing.Tuple[int, int], coverage: int):
+        waiting = cell in self.slots
+        if waiting:
+            self.remove_from_bucket(cell)
+        self.coverage[cell] = coverage
+        if waiting:
+            self.add_to_bucket(cell)
+
+    def get_store(self) -> typing.Optional[StorePoint]:
+        """A store from one of the least covered cells, or None when every store has been handed out."""
+        with self.lock:
+            if len(self.buckets) == 0:
+                return None
+            while self.lowest not in self.buckets:
+                self.lowest += 1
+            bucket = self.buckets[self.lowest]
+            cell = bucket[self.generator.randrange(len(bucket))]
+            store = self.unchecked[cell].pop()
+            if len(self.unchecked[cell]) == 0:
+                del self.unchecked[cell]
+                self.remove_from_bucket(cell)
+            self.set_coverage(cell, self.coverage[cell] + 1)
+            self.in_flight[store.store_id] = store
+            return store
+
+    def complete(self, store: StorePoint):
+        """The store is checked; its cell keeps the coverage it was given when the store was handed out."""
+        with self.lock:
+            self.in_flight.pop(store.store_id, None)
+
+    def release(self, store: StorePoint):
+        """Put an unfinished store back, e.g. after its worker failed."""
+        with self.lock:
+            if self.in_flight.pop(store.store_id, None) is None:
+                return
+            cell = self.get_cell(store)
+            self.set_coverage(cell, self.coverage[cell] - 1)
+            if cell not in self.unchecked:
+                self.unchecked[cell] = []
+                self.add_to_bucket(cell)
+            self.unchecked[cell].append(store)
+
+    def close(self):
+        """Put back every store still in flight, so the grid matches what was actually checked."""
+        for store in list(self.in_flight.values()):
+            self.release(store)
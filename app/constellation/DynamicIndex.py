@@ -0,0 +1,155 @@
+import math
+import typing
+
+from app.constellation.SphericalIndex import SphericalIndex
+
+
+class DynamicIndex:
+    """
+    A SphericalIndex that takes inserts and deletes, so a refreshed store list can be applied to
+    a warm index instead of rebuilding it.
+
+    Most stores stay in the static SphericalIndex it was made from, which is never modified and
+    can go on serving the old store list. Deleted rows of it are masked out and inserted stores
+    go into a small SphericalIndex of their own, rebuilt with every batch. Once the changes add
+    up to REBUILD_FRACTION of the static stores, the live stores are rebuilt into a fresh, balanced
+    SphericalIndex and the overlay starts again empty.
+
+    Answers are those of a SphericalIndex over the live stores in StoreTable.in_search_order,
+    i.e. ties go to the store that comes first in the finder's store_list.
+    """
+    #   Inserted plus deleted stores, as a share of the static ones, that trigger a rebuild.
+    REBUILD_FRACTION = 0.05
+
+    def __init__(self, index: SphericalIndex, rebuild_fraction: float = REBUILD_FRACTION):
+        self.rebuild_fraction: float = rebuild_fraction
+        self.index: SphericalIndex = index
+        #   Rows of `index` that no longer hold a live store.
+        self.deleted: typing.Set[int] = set()
+        #   Stores inserted since the last rebuild, in search order, and the index over them.
+        self.inserted: typing.List = []
+        self.inserted_index: typing.Optional[SphericalIndex] = None
+        #   str(store_id): row of `index`, built on first delete.
+        self.rows: typing.Optional[typing.Dict[str, int]] = None
+        self.rebuilds: int = 0
+        #   Node visits of indexes already replaced, so node_visits only ever grows.
+        self.retired_visits: int = 0
+
+    def __len__(self):
+        return len(self.index) - len(self.deleted) + len(self.inserted)
+
+    @property
+    def node_visits(self) -> int:
+        inserted_visits = self.inserted_index.node_visits if self.inserted_index is not None else 0
+        return self.retired_visits + self.index.node_visits + inserted_visits
+
+    def get_row(self, store_id) -> typing.Optional[int]:
+        if self.rows is None:
+            items = self.index.tree.items
+            table = getattr(items, 'table', None)
+            if table is not None:
+                return table.get_row(store_id)
+            self.rows = {str(items[row].store_id): row for row in range(len(items))}
+        return self.rows.get(str(store_id))
+
+    def insert(self, stores: typing.List):
+        """Add stores; a store_id already present is replaced, as when a store has moved."""
+        if len(stores) == 0:
+            return
+        self.delete([store.store_id for store in stores])
+        self.inserted = sorted(self.inserted + list(stores), key=self.get_search_key)
+        self.set_inserted_index()
+        self.rebalance()
+
+    def delete(self, store_ids: typing.Iterable):
+        """Remove stores by store_id; ids that are not in the index are ignored."""
+        store_ids = {str(store_id) for store_id in store_ids}
+        if len(store_ids) == 0:
+            return
+        kept = [store for store in self.inserted if str(store.store_id) not in store_ids]
+        if len(kept) != len(self.inserted):
+            self.inserted = kept
+            self.set_inserted_index()
+        for store_id in store_ids:
+            row = self.get_row(store_id)
+            if row is not None:
+                self.deleted.add(row)
+        self.rebalance()
+
+    def set_inserted_index(self):
+        if self.inserted_index is not None:
+            self.retired_visits += self.inserted_index.node_visits
+        self.inserted_index = SphericalIndex.from_store_points(self.inserted) if self.inserted else None
+
+    @staticmethod
+    def get_search_key(store) -> typing.Tuple:
+        """Where a store comes in StoreTable.in_search_order: by longitude, then id."""
+        return store.x, store.store_id
+
+    def get_stores(self) -> typing.List:
+        """The live stores, in search order."""
+        items = self.index.tree.items
+        stores = [items[row] for row in range(len(items)) if row not in self.deleted]
+        return sorted(stores + self.inserted, key=self.get_search_key)
+
+    def rebalance(self):
+        if len(self.inserted) + len(self.deleted) > self.rebuild_fraction * len(self.index):
+            self.rebuild()
+
+    def rebuild(self):
+        stores = self.get_stores()
+        self.retired_visits = self.node_visits
+        self.index = SphericalIndex.from_store_points(stores)
+        self.deleted, self.inserted, self.inserted_index, self.rows = set(), [], None, None
+        self.rebuilds += 1
+
+    def query_static(self, vector, max_chord: float) -> typing.Tuple[float, typing.Any]:
+        """Nearest live store of the static index, as (chord, item), or (max_chord, None)."""
+        tree = self.index.tree
+        chord, row = tree.query(vector, max_chord)
+        if row == -1:
+            return max_chord, None
+        if row not in self.deleted:
+            return chord, tree.get_item(row)
+        #   The nearest is gone; at most len(deleted) stores come before the nearest live one.
+        if max_chord == math.inf:
+            neighbours = tree._knn(vector, len(self.deleted) + 1)
+        else:
+            #   query only finds stores strictly closer than max_chord; query_radius also those on it.
+            points = tree.data
+            neighbours = sorted(
+                (distance, int(r)) for distance, r in (
+                    (math.dist(points[r], vector), r) for r in tree.query_radius(vector, max_chord)
+                ) if distance < max_chord
+            )
+        for chord, row in neighbours:
+            if row not in self.deleted:
+                return chord, tree.get_item(row)
+        return max_chord, None
+
+    def query(self, vector, max_chord: float = math.inf) -> typing.Tuple[float, typing.Any]:
+        """(chord, item) of the nearest live store at most `max_chord` away, or (max_chord, None)."""
+        chord, item = self.query_static(vector, max_chord)
+        if self.inserted_index is None:
+            return chord, item
+        inserted_chord, row = self.inserted_index.tree.query(vector, max_chord)
+        if row == -1:
+            return chord, item
+        inserted_item = self.inserted_index.tree.get_item(row)
+        if item is None or inserted_chord < chord or (
+            inserted_chord == chord and self.get_search_key(inserted_item) < self.get_search_key(item)
+        ):
+            return inserted_chord, inserted_item
+        return chord, item
+
+    def get_nearest(self, coordinates) -> typing.Optional[typing.Tuple[float, typing.Any]]:
+        """(miles, item) of the geodesically nearest store, or None if the index is empty."""
+        chord, item = self.query(SphericalIndex.get_unit_vector(coordinates))
+        if item is None:
+            return None
+        return SphericalIndex.get_miles(chord), item
+
+    def get_nearest_within(self, coordinates, miles: float):
+        """The nearest store at most `miles` away, or None."""
+        return self.query(SphericalIndex.get_unit_vector(coordinates), SphericalIndex.get_chord(miles))[1]
+
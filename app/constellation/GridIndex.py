@@ -0,0 +1,150 @@
+import math
+import typing
+
+import numpy as np
+
+from app.constellation.SphericalIndex import SphericalIndex
+
+
+class GridIndex:
+    """
+    Nearest store lookups by great circle distance through a uniform grid, for a fixed tolerance.
+
+    Stores are bucketed by cell of the same 3D unit vectors SphericalIndex uses, with the
+    cell side set to the chord of `miles`. Every store within `miles` of a point then lies
+    in the 3x3x3 block of cells around it, so "is there a store within the tolerance" probes
+    27 cells, whatever the density, instead of walking a tree. Cells are addressed by a single
+    integer key and the 26 neighbour offsets are precomputed.
+
+    get_nearest, get_nearest_within and query_radius answer exactly as SphericalIndex does,
+    ties going to the lower index, so ConstellationFinder can use either. Queries much wider
+    than the cell size widen the block, and past PADDING cells fall back to a full scan.
+    """
+    #   Empty cells kept around the occupied range, so neighbour keys never wrap onto another row.
+    PADDING = 64
+
+    def __init__(self, coordinates, miles: float, items: typing.Optional[typing.Sequence] = None):
+        self.miles: float = miles
+        self.items: typing.Optional[typing.Sequence] = items
+        self.cell_size: float = SphericalIndex.get_chord(miles)
+        vectors = SphericalIndex.get_unit_vectors(coordinates)
+        #   Unit vector components lie in [-1, 1].
+        self.offset: int = int(math.ceil(1 / self.cell_size)) + 1 + self.PADDING
+        self.span: int = 2 * self.offset + 1
+        cells = np.floor(vectors / self.cell_size).astype(np.int64) + self.offset
+        keys = (cells[:, 0] * self.span + cells[:, 1]) * self.span + cells[:, 2]
+        #   Stable, so each cell lists its stores in index order.
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(keys) else np.zeros(0, dtype=np.intp)
+        ends = np.r_[starts[1:], len(keys)]
+        #   key: (start, end) into _order / _points.
+        self.cells: typing.Dict[int, typing.Tuple[int, int]] = dict(zip(
+            sorted_keys[starts].tolist(), zip(starts.tolist(), ends.tolist())
+        ))
+        self._order: typing.List[int] = order.tolist()
+        self._points: typing.List[typing.Tuple[float, float, float]] = [tuple(p) for p in vectors[order].tolist()]
+        #   Cells probed so far; reported with the KD-tree node visits by the finder's metrics.
+        self.node_visits: int = 0
+        self.neighbours: typing.Dict[int, typing.List[int]] = {}
+
+    @classmethod
+    def from_store_points(cls, store_list: typing.List, miles: float) -> 'GridIndex':
+        table = getattr(store_list, 'table', None)
+        if table is not None:
+            coordinates = table.coordinates
+        else:
+            coordinates = np.array([[s.x, s.y] for s in store_list], dtype=np.float64).reshape(-1, 2)
+        return cls(coordinates, miles, items=store_list)
+
+    def __len__(self):
+        return len(self._order)
+
+    def get_item(self, index: int):
+        return index if self.items is None else self.items[index]
+
+    def get_key(self, vector: typing.Tuple[float, float, float]) -> int:
+        size, offset = self.cell_size, self.offset
+        return (
+            (math.floor(vector[0] / size) + offset) * self.span + math.floor(vector[1] / size) + offset
+        ) * self.span + math.floor(vector[2] / size) + offset
+
+    def get_neighbours(self, reach: int) -> typing.List[int]:
+        """Key offsets of the cells within `reach` cells along every axis."""
+        neighbours = self.neighbours.get(reach)
+        if neighbours is None:
+            steps = range(-reach, reach + 1)
+            neighbours = self.neighbours[reach] = [
+                (dx * self.span + dy) * self.span + dz for dx in steps for dy in steps for dz in steps
+            ]
+        return neighbours
+
+    def get_cells(self, vector, reach: int) -> typing.List[typing.Tuple[int, int]]:
+        """(start, end) of every occupied cell within `reach` of the cell holding `vector`."""
+        key = self.get_key(vector)
+        get = self.cells.get
+        cells = [get(key + delta) for delta in self.get_neighbours(reach)]
+        return [cell for cell in cells if cell is not None]
+
+    def get_reach(self, chord: float) -> int:
+        return max(1, int(math.ceil(chord / self.cell_size)))
+
+    def scan(self, vector, reach: int, max_chord: float) -> typing.Tuple[float, int]:
+        """Nearest of the stores in the cells within `reach`, at most `max_chord` away, as (chord, index)."""
+        best_distance, best_index = max_chord, -1
+        if reach > self.PADDING:
+            candidates = [(0, len(self._order))]
+        else:
+            candidates = self.get_cells(vector, reach)
+            self.node_visits += (2 * reach + 1) ** 3
+        order, points, dist = self._order, self._points, math.dist
+        for start, end in candidates:
+            for j in range(start, end):
+                distance = dist(points[j], vector)
+                if distance < best_distance or (
+                    distance == best_distance and (best_index == -1 or order[j] < best_index)
+                ):
+                    best_distance, best_index = distance, order[j]
+        return best_distance, best_index
+
+    def query(self, vector, max_chord: float = math.inf) -> typing.Tuple[float, int]:
+        """Like ArrayKDTree.query over the unit vectors: (chord, index), or (max_chord, -1) when nothing is that close."""
+        if max_chord != math.inf:
+            return self.scan(vector, self.get_reach(max_chord), max_chord)
+        reach = 1
+        while True:
+            distance, index = self.scan(vector, reach, max_chord)
+            #   Stores outside the probed block are more than reach cells away.
+            if reach > self.PADDING or (index != -1 and distance <= reach * self.cell_size):
+                return distance, index
+            reach *= 2
+
+    def get_nearest(self, coordinates) -> typing.Optional[typing.Tuple[float, typing.Any]]:
+        """(miles, item) of the geodesically nearest store, or None if the index is empty."""
+        chord, index = self.query(SphericalIndex.get_unit_vector(coordinates))
+        if index == -1:
+            return None
+        return SphericalIndex.get_miles(chord), self.get_item(index)
+
+    def get_nearest_within(self, coordinates, miles: float):
+        """The nearest store at most `miles` away, or None."""
+        chord, index = self.query(SphericalIndex.get_unit_vector(coordinates), SphericalIndex.get_chord(miles))
+        if index == -1:
+            return None
+        return self.get_item(index)
+
+    def query_radius(self, coordinates, miles: float) -> np.ndarray:
+        """Indexes of every store within `miles` of `coordinates`, in ascending order."""
+        vector = SphericalIndex.get_unit_vector(coordinates)
+        chord = SphericalIndex.get_chord(miles)
+        reach = self.get_reach(chord)
+        if reach > self.PADDING:
+            candidates = [(0, len(self._order))]
+        else:
+            candidates = self.get_cells(vector, reach)
+        found = [
+            self._order[j] for start, end in candidates for j in range(start, end)
+            if math.dist(self._points[j], vector) <= chord
+        ]
+        found.sort()
+        return np.array(found, dtype=np.intp)
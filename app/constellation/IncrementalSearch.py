@@ -0,0 +1,343 @@
+import math
+import time
+import typing
+
+import numpy as np
+
+from app.constellation.CellCounts import CellCounts
+from app.constellation.Constellation import Constellation
+from app.constellation.ConstellationFinder import ConstellationFinder
+from app.constellation.ConstellationsFinder import ConstellationsFinder
+from app.constellation.DynamicIndex import DynamicIndex
+from app.constellation.OccupancyFilter import OccupancyFilter
+from app.constellation.SphericalIndex import SphericalIndex
+from app.constellation.StorePoint import StorePoint
+from app.constellation.StoreSnapshot import StoreSnapshot
+from app.constellation.StoreTable import StoreTable
+
+
+class IncrementalSearch:
+    """
+    Brings the results of checked anchors up to date after store_list changes, re-searching
+    only the (anchor, constellation) passes a changed store can alter.
+
+    A pass sees the stores only through the outcome of each candidate pair: the stores matched
+    to its projected points, or none. If no pair changes outcome, the pass finds what it found
+    before, whatever its running minimum size did. An added or removed store S can only change
+    the outcome of pairs that have S as their candidate, or project a template point within the
+    tolerance of S; the anchor's own point only moves for a store on the anchor itself.
+
+    For every changed store, constellation and template point, the anchors that could place
+    that point on S are screened in numpy: with S pinned to the point, every other point of the
+    projection can only move so far, and each must have a store (old or new) near enough. The
+    actual candidates of the anchors that survive are then checked point by point, and the
+    pairs left are matched against the old stores and against the new ones. The pass is
+    re-searched when the two differ.
+
+    Results are tied to a pass through their anchor's template point, the first store of
+    constellation_string by default, so anchors at the same coordinates are handled together.
+    A re-searched pass replaces its results in one short transaction, along with any result naming a
+    removed store. New and moved stores are taken off cf_stores_checked, for the normal run to
+    search as anchors.
+    """
+    #   Degrees within which two stores count as the same place; covers rounding in the projection.
+    COINCIDENT = 1e-9
+    #   No pass ever holds a smaller minimum size: ConstellationFinder.process drops finds under 100 miles.
+    FLOOR_SIZE = 100
+    #   (anchor, changed point) combinations screened at once.
+    SCREEN_SIZE = 1000000
+
+    def __init__(self,
+                 old_table: StoreTable,
+                 new_table: StoreTable,
+                 checked_store_ids: typing.Iterable,
+                 constellations: typing.List[Constellation],
+                 old_lookup: typing.Optional[SphericalIndex] = None
+    ):
+        self.old_table: StoreTable = old_table
+        self.new_table: StoreTable = new_table
+        self.constellations: typing.List[Constellation] = constellations
+        self.old_lookup: SphericalIndex = old_lookup or SphericalIndex.from_store_points(old_table.get_stores())
+        self.added_rows, self.removed_rows = self.get_delta(old_table, new_table)
+        #   The old index with the delta applied; the same answers as one built over new_table.
+        self.new_lookup: DynamicIndex = DynamicIndex(self.old_lookup)
+        self.new_lookup.delete(old_table.store_ids[self.removed_rows].tolist())
+        self.new_lookup.insert([new_table.get_store(row) for row in self.added_rows.tolist()])
+
+        #   Every store of either list: the old rows, then the added ones, and which are in the new list.
+        self.union_coordinates: np.ndarray = np.concatenate(
+            [old_table.coordinates, new_table.coordinates[self.added_rows]]
+        )
+        self.union_in_new: np.ndarray = np.ones(len(self.union_coordinates), dtype=bool)
+        self.union_in_new[self.removed_rows] = False
+        self.union_points: np.ndarray = self.union_coordinates[:, 0] + 1j * self.union_coordinates[:, 1]
+        #   Largest per-axis degree offset of a store matched to a projected point.
+        self.tolerance: float = OccupancyFilter.get_cell_size(
+            ConstellationFinder.ACCEPTABLE_DISTANCE, ConstellationFinder.BOUNDARIES
+        )
+        self.cell_counts: CellCounts = CellCounts(self.union_coordinates, self.tolerance)
+
+        #   Checked anchors that are in both lists, as rows of new_table and as complex coordinates.
+        checked_store_ids = {str(store_id) for store_id in checked_store_ids}
+        added = set(self.added_rows.tolist())
+        self.anchor_rows: np.ndarray = np.array([
+            row for row, store_id in enumerate(new_table.store_ids.astype(np.str_).tolist())
+            if store_id in checked_store_ids and row not in added
+        ], dtype=np.intp)
+        anchor_coordinates = new_table.coordinates[self.anchor_rows]
+        self.anchor_points: np.ndarray = anchor_coordinates[:, 0] + 1j * anchor_coordinates[:, 1]
+
+    @classmethod
+    def from_snapshot(cls,
+                      snapshot: StoreSnapshot,
+                      repository,
+                      constellations: typing.List[Constellation]
+    ) -> 'IncrementalSearch':
+        """From the store list `snapshot` was last written with to what `repository` holds now."""
+        ids, tree, old_lookup = snapshot.load_all()
+        old_table = StoreTable(ids, tree.data)
+        old_lookup.tree.items = old_table.get_stores()
+        return cls(
+            old_table,
+            StoreTable.in_search_order(repository.get_stores()),
+            repository.get_checked_store_ids(),
+            constellations,
+            old_lookup
+        )
+
+    @staticmethod
+    def get_delta(old_table: StoreTable, new_table: StoreTable) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Rows of new_table that are new or have moved, and rows of old_table that are gone or have moved."""
+        added = []
+        kept = np.zeros(len(old_table), dtype=bool)
+        for row, store_id in enumerate(new_table.store_ids.tolist()):
+            old_row = old_table.get_row(store_id)
+            if old_row is None or (old_table.coordinates[old_row] != new_table.coordinates[row]).any():
+                added.append(row)
+            else:
+                kept[old_row] = True
+        return np.array(added, dtype=np.intp), np.flatnonzero(~kept)
+
+    def get_union_store(self, index: int) -> StorePoint:
+        """The store behind a row of union_coordinates."""
+        old_count = len(self.old_table)
+        if index < old_count:
+            return self.old_table.get_store(index)
+        return self.new_table.get_store(int(self.added_rows[index - old_count]))
+
+    @classmethod
+    def get_outcome(cls, store_lookup, anchor: StorePoint, candidate: StorePoint,
+                    constellation: Constellation) -> typing.Optional[typing.Dict]:
+        """The record the pair would be found as at the lowest possible minimum size, or None."""
+        found = []
+        ConstellationFinder(
+            point_1=anchor, point_2=candidate, constellation=constellation,
+            minimum_constellation_size=cls.FLOOR_SIZE, store_lookup=store_lookup, found_constellations=found
+        ).process()
+        return found[0] if found else None
+
+    def is_changed_pair(self, anchor_index: int, union_index: int, constellation: Constellation) -> bool:
+        anchor = self.new_table.get_store(int(self.anchor_rows[anchor_index]))
+        candidate = self.get_union_store(union_index)
+        if candidate.store_id == anchor.store_id:
+            return False
+        old = None
+        if union_index < len(self.old_table):
+            old = self.get_outcome(self.old_lookup, anchor, candidate, constellation)
+        new = None
+        if self.union_in_new[union_index]:
+            new = self.get_outcome(self.new_lookup, anchor, candidate, constellation)
+        return old != new
+
+    def get_changed_anchors(self, points: np.ndarray, constellation: Constellation, done: np.ndarray) -> np.ndarray:
+        """
+        Indexes into anchor_rows of the anchors not yet `done` with a pair of `constellation` whose
+        outcome a store at one of `points` (complex coordinates) changes.
+        """
+        keys = OccupancyFilter.get_triple_keys(constellation)
+        anchor_1, anchor_2 = constellation.anchor_pair
+        others = [i for i in constellation.geometric_order if i not in constellation.anchor_pair]
+        anchors = self.anchor_points
+        changed = np.zeros(len(anchors), dtype=bool)
+        #   Changed points screened together, so that (anchor, point) arrays stay near SCREEN_SIZE.
+        chunk_size = max(1, self.SCREEN_SIZE // max(1, len(anchors)))
+        for role, key in enumerate(keys):
+            if role == anchor_1:
+                continue
+            #   How far the candidate can be from where the role puts it: a store on the candidate itself,
+            #   or anywhere that keeps the role's projected point within the tolerance of the changed point.
+            wiggle = self.COINCIDENT if role == anchor_2 else math.sqrt(2) * self.tolerance / abs(key)
+            ratios = keys / key
+            for chunk in range(0, len(points), chunk_size):
+                chunk_points = points[chunk:chunk + chunk_size]
+                open_anchors = np.flatnonzero(~done & ~changed)
+                pair_anchors = np.repeat(open_anchors, len(chunk_points))
+                pair_points = np.tile(chunk_points, len(open_anchors))
+                for other in [anchor_2] + others:
+                    if other == role or len(pair_anchors) == 0:
+                        continue
+                    #   Where `other` lands with the candidate the role asks for, and how far it can stray from there.
+                    landing = anchors[pair_anchors] + ratios[other] * (pair_points - anchors[pair_anchors])
+                    radius = abs(keys[other]) * wiggle + (0 if other == anchor_2 else self.tolerance) + self.COINCIDENT
+                    keep = self.cell_counts.has_store(*self.get_xy(landing), radius)
+                    pair_anchors, pair_points = pair_anchors[keep], pair_points[keep]
+                if len(pair_anchors) == 0:
+                    continue
+                self.check_pairs(pair_anchors, pair_points, constellation, role, wiggle, changed)
+        return np.flatnonzero(changed)
+
+    def check_pairs(self, pair_anchors: np.ndarray, pair_points: np.ndarray, constellation: Constellation,
+                    role: int, wiggle: float, changed: np.ndarray):
+        """
+        Sets `changed` for the anchors with an actual pair that puts `role` on its changed point and
+        whose outcome differs between the old and new stores.
+        """
+        keys = OccupancyFilter.get_triple_keys(constellation)
+        anchors = self.anchor_points
+        centres = anchors[pair_anchors] + (pair_points - anchors[pair_anchors]) / keys[role]
+        boxes, union_indexes = self.cell_counts.get_pairs(*self.get_xy(centres), wiggle + self.COINCIDENT)
+        candidates = self.union_points[union_indexes]
+        steps = candidates - anchors[pair_anchors[boxes]]
+        pinned = anchors[pair_anchors[boxes]] + keys[role] * steps - pair_points[boxes]
+        keep = np.abs(candidates - centres[boxes]) <= wiggle + self.COINCIDENT
+        keep &= np.maximum(np.abs(pinned.real), np.abs(pinned.imag)) <= self.tolerance + self.COINCIDENT
+        for other in constellation.geometric_order:
+            if other in constellation.anchor_pair or other == role:
+                continue
+            landing = anchors[pair_anchors[boxes[keep]]] + keys[other] * steps[keep]
+            keep[keep] = self.cell_counts.has_store(*self.get_xy(landing), self.tolerance + self.COINCIDENT)
+        pairs = np.unique(np.stack([pair_anchors[boxes[keep]], union_indexes[keep]], axis=1), axis=0)
+        for anchor_index, union_index in pairs.tolist():
+            if not changed[anchor_index] and self.is_changed_pair(anchor_index, union_index, constellation):
+                changed[anchor_index] = True
+
+    @staticmethod
+    def get_xy(points: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        return points.real, points.imag
+
+    def get_changed_points(self) -> typing.List[typing.Tuple[float, float]]:
+        """Coordinates of every added or removed store, each place once."""
+        coordinates = np.concatenate([
+            self.old_table.coordinates[self.removed_rows], self.new_table.coordinates[self.added_rows]
+        ])
+        return sorted(set(map(tuple, coordinates.tolist())))
+
+    def get_anchor_key(self, anchor_index: int) -> typing.Tuple[float, float]:
+        point = self.anchor_points[anchor_index]
+        return point.real, point.imag
+
+    def get_affected_passes(self) -> typing.Dict[typing.Tuple[float, float], typing.Set[str]]:
+        """Names of the constellations to re-search, by anchor coordinates."""
+        names = {c.name for c in self.constellations}
+        affected = {}
+        #   Anchors on a changed store, and the results of a removed anchor, need every pass.
+        on_changed = np.zeros(len(self.anchor_points), dtype=bool)
+        changed_points = self.get_changed_points()
+        for x, y in changed_points:
+            affected.setdefault((x, y), set()).update(names)
+            on_changed |= np.abs(self.anchor_points - complex(x, y)) <= self.COINCIDENT
+        for anchor_index in np.flatnonzero(on_changed).tolist():
+            affected.setdefault(self.get_anchor_key(anchor_index), set()).update(names)
+        points = np.array([complex(x, y) for x, y in changed_points], dtype=np.complex128)
+        for constellation in self.constellations:
+            for anchor_index in self.get_changed_anchors(points, constellation, on_changed).tolist():
+                affected.setdefault(self.get_anchor_key(anchor_index), set()).add(constellation.name)
+        return affected
+
+    def get_record_key(self, record: typing.Dict,
+                       constellations: typing.Dict[str, Constellation]) -> typing.Optional[typing.Tuple[float, float]]:
+        """Coordinates of the anchor a result was found from, or None for an unknown store or constellation."""
+        constellation = constellations.get(record['constellation_name'])
+        if constellation is None:
+            return None
+        anchor_id = record['constellation_string'].split('|')[constellation.anchor_pair[0]]
+        for table in (self.old_table, self.new_table):
+            row = table.get_row(anchor_id)
+            if row is not None:
+                return tuple(table.coordinates[row].tolist())
+        return None
+
+    def get_result_ids(self, repository, affected: typing.Dict[typing.Tuple[float, float], typing.Set[str]],
+                       batch_size: int) -> typing.Dict[typing.Tuple[float, float], typing.List]:
+        """
+        Ids of the results of every affected pass, by anchor coordinates. Passes with a result naming
+        a removed store are added to `affected` first.
+        """
+        constellations = {c.name: c for c in self.constellations}
+        removed_ids = set(self.old_table.store_ids[self.removed_rows].astype(np.str_).tolist())
+        if len(removed_ids) > 0:
+            for records in repository.iterate_constellations(batch_size):
+                for record in records:
+                    if removed_ids.isdisjoint(record['constellation_string'].split('|')):
+                        continue
+                    key = self.get_record_key(record, constellations)
+                    if key is not None:
+                        affected.setdefault(key, set()).add(record['constellation_name'])
+        result_ids = {}
+        for records in repository.iterate_constellations(batch_size):
+            for record in records:
+                key = self.get_record_key(record, constellations)
+                if key is not None and record['constellation_name'] in affected.get(key, ()):
+                    result_ids.setdefault(key, []).append(record['id'])
+        return result_ids
+
+    def run(self,
+            repository,
+            finder_options: typing.Optional[typing.Dict] = None,
+            batch_size: int = 10000,
+            report: typing.Callable[[str], None] = print
+    ) -> typing.Dict:
+        """
+        Re-searches every affected pass and swaps its results in, one anchor location at a time:
+        each location is searched outside any transaction, then its old results are deleted and
+        the new ones written in one short transaction. Then takes new and moved stores off
+        cf_stores_checked. `finder_options` are the ConstellationsFinder arguments the results were
+        found with, over the new store list; the plain scalar search over new_lookup by default.
+        Returns counts and timings.
+        """
+        start = time.monotonic()
+        finder_options = finder_options or {'store_list': self.new_table.get_stores(), 'store_lookup': self.new_lookup}
+        totals = {
+            'added': len(self.added_rows),
+            'removed': len(self.removed_rows),
+            'passes': 0,
+            'results_deleted': 0,
+            'results_written': 0,
+        }
+        affected = self.get_affected_passes()
+        totals['screen_seconds'] = time.monotonic() - start
+        result_ids = self.get_result_ids(repository, affected, batch_size)
+        anchor_rows = {}
+        for anchor_index, row in enumerate(self.anchor_rows.tolist()):
+            anchor_rows.setdefault(self.get_anchor_key(anchor_index), []).append(row)
+        report('%d stores added, %d removed; re-searching %d anchor locations' % (
+            totals['added'], totals['removed'], len(affected)
+        ))
+        for key, names in affected.items():
+            constellations = [c for c in self.constellations if c.name in names]
+            results = []
+            for row in anchor_rows.get(key, []):
+                finder = ConstellationsFinder(
+                    store_to_examine=self.new_table.get_store(row),
+                    constellations=constellations,
+                    collect_results=True,
+                    **finder_options
+                )
+                finder.run()
+                results.extend(finder.results)
+                totals['passes'] += len(constellations)
+            #   Searched first, so the write transaction only lasts as long as the swap.
+            with repository.transaction():
+                repository.delete_constellations(result_ids.get(key, []))
+                repository.write_results(results)
+            totals['results_deleted'] += len(result_ids.get(key, []))
+            totals['results_written'] += len(results)
+        repository.set_many_as_unprocessed(
+            self.new_table.store_ids[self.added_rows].tolist() + self.old_table.store_ids[self.removed_rows].tolist()
+        )
+        totals['seconds'] = time.monotonic() - start
+        report('re-searched %d passes in %.1fs (%.1fs screening); %d results replaced by %d' % (
+            totals['passes'], totals['seconds'], totals['screen_seconds'],
+            totals['results_deleted'], totals['results_written']
+        ))
+        return totals
@@ -0,0 +1,99 @@
+import math
+import typing
+
+import numpy as np
+
+from app.constellation.Constellation import Constellation
+
+
+class OccupancyFilter:
+    """
+    Occupancy pre-filter for vectorized candidates: drops an (anchor, candidate) pair when some
+    template point would land where no store is.
+
+    Each template point k has a fixed complex ratio (tk - t0) / (t1 - t0) to the constellation's
+    anchor pair t0, t1, which encodes both the length ratio and the angle of the triple. For an
+    anchor A and candidate B the point is projected to A + key * (B - A), and a store X can only
+    be matched to it when X lies within the tolerance of that spot.
+
+    Stores are marked once in a grid of cells at least as wide as the tolerance, with every cell
+    also marked in its 8 neighbours, so "is there a store for template point k" becomes a single
+    cell lookup instead of a KD query. The grid costs O(N) to build and still has every candidate
+    projected; it is not geometric hashing, which would index store triples by their invariants.
+    The lookup is a necessary condition only; survivors still go through ConstellationFinder and
+    its ACCEPTABLE_DISTANCE/haversine check.
+    """
+    #   Miles per degree of latitude for the 3956 mile earth radius used by haversine.
+    MILES_PER_DEGREE = 3956 * math.pi / 180
+
+    def __init__(self,
+                 store_coordinates: np.ndarray,
+                 constellations: typing.List[Constellation],
+                 acceptable_distance: float,
+                 boundaries: typing.List
+    ):
+        self.store_coordinates: np.ndarray = np.asarray(store_coordinates, dtype=float)
+        self.cell_size: float = self.get_cell_size(acceptable_distance, boundaries)
+        self.triple_keys: typing.Dict[str, np.ndarray] = {
+            c.name: self.get_triple_keys(c) for c in constellations
+        }
+
+        self.origin: np.ndarray = self.store_coordinates.min(axis=0) - 2 * self.cell_size
+        extent = self.store_coordinates.max(axis=0) + 2 * self.cell_size - self.origin
+        self.shape: typing.Tuple[int, int] = tuple(int(n) + 1 for n in np.floor(extent / self.cell_size))
+        self.occupied: np.ndarray = np.zeros(self.shape, dtype=bool)
+        cells = self.get_cells(self.store_coordinates[:, 0], self.store_coordinates[:, 1])
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                self.occupied[cells[0] + dx, cells[1] + dy] = True
+
+    @classmethod
+    def get_cell_size(cls, acceptable_distance: float, boundaries) -> float:
+        """
+        Smallest degree radius guaranteed to contain every point within acceptable_distance miles.
+        A degree of longitude is shortest at the highest latitude in the boundaries; one degree of
+        margin covers a great circle bulging poleward over such a short hop.
+        """
+        highest_latitude = max(abs(boundaries[0][1]), abs(boundaries[1][1])) + 1
+        radius = acceptable_distance / (cls.MILES_PER_DEGREE * math.cos(math.radians(highest_latitude)))
+        return radius * (1 + 1e-6)
+
+    @staticmethod
+    def get_triple_keys(constellation: Constellation) -> np.ndarray:
+        template = np.asarray(constellation.points, dtype=float)
+        as_complex = template[:, 0] + 1j * template[:, 1]
+        anchor_1, anchor_2 = (as_complex[i] for i in constellation.anchor_pair)
+        return (as_complex - anchor_1) / (anchor_2 - anchor_1)
+
+    def get_cells(self, x: np.ndarray, y: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        return (
+            np.floor((x - self.origin[0]) / self.cell_size).astype(np.intp),
+            np.floor((y - self.origin[1]) / self.cell_size).astype(np.intp),
+        )
+
+    def is_occupied(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        cell_x, cell_y = self.get_cells(x, y)
+        inside = (cell_x >= 0) & (cell_x < self.shape[0]) & (cell_y >= 0) & (cell_y < self.shape[1])
+        found = np.zeros(x.shape, dtype=bool)
+        found[inside] = self.occupied[cell_x[inside], cell_y[inside]]
+        return found
+
+    def get_candidate_mask(self, constellation: Constellation, point_1, points_2: np.ndarray) -> np.ndarray:
+        """
+        For anchor point_1 and every candidate point_2, whether each remaining template point has a
+        store marked near its predicted position. Template points are checked one at a time so
+        most candidates drop out after the first few lookups.
+        """
+        keys = self.triple_keys[constellation.name]
+        points_2 = np.asarray(points_2, dtype=float)
+        mask = np.ones(len(points_2), dtype=bool)
+        anchor_offsets = (points_2[:, 0] - point_1[0]) + 1j * (points_2[:, 1] - point_1[1])
+        for point_index in constellation.get_evaluation_order():
+            if point_index in constellation.anchor_pair:
+                continue
+            remaining = np.flatnonzero(mask)
+            if len(remaining) == 0:
+                break
+            predicted = anchor_offsets[remaining] * keys[point_index]
+            mask[remaining] = self.is_occupied(predicted.real + point_1[0], predicted.imag + point_1[1])
+        return mask
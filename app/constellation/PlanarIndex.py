@@ -0,0 +1,46 @@
+import typing
+
+from app.constellation.ArrayKDTree import ArrayKDTree
+from app.constellation.ConstellationFinder import ConstellationFinder
+
+
+class PlanarIndex:
+    """
+    Nearest store lookups the way ConstellationFinder first made them: the nearest store by
+    longitude/latitude degrees, accepted when haversine puts it within the tolerance.
+
+    Wraps any tree with KDTree's get_nearest, an ArrayKDTree or the original KDTree itself,
+    and answers the get_nearest/get_nearest_within interface of SphericalIndex and GridIndex,
+    so the finder queries every lookup the same way. A degree of longitude counts as a degree
+    of latitude here, so a store further away can hide one within the tolerance; see
+    SphericalIndex.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    @classmethod
+    def from_store_points(cls, store_list: typing.List, leaf_size: int = 8) -> 'PlanarIndex':
+        return cls(ArrayKDTree.from_store_points(store_list, leaf_size))
+
+    @property
+    def node_visits(self) -> int:
+        #   The original KDTree does not count them.
+        return getattr(self.tree, 'node_visits', 0)
+
+    def get_nearest(self, coordinates) -> typing.Optional[typing.Tuple[float, typing.Any]]:
+        """(miles, item) of the nearest store by degrees, or None if the index is empty."""
+        nearest = self.tree.get_nearest(coordinates)
+        if nearest is None:
+            return None
+        point = nearest[1]
+        return ConstellationFinder.haversine_from_points(point, coordinates), point
+
+    def get_nearest_within(self, coordinates, miles: float):
+        """The nearest store by degrees if it is at most `miles` away, else None."""
+        nearest = self.tree.get_nearest(coordinates)
+        if nearest is None:
+            return None
+        point = nearest[1]
+        if ConstellationFinder.haversine_from_points(point, coordinates) <= miles:
+            return point
@@ -0,0 +1,86 @@
+import math
+import typing
+
+from app.constellation.BloomFilter import BloomFilter
+from app.constellation.ConstellationFinder import ConstellationFinder
+from app.metrics import metrics
+
+
+class ResultFilter:
+    """
+    Drops found constellations that would only repeat rows already written.
+
+    A result's canonical key is its constellation name plus its sorted store ids, so the
+    same stores found from another anchor, or matched to the template in another order,
+    share a key. Keys seen by this process go into a BloomFilter and later results with a
+    known key are skipped. A false positive drops a genuinely new result, with probability
+    about `error_rate` while under `capacity` keys.
+
+    With `suppression_degrees`, results are also grouped into regions: the grid cell, that
+    many degrees across, holding the centre of their stores' bounding box. Within a region
+    only the largest constellation of each name is kept. A store's results are suppressed
+    against one another largest first, and later results only get through when they beat
+    the largest already kept in their region; rows already written are never taken back.
+    """
+
+    def __init__(self,
+                 capacity: int = 10000000,
+                 error_rate: float = 1e-6,
+                 suppression_degrees: float = 0,
+                 store_coordinates: typing.Optional[typing.Dict[str, typing.Tuple[float, float]]] = None
+    ):
+        self.seen: BloomFilter = BloomFilter(capacity, error_rate)
+        self.suppression_degrees: float = suppression_degrees
+        #   store_id: (longitude, latitude), needed to place results in regions.
+        self.store_coordinates: typing.Dict[str, typing.Tuple[float, float]] = store_coordinates or {}
+        #   (constellation_name, cell x, cell y): size of the largest result kept there.
+        self.region_sizes: typing.Dict[typing.Tuple[str, int, int], float] = {}
+        if suppression_degrees > 0 and store_coordinates is None:
+            raise ValueError('Spatial suppression needs store_coordinates')
+
+    @staticmethod
+    def get_canonical_key(record: typing.Dict) -> str:
+        store_ids = sorted(record['constellation_string'].split('|'))
+        return '%s:%s' % (record['constellation_name'], '|'.join(store_ids))
+
+    def get_region(self, record: typing.Dict) -> typing.Tuple[str, int, int]:
+        points = [self.store_coordinates[store_id] for store_id in record['constellation_string'].split('|')]
+        center_x = (min(p[0] for p in points) + max(p[0] for p in points)) / 2
+        center_y = (min(p[1] for p in points) + max(p[1] for p in points)) / 2
+        return (
+            record['constellation_name'],
+            math.floor(center_x / self.suppression_degrees),
+            math.floor(center_y / self.suppression_degrees),
+        )
+
+    def get_size(self, record: typing.Dict) -> float:
+        if record.get('size') is not None:
+            return record['size']
+        points = [self.store_coordinates[store_id] for store_id in record['constellation_string'].split('|')]
+        return ConstellationFinder.get_constellation_size(points)
+
+    def suppress(self, records: typing.List[typing.Dict]) -> typing.List[typing.Dict]:
+        kept = []
+        for record in sorted(records, key=self.get_size, reverse=True):
+            region = self.get_region(record)
+            size = self.get_size(record)
+            if size <= self.region_sizes.get(region, -1):
+                metrics.counters['suppressed_results'] += 1
+                continue
+            self.region_sizes[region] = size
+            kept.append(record)
+        #   Back in the order they were found.
+        kept_ids = {id(record) for record in kept}
+        return [record for record in records if id(record) in kept_ids]
+
+    def filter(self, records: typing.List[typing.Dict]) -> typing.List[typing.Dict]:
+        """The records worth writing, in their original order; marks them as seen."""
+        fresh = []
+        for record in records:
+            if not self.seen.add(self.get_canonical_key(record)):
+                metrics.counters['duplicate_results'] += 1
+                continue
+            fresh.append(record)
+        if self.suppression_degrees > 0:
+            fresh = self.suppress(fresh)
+        return fresh
@@ -0,0 +1,116 @@
+import queue
+import threading
+import time
+import typing
+
+from app.constellation.ResultFilter import ResultFilter
+from app.constellation.StorePoint import StorePoint
+from app.metrics import metrics
+from app.storage.StoreRepository import StoreRepository
+
+
+class ResultSink:
+    """
+    Write-behind sink for finished stores.
+
+    submit() only enqueues, so the compute loop never waits on the database. A
+    background thread gathers finished stores and, once `batch_stores` have built up or
+    `flush_interval` seconds have passed, writes their constellations and their
+    cf_stores_checked rows with insert_many in a single transaction: a store's results
+    and its checked row land together or not at all. A failed flush is retried on the
+    next cycle. close() flushes whatever is left and stops the thread.
+
+    With a `result_filter`, submit() drops duplicate and suppressed results first, in the
+    caller's thread.
+
+    `pending` holds the ids of stores submitted but not yet committed. They are not on
+    cf_stores_checked yet, so claiming stores from the repository must skip them.
+    """
+
+    def __init__(self,
+                 batch_stores: int = 50,
+                 flush_interval: float = 5,
+                 complete_store: typing.Optional[typing.Callable[[StorePoint], None]] = None,
+                 repository: typing.Optional[StoreRepository] = None,
+                 result_filter: typing.Optional[ResultFilter] = None
+    ):
+        self.batch_stores: int = batch_stores
+        self.flush_interval: float = flush_interval
+        #   Extra per-store bookkeeping run inside the flush transaction, e.g. StoreLeases.complete.
+        self.complete_store: typing.Optional[typing.Callable[[StorePoint], None]] = complete_store
+        self.repository: StoreRepository = repository or StoreRepository.from_url('mysql')
+        self.result_filter: typing.Optional[ResultFilter] = result_filter
+        self.queue: queue.Queue = queue.Queue()
+        self.buffer: typing.List[typing.Tuple[StorePoint, typing.List[typing.Dict]]] = []
+        self.error: typing.Optional[BaseException] = None
+        self.pending: typing.Set[str] = set()
+        self.pending_lock: threading.Lock = threading.Lock()
+        self.thread: threading.Thread = threading.Thread(target=self.run, name='ResultSink', daemon=True)
+        self.thread.start()
+
+    def submit(self, store: StorePoint, results: typing.List[typing.Dict]):
+        if self.result_filter is not None:
+            results = self.result_filter.filter(results)
+        with self.pending_lock:
+            self.pending.add(store.get_store_id())
+        self.queue.put((store, results))
+
+    def get_pending_ids(self) -> typing.Set[str]:
+        with self.pending_lock:
+            return set(self.pending)
+
+    def write(self, buffer: typing.List[typing.Tuple[StorePoint, typing.List[typing.Dict]]]):
+        start = time.monotonic()
+        self.write_batch(buffer)
+        metrics.observe('db_write_seconds', time.monotonic() - start)
+
+    def write_batch(self, buffer: typing.List[typing.Tuple[StorePoint, typing.List[typing.Dict]]]):
+        with self.repository.transaction():
+            self.repository.write_results([r for _, results in buffer for r in results])
+            self.repository.set_many_as_processed([store for store, _ in buffer])
+            if self.complete_store is not None:
+                for store, _ in buffer:
+                    self.complete_store(store)
+        with self.pending_lock:
+            self.pending.difference_update(store.get_store_id() for store, _ in buffer)
+
+    def flush(self) -> bool:
+        if len(self.buffer) == 0:
+            return True
+        try:
+            self.write(self.buffer)
+        except Exception as e:
+            self.error = e
+            return False
+        self.buffer = []
+        self.error = None
+        return True
+
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, last_flush + self.flush_interval - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+                if item is None:
+                    return
+                self.buffer.append(item)
+            except queue.Empty:
+                pass
+            if len(self.buffer) >= self.batch_stores or time.monotonic() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.monotonic()
+
+    def close(self):
+        """Stop the background thread and write everything still queued; raises if the last flush fails."""
+        self.queue.put(None)
+        self.thread.join()
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self.buffer.append(item)
+        if not self.flush():
+            raise self.error
@@ -0,0 +1,93 @@
+import math
+import typing
+
+import numpy as np
+
+from app.constellation.ArrayKDTree import ArrayKDTree
+
+
+class SphericalIndex:
+    """
+    Nearest store lookups by great circle distance.
+
+    Stores are indexed as 3D unit vectors, where straight-line (chord) distance grows
+    monotonically with great circle distance. The nearest vector is therefore the
+    geodesically nearest store, wherever it is on the map, and a tolerance in miles is a
+    single chord radius: "is there a store within ACCEPTABLE_DISTANCE" is one bounded
+    KD query with no trig on the hit.
+
+    An ArrayKDTree over raw longitude/latitude instead treats a degree of longitude as a
+    degree of latitude, so its nearest point can be further away than another store.
+    """
+    #   Same earth radius as ConstellationFinder.haversine, in miles.
+    EARTH_RADIUS = 3956
+
+    def __init__(self, coordinates, items: typing.Optional[typing.Sequence] = None, leaf_size: int = 8):
+        self.tree: ArrayKDTree = ArrayKDTree(self.get_unit_vectors(coordinates), leaf_size=leaf_size, items=items)
+
+    @classmethod
+    def from_tree(cls, tree: ArrayKDTree) -> 'SphericalIndex':
+        """Wraps an ArrayKDTree over unit vectors, e.g. one loaded from a StoreSnapshot."""
+        index = cls.__new__(cls)
+        index.tree = tree
+        return index
+
+    @classmethod
+    def from_store_points(cls, store_list: typing.List, leaf_size: int = 8) -> 'SphericalIndex':
+        table = getattr(store_list, 'table', None)
+        if table is not None:
+            #   Rows of a StoreTable, whose coordinates array is already what is needed.
+            coordinates = table.coordinates
+        else:
+            coordinates = np.array([[s.x, s.y] for s in store_list], dtype=np.float64).reshape(-1, 2)
+        return cls(coordinates, items=store_list, leaf_size=leaf_size)
+
+    def __len__(self):
+        return len(self.tree)
+
+    @property
+    def node_visits(self) -> int:
+        return self.tree.node_visits
+
+    @staticmethod
+    def get_unit_vectors(coordinates) -> np.ndarray:
+        """(N, 2) longitude/latitude in degrees to (N, 3) unit vectors."""
+        coordinates = np.radians(np.asarray(coordinates, dtype=np.float64).reshape(-1, 2))
+        cos_latitude = np.cos(coordinates[:, 1])
+        return np.column_stack((
+            cos_latitude * np.cos(coordinates[:, 0]),
+            cos_latitude * np.sin(coordinates[:, 0]),
+            np.sin(coordinates[:, 1]),
+        ))
+
+    @staticmethod
+    def get_unit_vector(coordinates) -> typing.Tuple[float, float, float]:
+        longitude, latitude = math.radians(coordinates[0]), math.radians(coordinates[1])
+        cos_latitude = math.cos(latitude)
+        return cos_latitude * math.cos(longitude), cos_latitude * math.sin(longitude), math.sin(latitude)
+
+    @classmethod
+    def get_chord(cls, miles: float) -> float:
+        return 2 * math.sin(min(miles / (2 * cls.EARTH_RADIUS), math.pi / 2))
+
+    @classmethod
+    def get_miles(cls, chord: float) -> float:
+        return 2 * cls.EARTH_RADIUS * math.asin(min(chord / 2, 1.0))
+
+    def get_nearest(self, coordinates) -> typing.Optional[typing.Tuple[float, typing.Any]]:
+        """(miles, item) of the geodesically nearest store, or None if the index is empty."""
+        chord, index = self.tree.query(self.get_unit_vector(coordinates))
+        if index == -1:
+            return None
+        return self.get_miles(chord), self.tree.get_item(index)
+
+    def get_nearest_within(self, coordinates, miles: float):
+        """The nearest store at most `miles` away, or None."""
+        chord, index = self.tree.query(self.get_unit_vector(coordinates), self.get_chord(miles))
+        if index == -1:
+            return None
+        return self.tree.get_item(index)
+
+    def query_radius(self, coordinates, miles: float) -> np.ndarray:
+        """Indexes of every store within `miles` of `coordinates`, in ascending order."""
+        return self.tree.query_radius(self.get_unit_vector(coordinates), self.get_chord(miles))
@@ -0,0 +1,93 @@
+import time
+import typing
+
+from app.constellation.ConstellationFinder import ConstellationFinder
+from app.constellation.StorePoint import StorePoint
+from app.db import get_all_rows, get_cursor, transaction
+
+
+class StoreCheckpoints:
+    """
+    Progress of each (anchor store, constellation) pass, kept in cf_store_progress.
+
+    A pass records how far into store_list it has got (next_index) and the adaptive
+    minimum size at that point, which is all process_constellation needs to carry on
+    exactly where it stopped. The constellations found since the previous checkpoint are
+    written in the same transaction as the progress row, so after a crash a restarted
+    worker resumes from the last checkpoint and replays nothing that was already written.
+    """
+    CREATE_TABLES = [
+        """
+        CREATE TABLE IF NOT EXISTS cf_store_progress (
+            store_id BIGINT NOT NULL,
+            constellation_name VARCHAR(64) NOT NULL,
+            next_index INT NOT NULL,
+            minimum_size DOUBLE NOT NULL,
+            completed TINYINT NOT NULL,
+            checker_name VARCHAR(64) NULL,
+            when_updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (store_id, constellation_name)
+        )
+        """,
+    ]
+    GET_PROGRESS = """
+        SELECT constellation_name, next_index, minimum_size, completed
+        FROM cf_store_progress
+        WHERE store_id = %(store_id)s
+        """
+    SAVE_PROGRESS = """
+        INSERT INTO cf_store_progress (
+            store_id, constellation_name, next_index, minimum_size, completed, checker_name
+        ) VALUES (
+            %(store_id)s, %(constellation_name)s, %(next_index)s, %(minimum_size)s, %(completed)s, %(checker_name)s
+        )
+        ON DUPLICATE KEY UPDATE
+            next_index = VALUES(next_index),
+            minimum_size = VALUES(minimum_size),
+            completed = VALUES(completed),
+            checker_name = VALUES(checker_name)
+        """
+
+    def __init__(self, interval: float = 30, clock: typing.Callable[[], float] = time.monotonic):
+        #   Seconds between checkpoints within one pass; a finished pass is always checkpointed.
+        self.interval: float = interval
+        self.clock: typing.Callable[[], float] = clock
+
+    def create_tables(self):
+        with get_cursor() as cursor:
+            for statement in self.CREATE_TABLES:
+                cursor.execute(statement)
+
+    def get_progress(self, store: StorePoint) -> typing.Dict[str, typing.Dict]:
+        """Saved progress of every pass of `store`, by constellation name."""
+        rows = get_all_rows(self.GET_PROGRESS, {'store_id': store.get_store_id()})
+        return {row['constellation_name']: row for row in rows}
+
+    def save(self,
+             store: StorePoint,
+             constellation_name: str,
+             next_index: int,
+             minimum_size: float,
+             completed: bool,
+             records: typing.List[typing.Dict]
+    ):
+        self.save_passes(store, [{
+            'constellation_name': constellation_name,
+            'next_index': next_index,
+            'minimum_size': minimum_size,
+            'completed': completed,
+        }], records)
+
+    def save_passes(self, store: StorePoint, passes: typing.List[typing.Dict], records: typing.List[typing.Dict]):
+        """Progress of several passes, e.g. a fused sweep's, and the records found since, in one transaction."""
+        checker_name = store.get_checked_record()['checker_name']
+        with transaction() as cursor:
+            ConstellationFinder.write_constellations(records)
+            cursor.executemany(self.SAVE_PROGRESS, [{
+                'store_id': store.get_store_id(),
+                'constellation_name': progress['constellation_name'],
+                'next_index': progress['next_index'],
+                'minimum_size': progress['minimum_size'],
+                'completed': int(progress['completed']),
+                'checker_name': checker_name,
+            } for progress in passes])
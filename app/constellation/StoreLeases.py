@@ -0,0 +1,385 @@
+import contextlib
+import math
+import random
+import re
+import threading
+import time
+import typing
+import uuid
+
+from app.constellation.StorePoint import StorePoint
+from app.db import get_cursor, transaction
+
+
+class StoreLeases:
+    """
+    Lease-based work claiming over cf_store_queue, replacing StorePoint.get_store.
+
+    The queue is seeded once with every unchecked store, its 1x1 degree cell and a
+    spread_rank: the store's position, in random order, among the stores of its cell.
+    Claiming orders by spread_rank and then by how often the cell has been checked, so
+    each batch takes one store from each of the least covered cells before any cell
+    gets a second. That keeps the spatial spread get_store aimed for, without
+    aggregating store_list on every call.
+
+    A claim is a conditional UPDATE tagged with a fresh lease token, so concurrent
+    workers never both win the same row. On MySQL the candidates are read with
+    SELECT ... FOR UPDATE SKIP LOCKED in the same transaction, so workers claiming at once
+    take different rows; elsewhere a worker that loses every candidate reads the next ones.
+    Leases expire after lease_seconds unless renewed, and expired rows become claimable
+    again. A background thread renews everything held every renew_interval seconds, so a
+    long-running store keeps its lease.
+
+    The SQL sticks to what MySQL and SQLite both accept; pass a sqlite3 connection
+    to run against a local stand-in, or take one from SQLiteRepository.get_leases, which
+    shares the repository's connection and lock so leases complete in its flush transaction.
+    """
+    CREATE_TABLES = [
+        """
+        CREATE TABLE IF NOT EXISTS cf_store_queue (
+            store_id BIGINT PRIMARY KEY,
+            latitude DOUBLE NOT NULL,
+            longitude DOUBLE NOT NULL,
+            cell_latitude INT NOT NULL,
+            cell_longitude INT NOT NULL,
+            spread_rank INT NOT NULL,
+            random_key DOUBLE NOT NULL,
+            worker_id VARCHAR(64) NULL,
+            lease_token VARCHAR(64) NULL,
+            lease_expires DOUBLE NULL,
+            when_processed DOUBLE NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS cf_cell_coverage (
+            cell_latitude INT NOT NULL,
+            cell_longitude INT NOT NULL,
+            checked_count INT NOT NULL,
+            PRIMARY KEY (cell_latitude, cell_longitude)
+        )
+        """,
+    ]
+    #   MySQL has no CREATE INDEX IF NOT EXISTS, so these only run when cf_store_queue is new.
+    CREATE_INDEXES = [
+        """
+        CREATE INDEX cf_store_queue_claim ON cf_store_queue (when_processed, spread_rank)
+        """,
+        """
+        CREATE INDEX cf_store_queue_lease ON cf_store_queue (lease_token)
+        """,
+    ]
+
+    def __init__(self,
+                 worker_id: str,
+                 batch_size: int = 16,
+                 lease_seconds: float = 3600,
+                 connection=None,
+                 clock: typing.Callable[[], float] = time.time,
+                 renew_interval: typing.Optional[float] = None,
+                 lock: typing.Optional[threading.RLock] = None
+    ):
+        self.worker_id: str = worker_id
+        self.batch_size: int = batch_size
+        self.lease_seconds: float = lease_seconds
+        #   Leases are renewed this often while held; a few times per lease_seconds by default.
+        self.renew_interval: float = renew_interval if renew_interval is not None else lease_seconds / 4
+        #   Claimed but not yet handed out by get_store.
+        self.pending: typing.List[StorePoint] = []
+        #   Ids of every store leased by this worker and not yet completed.
+        self.held: typing.Set = set()
+        #   A DB-API connection to use instead of the MySQL pool, e.g. sqlite3.
+        self.connection = connection
+        self.clock: typing.Callable[[], float] = clock
+        #   Guards `held` and `connection`, which the renewal thread and the result writer also use.
+        #   The connection owner's lock when it is shared, e.g. SQLiteRepository's.
+        self.lock: threading.RLock = lock or threading.RLock()
+        self.stopped: threading.Event = threading.Event()
+        self.renewer: typing.Optional[threading.Thread] = None
+
+    @staticmethod
+    def get_cell(value: float) -> int:
+        """MySQL ROUND(): halves round away from zero."""
+        return int(math.copysign(math.floor(abs(value) + 0.5), value))
+
+    def is_sqlite(self, connection) -> bool:
+        return type(connection).__module__.startswith('sqlite3')
+
+    @staticmethod
+    def run(cursor, statement: str, values, many: bool) -> typing.Tuple[typing.List[typing.Dict], int]:
+        if many:
+            cursor.executemany(statement, values)
+        else:
+            cursor.execute(statement, values or {})
+        rows = []
+        if cursor.description is not None:
+            columns = [x[0] for x in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return rows, cursor.rowcount
+
+    def execute(self, statement: str, values=None, many: bool = False) -> typing.Tuple[typing.List[typing.Dict], int]:
+        if self.connection is None:
+            with get_cursor() as cursor:
+                return self.run(cursor, statement, values, many)
+        if self.is_sqlite(self.connection):
+            statement = re.sub(r'%\((\w+)\)s', r':\1', statement)
+        with self.lock:
+            cursor = self.connection.cursor()
+            try:
+                result = self.run(cursor, statement, values, many)
+            finally:
+                cursor.close()
+            #   An autocommit connection commits each statement itself, or its owner's open
+            #   transaction commits them together; committing here would end that early.
+            if getattr(self.connection, 'isolation_level', '') is not None:
+                self.connection.commit()
+        return result
+
+    def has_table(self, table: str) -> bool:
+        try:
+            self.execute('SELECT 1 FROM %s WHERE 1 = 0' % table)
+        except Exception:
+            #   Each driver raises its own error for a missing table.
+            return False
+        return True
+
+    def create_tables(self):
+        """Creates whatever is missing, so running it again is harmless."""
+        is_new = not self.has_table('cf_store_queue')
+        for statement in self.CREATE_TABLES:
+            self.execute(statement)
+        if is_new:
+            for statement in self.CREATE_INDEXES:
+                self.execute(statement)
+
+    def seed(self, stores: typing.List[StorePoint], checked_store_ids: typing.Iterable):
+        """
+        Queue every store not yet checked and count the checked ones per cell. Stores and cells
+        already in the tables are left as they are, so seeding again only adds what is new.
+        """
+        checked_store_ids = {str(s) for s in checked_store_ids}
+        queued, _ = self.execute('SELECT store_id, cell_latitude, cell_longitude, spread_rank FROM cf_store_queue')
+        queued_ids = {str(row['store_id']) for row in queued}
+        #   New stores rank after the ones their cell already has queued.
+        next_ranks: typing.Dict[typing.Tuple[int, int], int] = {}
+        for row in queued:
+            cell = (row['cell_latitude'], row['cell_longitude'])
+            next_ranks[cell] = max(next_ranks.get(cell, 0), row['spread_rank'] + 1)
+        covered, _ = self.execute('SELECT cell_latitude, cell_longitude FROM cf_cell_coverage')
+        covered_cells = {(row['cell_latitude'], row['cell_longitude']) for row in covered}
+        cells: typing.Dict[typing.Tuple[int, int], typing.List[StorePoint]] = {}
+        coverage: typing.Dict[typing.Tuple[int, int], int] = {}
+        for store in stores:
+            cell = (self.get_cell(store.y), self.get_cell(store.x))
+            coverage.setdefault(cell, 0)
+            if store.get_store_id() in checked_store_ids:
+                coverage[cell] += 1
+            elif store.get_store_id() not in queued_ids:
+                cells.setdefault(cell, []).append(store)
+
+        queue = []
+        for (cell_latitude, cell_longitude), cell_stores in cells.items():
+            random.shuffle(cell_stores)
+            first_rank = next_ranks.get((cell_latitude, cell_longitude), 0)
+            for spread_rank, store in enumerate(cell_stores, first_rank):
+                queue.append({
+                    'store_id': store.store_id,
+                    'latitude': store.y,
+                    'longitude': store.x,
+                    'cell_latitude': cell_latitude,
+                    'cell_longitude': cell_longitude,
+                    'spread_rank': spread_rank,
+                    'random_key': random.random(),
+                })
+        self.execute(
+            """
+            INSERT INTO cf_store_queue (
+                store_id, latitude, longitude, cell_latitude, cell_longitude, spread_rank, random_key
+            ) VALUES (
+                %(store_id)s, %(latitude)s, %(longitude)s, %(cell_latitude)s, %(cell_longitude)s,
+                %(spread_rank)s, %(random_key)s
+            )
+            """, queue, many=True
+        )
+        self.execute(
+            """
+            INSERT INTO cf_cell_coverage (
+                cell_latitude, cell_longitude, checked_count
+            ) VALUES (
+                %(cell_latitude)s, %(cell_longitude)s, %(checked_count)s
+            )
+            """, [
+                {'cell_latitude': cell[0], 'cell_longitude': cell[1], 'checked_count': count}
+                for cell, count in coverage.items() if cell not in covered_cells
+            ], many=True
+        )
+
+    @staticmethod
+    def get_id_placeholders(store_ids: typing.Iterable) -> typing.Tuple[str, typing.Dict]:
+        values = {'store_id_%s' % i: store_id for i, store_id in enumerate(store_ids)}
+        return ', '.join('%%(%s)s' % key for key in values), values
+
+    def lease_candidates(self, batch_size: int, now: float, lease_token: str) -> typing.Tuple[int, int]:
+        """
+        Tags up to batch_size claimable stores with lease_token; returns (candidates read, leases won).
+        On MySQL the candidates stay locked until the UPDATE commits, and rows other claims have
+        locked are skipped rather than waited for.
+        """
+        locking = 'FOR UPDATE OF q SKIP LOCKED' if self.connection is None else ''
+        with transaction() if self.connection is None else contextlib.nullcontext():
+            candidates, _ = self.execute(
+                """
+                SELECT q.store_id
+                FROM cf_store_queue q
+                JOIN cf_cell_coverage c ON c.cell_latitude = q.cell_latitude AND c.cell_longitude = q.cell_longitude
+                WHERE q.when_processed IS NULL
+                AND (q.lease_expires IS NULL OR q.lease_expires < %(now)s)
+                ORDER BY q.spread_rank, c.checked_count, q.random_key
+                LIMIT %(limit)s
+                """ + locking, {'now': now, 'limit': batch_size}
+            )
+            if len(candidates) == 0:
+                return 0, 0
+            placeholders, values = self.get_id_placeholders(c['store_id'] for c in candidates)
+            values.update(
+                worker_id=self.worker_id, lease_token=lease_token, lease_expires=now + self.lease_seconds, now=now
+            )
+            _, won = self.execute(
+                """
+                UPDATE cf_store_queue
+                SET worker_id = %(worker_id)s, lease_token = %(lease_token)s, lease_expires = %(lease_expires)s
+                WHERE store_id IN (""" + placeholders + """)
+                AND when_processed IS NULL
+                AND (lease_expires IS NULL OR lease_expires < %(now)s)
+                """, values
+            )
+        return len(candidates), won
+
+    def claim(self, batch_size: int) -> typing.List[StorePoint]:
+        """
+        Lease up to batch_size stores to this worker; returns the stores actually won, and
+        nothing only when no store is left to claim.
+        """
+        while True:
+            lease_token = uuid.uuid4().hex
+            candidates, won = self.lease_candidates(batch_size, self.clock(), lease_token)
+            if candidates == 0:
+                return []
+            if won > 0:
+                break
+            #   Other workers won every candidate; they hold those leases now, so the next read skips them.
+        claimed, _ = self.execute(
+            """
+            SELECT store_id, latitude, longitude
+            FROM cf_store_queue
+            WHERE lease_token = %(lease_token)s
+            ORDER BY spread_rank, random_key
+            """, {'lease_token': lease_token}
+        )
+        stores = [StorePoint(**row) for row in claimed]
+        with self.lock:
+            self.held.update(s.store_id for s in stores)
+        self.start_renewer()
+        return stores
+
+    def start_renewer(self):
+        if self.renewer is None:
+            self.renewer = threading.Thread(target=self.renew_held, name='StoreLeases', daemon=True)
+            self.renewer.start()
+
+    def renew_held(self):
+        while not self.stopped.wait(self.renew_interval):
+            with self.lock:
+                held = list(self.held)
+            try:
+                self.renew(held)
+            except Exception:
+                #   Tried again on the next cycle; leases last several intervals.
+                pass
+
+    def renew(self, store_ids: typing.Iterable) -> int:
+        """Push the expiry of this worker's leases on store_ids out by lease_seconds."""
+        store_ids = list(store_ids)
+        if len(store_ids) == 0:
+            return 0
+        placeholders, values = self.get_id_placeholders(store_ids)
+        values.update(worker_id=self.worker_id, lease_expires=self.clock() + self.lease_seconds)
+        _, row_count = self.execute(
+            """
+            UPDATE cf_store_queue
+            SET lease_expires = %(lease_expires)s
+            WHERE store_id IN (""" + placeholders + """)
+            AND worker_id = %(worker_id)s AND when_processed IS NULL
+            """, values
+        )
+        return row_count
+
+    def release(self, store_ids: typing.Iterable) -> int:
+        """Hand this worker's unfinished leases on store_ids back to the queue."""
+        store_ids = list(store_ids)
+        if len(store_ids) == 0:
+            return 0
+        placeholders, values = self.get_id_placeholders(store_ids)
+        values.update(worker_id=self.worker_id)
+        _, row_count = self.execute(
+            """
+            UPDATE cf_store_queue
+            SET worker_id = NULL, lease_token = NULL, lease_expires = NULL
+            WHERE store_id IN (""" + placeholders + """)
+            AND worker_id = %(worker_id)s AND when_processed IS NULL
+            """, values
+        )
+        return row_count
+
+    def reclaim_expired(self) -> int:
+        """Clear every lease past its expiry; returns how many were reclaimed."""
+        _, row_count = self.execute(
+            """
+            UPDATE cf_store_queue
+            SET worker_id = NULL, lease_token = NULL, lease_expires = NULL
+            WHERE when_processed IS NULL AND lease_expires < %(now)s
+            """, {'now': self.clock()}
+        )
+        return row_count
+
+    def complete(self, store: StorePoint):
+        """Mark a leased store done and count it towards its cell's coverage."""
+        self.execute(
+            """
+            UPDATE cf_store_queue
+            SET when_processed = %(now)s, lease_expires = NULL
+            WHERE store_id = %(store_id)s
+            """, {'now': self.clock(), 'store_id': store.store_id}
+        )
+        self.execute(
+            """
+            UPDATE cf_cell_coverage
+            SET checked_count = checked_count + 1
+            WHERE cell_latitude = %(cell_latitude)s AND cell_longitude = %(cell_longitude)s
+            """, {'cell_latitude': self.get_cell(store.y), 'cell_longitude': self.get_cell(store.x)}
+        )
+        with self.lock:
+            self.held.discard(store.store_id)
+
+    def get_store(self) -> typing.Optional[StorePoint]:
+        """Drop-in for StorePoint.get_store: hands out leased stores, claiming a new batch when empty."""
+        if len(self.pending) == 0:
+            self.pending = self.claim(self.batch_size)
+        if len(self.pending) == 0:
+            return None
+        return self.pending.pop(0)
+
+    def set_as_processed(self, store: StorePoint):
+        store.set_as_processed()
+        self.complete(store)
+
+    def close(self):
+        """Stop renewing and give back everything still held, e.g. on shutdown."""
+        self.stopped.set()
+        if self.renewer is not None:
+            self.renewer.join()
+            self.renewer = None
+        with self.lock:
+            held = list(self.held)
+            self.held.clear()
+        self.release(held)
+        self.pending = []
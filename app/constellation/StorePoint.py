@@ -1,8 +1,39 @@
-from app.db import get_all_rows, get_row, insert
+from app.db import get_all_rows, get_row, insert, insert_many, update_many
 import os
+import typing
+
+import numpy as np
 
 
 class StorePoint:
+    INSERT_CHECKED = """
+        INSERT INTO cf_stores_checked (
+            store_id, checker_name
+        ) VALUES (
+            %(store_id)s, %(checker_name)s
+        )
+        """
+    DELETE_CHECKED = """
+        DELETE FROM cf_stores_checked
+        WHERE store_id = %(store_id)s
+        """
+    #   The stores the finder works over; shared by get_stores and get_store_list_signature.
+    STORE_FILTER = """
+        latitude IS NOT NULL AND longitude IS NOT NULL
+        AND company_name IN (
+            'McDonalds', 'Starbucks', 'Subway', 'Taco Bell', 'ChickFilA',
+            'Wendys', 'Burger King', 'Dunkin', 'Dominos', 'Panera',
+            'Pizza Hut', 'Chipotle', 'Sonic', 'KFC', 'Arbys',
+            'Little Caesars', 'Dairy Queen', 'Jack In The Box', 'Panda Express', 'Popeyes', 'Whataburger',
+            'Jimmy Johns', "Hardee's", 'Zaxbys', 'Papa Johns'
+        )
+        AND country_code = 'US'
+        AND TRIM(state_alpha) NOT IN ('AK', 'HI')
+        AND longitude < 0 AND latitude > 0
+        """
+
+    #   No per-instance __dict__; stores held in bulk belong in a StoreTable.
+    __slots__ = ('store_id', 'x', 'y')
 
     def __init__(self, **kwargs):
         self.store_id = kwargs.get('store_id')
@@ -10,7 +41,19 @@ class StorePoint:
         self.y = kwargs.get('latitude')
 
     def __getitem__(self, key):
-        return [self.x, self.y][key]
+        #   Hot in the distance and projection code, so no list is built for the common keys.
+        if key == 0:
+            return self.x
+        if key == 1:
+            return self.y
+        return (self.x, self.y)[key]
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        #   Unpacking and math.dist would otherwise probe __getitem__ until it raises.
+        return iter((self.x, self.y))
 
     def __str__(self):
         return f"Point {self.store_id} ({self.x}, {self.y})"
@@ -19,7 +62,11 @@ class StorePoint:
         return self.__str__()
 
     def __hash__(self):
-        return self.store_id
+        return hash(self.store_id)
+
+    @staticmethod
+    def from_values(store_id, longitude, latitude) -> 'StorePoint':
+        return StorePoint(store_id=store_id, longitude=longitude, latitude=latitude)
 
     def get_point(self):
         return [self.x, self.y]
@@ -27,45 +74,93 @@ class StorePoint:
     def get_store_id(self) -> str:
         return str(self.store_id)
 
+    def get_checked_record(self) -> typing.Dict:
+        return {
+            'store_id': self.get_store_id(),
+            'checker_name': os.getenv('PROCESSOR_NAME')
+        }
+
     def set_as_processed(self):
-        insert(
-            """
-            INSERT INTO cf_stores_checked (
-                store_id, checker_name
-            ) VALUES (
-                %(store_id)s, %(checker_name)s
-            )
-            """, {
-                'store_id': self.get_store_id(),
-                'checker_name': os.getenv('PROCESSOR_NAME')
-            }
-        )
+        insert(self.INSERT_CHECKED, self.get_checked_record())
 
     @staticmethod
-    def get_stores():
-        response = get_all_rows(
+    def set_many_as_processed(stores: typing.List['StorePoint']):
+        if len(stores) == 0:
+            return
+        insert_many(StorePoint.INSERT_CHECKED, [s.get_checked_record() for s in stores])
+
+    @staticmethod
+    def set_many_as_unprocessed(store_ids: typing.List):
+        """Take stores off cf_stores_checked, so they are claimed and searched again."""
+        if len(store_ids) == 0:
+            return
+        update_many(StorePoint.DELETE_CHECKED, [{'store_id': str(store_id)} for store_id in store_ids])
+
+    @staticmethod
+    def get_coordinate_array(store_list: typing.List['StorePoint']) -> np.ndarray:
+        table = getattr(store_list, 'table', None)
+        if table is not None:
+            #   Rows of a StoreTable: its (read-only) coordinates already are this array.
+            return table.coordinates
+        return np.array([[s.x, s.y] for s in store_list], dtype=float).reshape(-1, 2)
+
+    @staticmethod
+    def get_coordinate_values(
+            store_list: typing.List['StorePoint'],
+            coordinates: typing.Optional[np.ndarray] = None
+    ) -> typing.Tuple[typing.Sequence[float], typing.Sequence[float]]:
+        """
+        (longitudes, latitudes) by row as plain floats, for loops that sweep the list without making
+        a store object per row. `coordinates` is get_coordinate_array's result, if already at hand.
+        """
+        table = getattr(store_list, 'table', None)
+        if table is not None:
+            return table.longitude_values, table.latitude_values
+        if coordinates is None:
+            coordinates = StorePoint.get_coordinate_array(store_list)
+        return coordinates[:, 0].tolist(), coordinates[:, 1].tolist()
+
+    @staticmethod
+    def get_store_rows() -> typing.List[typing.Dict]:
+        return get_all_rows(
             """
             SELECT id AS store_id, latitude, longitude
             FROM store_list
-            WHERE 
-            latitude IS NOT NULL AND longitude IS NOT NULL
-            AND company_name IN (
-                'McDonalds', 'Starbucks', 'Subway', 'Taco Bell', 'ChickFilA',
-                'Wendys', 'Burger King', 'Dunkin', 'Dominos', 'Panera',
-                'Pizza Hut', 'Chipotle', 'Sonic', 'KFC', 'Arbys',
-                'Little Caesars', 'Dairy Queen', 'Jack In The Box', 'Panda Express', 'Popeyes', 'Whataburger',
-                'Jimmy Johns', "Hardee's", 'Zaxbys', 'Papa Johns'
-            )
-            AND country_code = 'US'
-            AND TRIM(state_alpha) NOT IN ('AK', 'HI')
-            AND longitude < 0 AND latitude > 0
+            WHERE """ + StorePoint.STORE_FILTER + """
             ORDER BY id
             """
         )
-        return [StorePoint(**x) for x in response]
 
     @staticmethod
-    def get_store():
+    def get_stores():
+        return [StorePoint(**x) for x in StorePoint.get_store_rows()]
+
+    @staticmethod
+    def get_store_list_signature() -> typing.Dict:
+        """Cheap fingerprint of the get_stores universe, for invalidating cached copies of it."""
+        return get_row(
+            """
+            SELECT COUNT(*) AS row_count, MAX(id) AS max_id
+            FROM store_list
+            WHERE """ + StorePoint.STORE_FILTER
+        )
+
+    @staticmethod
+    def get_checked_store_ids() -> typing.List:
+        return [x['store_id'] for x in get_all_rows('SELECT store_id FROM cf_stores_checked')]
+
+    @staticmethod
+    def get_exclusion(column: str, store_ids: typing.Collection) -> typing.Tuple[str, typing.Dict]:
+        """An `AND column NOT IN (...)` clause over store_ids and its values, or no clause for none."""
+        values = {'excluded_%d' % i: store_id for i, store_id in enumerate(sorted(store_ids))}
+        if len(values) == 0:
+            return '', values
+        return 'AND %s NOT IN (%s)' % (column, ', '.join('%%(%s)s' % name for name in values)), values
+
+    @staticmethod
+    def get_store(exclude_ids: typing.Collection = ()):
+        """Like claim_store; `exclude_ids` are stores this process is still working on or writing."""
+        exclusion, values = StorePoint.get_exclusion('store_list.id', exclude_ids)
         response = get_row(
             """
             SELECT store_list.id AS store_id, store_list.latitude, store_list.longitude FROM store_list
@@ -99,8 +194,11 @@ class StorePoint:
             )
             AND store_list.id NOT IN (SELECT store_id FROM cf_stores_checked)
             AND store_list.latitude IS NOT NULL AND store_list.longitude IS NOT NULL
+            %s
             ORDER BY RAND()
             LIMIT 1
-            """
+            """ % exclusion, values
         )
+        if response is None:
+            return None
         return StorePoint(**response)
\ No newline at end of file
@@ -0,0 +1,178 @@
+import json
+import os
+import shutil
+import tempfile
+import typing
+
+import numpy as np
+
+from app.constellation.ArrayKDTree import ArrayKDTree
+from app.constellation.SphericalIndex import SphericalIndex
+from app.constellation.StorePoint import StorePoint
+from app.constellation.StoreTable import StoreTable
+
+
+class StoreSnapshot:
+    """
+    On-disk snapshot of the get_stores universe: store ids, a (N, 2) longitude/latitude
+    array, the prebuilt ArrayKDTree over it and the SphericalIndex tree over the same
+    stores as unit vectors, main.py's default lookup. Rows are kept in
+    StoreTable.in_search_order, the order the finder sweeps them in.
+
+    Every array is a plain .npy file loaded with mmap_mode='r', so opening a snapshot
+    costs a few page faults rather than a 100k row query and a tree build, and every
+    process that opens it shares one physical copy through the page cache. Each tree
+    still needs its list mirrors to be queried; see ArrayKDTree.set_mirrors.
+
+    meta.json records the row count and max id of store_list at write time; the
+    snapshot is rebuilt when get_store_list_signature no longer matches. It also holds
+    each file's size and mtime, which load_all compares with the files on disk: a file
+    rewritten, truncated or swapped since makes the snapshot stale, without reading the
+    arrays. Snapshots are swapped in whole, so a reader never sees a partial one.
+    """
+    VERSION = 4
+    #   File name prefix of the SphericalIndex tree arrays.
+    SPHERICAL = 'spherical_'
+
+    def __init__(self, path: str):
+        self.path: str = path
+
+    def get_file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @staticmethod
+    def get_file_stats(directory: str, names: typing.Iterable[str]) -> typing.Dict[str, typing.List[int]]:
+        """name: [size, mtime in ns] of each array file."""
+        stats = {}
+        for name in names:
+            stat = os.stat(os.path.join(directory, name + '.npy'))
+            stats[name] = [stat.st_size, stat.st_mtime_ns]
+        return stats
+
+    def get_meta(self) -> typing.Optional[typing.Dict]:
+        try:
+            with open(self.get_file('meta.json')) as meta:
+                return json.load(meta)
+        except (OSError, ValueError):
+            return None
+
+    def is_current(self, signature: typing.Dict) -> bool:
+        meta = self.get_meta()
+        return (
+            meta is not None
+            and meta.get('version') == self.VERSION
+            and meta.get('row_count') == int(signature['row_count'] or 0)
+            and meta.get('max_id') == int(signature['max_id'] or 0)
+        )
+
+    def write(self, store_list: typing.List[StorePoint], tree: ArrayKDTree, signature: typing.Dict,
+              spherical_index: typing.Optional[SphericalIndex] = None):
+        """
+        Writes into a temporary directory next to `path` and swaps it in, so readers never see half a snapshot.
+        The SphericalIndex is built from store_list unless given.
+        """
+        spherical_tree = (spherical_index or SphericalIndex.from_store_points(store_list, tree.leaf_size)).tree
+        arrays = {
+            'ids': StoreTable.from_store_points(store_list).store_ids,
+            'coordinates': np.ascontiguousarray(tree.data, dtype=np.float64),
+            self.SPHERICAL + 'data': np.ascontiguousarray(spherical_tree.data, dtype=np.float64),
+        }
+        arrays.update({name: np.ascontiguousarray(getattr(tree, name)) for name in ArrayKDTree.ARRAYS})
+        arrays.update({
+            self.SPHERICAL + name: np.ascontiguousarray(getattr(spherical_tree, name)) for name in ArrayKDTree.ARRAYS
+        })
+        parent = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix='.snapshot-', dir=parent)
+        for name, array in arrays.items():
+            np.save(os.path.join(staging, name + '.npy'), array)
+        with open(os.path.join(staging, 'meta.json'), 'w') as meta:
+            json.dump({
+                'version': self.VERSION,
+                'row_count': int(signature['row_count'] or 0),
+                'max_id': int(signature['max_id'] or 0),
+                'leaf_size': tree.leaf_size,
+                'spherical_leaf_size': spherical_tree.leaf_size,
+                'files': self.get_file_stats(staging, arrays),
+            }, meta)
+        retired = staging + '-old'
+        try:
+            if os.path.isdir(self.path):
+                os.replace(self.path, retired)
+            os.replace(staging, self.path)
+        except OSError:
+            #   Another process swapped in its own copy first; keep that one.
+            pass
+        shutil.rmtree(staging, ignore_errors=True)
+        shutil.rmtree(retired, ignore_errors=True)
+
+    def load_all(self) -> typing.Tuple[np.ndarray, ArrayKDTree, SphericalIndex]:
+        """Returns the memory-mapped (ids, tree, spherical index); tree.data holds the coordinates."""
+        meta = self.get_meta()
+        names = ['ids', 'coordinates', self.SPHERICAL + 'data'] + ArrayKDTree.ARRAYS
+        names += [self.SPHERICAL + name for name in ArrayKDTree.ARRAYS]
+        if meta is None or self.get_file_stats(self.path, names) != meta.get('files'):
+            raise ValueError('Store snapshot at %s is corrupt' % self.path)
+        arrays = {name: np.load(self.get_file(name + '.npy'), mmap_mode='r') for name in names}
+        if not len(arrays['ids']) == len(arrays['coordinates']) == meta['row_count']:
+            raise ValueError('Store snapshot at %s is corrupt' % self.path)
+        tree = ArrayKDTree.from_arrays(arrays['coordinates'], arrays, leaf_size=meta['leaf_size'])
+        spherical_tree = ArrayKDTree.from_arrays(
+            arrays[self.SPHERICAL + 'data'],
+            {name: arrays[self.SPHERICAL + name] for name in ArrayKDTree.ARRAYS},
+            leaf_size=meta['spherical_leaf_size']
+        )
+        return arrays['ids'], tree, SphericalIndex.from_tree(spherical_tree)
+
+    def load(self) -> typing.Tuple[np.ndarray, ArrayKDTree]:
+        """Returns the memory-mapped (ids, tree); tree.data holds the coordinates."""
+        ids, tree, _ = self.load_all()
+        return ids, tree
+
+    def get_indexes(self, repository=None) -> typing.Tuple[typing.List[StorePoint], ArrayKDTree, SphericalIndex]:
+        """
+        The store_list main.py builds from get_stores, with its ArrayKDTree and SphericalIndex, served
+        from the snapshot when it is current and rebuilt (and rewritten) when it is not.
+        `repository` is the StoreRepository to read stores from, StorePoint's MySQL queries by default.
+        """
+        source = repository or StorePoint
+        signature = source.get_store_list_signature()
+        if self.is_current(signature):
+            try:
+                ids, tree, spherical_index = self.load_all()
+            except (OSError, ValueError):
+                pass
+            else:
+                #   Rows read straight from the memory-mapped arrays.
+                store_list = StoreTable(ids, tree.data).get_stores()
+                tree.items = store_list
+                spherical_index.tree.items = store_list
+                return store_list, tree, spherical_index
+        store_list = StoreTable.in_search_order(source.get_stores()).get_stores()
+        tree = ArrayKDTree.from_store_points(store_list)
+        spherical_index = SphericalIndex.from_store_points(store_list)
+        self.write(store_list, tree, signature, spherical_index)
+        return store_list, tree, spherical_index
+
+    def get_stores(self, repository=None) -> typing.Tuple[typing.List[StorePoint], ArrayKDTree]:
+        """get_indexes without the SphericalIndex."""
+        store_list, tree, _ = self.get_indexes(repository)
+        return store_list, tree
+
+    @staticmethod
+    def get_stores_and_indexes(repository=None) -> typing.Tuple[typing.List[StorePoint], ArrayKDTree, SphericalIndex]:
+        """Uses the snapshot at $STORE_SNAPSHOT when set, else queries store_list and builds both indexes."""
+        path = os.getenv('STORE_SNAPSHOT')
+        if path:
+            return StoreSnapshot(path).get_indexes(repository)
+        store_list = StoreTable.in_search_order((repository or StorePoint).get_stores()).get_stores()
+        return store_list, ArrayKDTree.from_store_points(store_list), SphericalIndex.from_store_points(store_list)
+
+    @staticmethod
+    def get_stores_and_index(repository=None) -> typing.Tuple[typing.List[StorePoint], ArrayKDTree]:
+        """Uses the snapshot at $STORE_SNAPSHOT when set, else queries store_list directly."""
+        path = os.getenv('STORE_SNAPSHOT')
+        if path:
+            return StoreSnapshot(path).get_stores(repository)
+        store_list = StoreTable.in_search_order((repository or StorePoint).get_stores()).get_stores()
+        return store_list, ArrayKDTree.from_store_points(store_list)
@@ -0,0 +1,119 @@
+import collections.abc
+import typing
+
+import numpy as np
+
+from app.constellation.StorePoint import StorePoint
+from app.constellation.StoreView import StoreView
+
+
+class StoreList(collections.abc.Sequence):
+    """
+    A StoreTable as a read-only sequence of StorePoints. Views are made as rows are read and
+    not kept, so the table stays the only copy of the data.
+    """
+
+    def __init__(self, table: 'StoreTable'):
+        self.table: StoreTable = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [StoreView(self.table, r) for r in range(*row.indices(len(self.table)))]
+        row = int(row)
+        if row < 0:
+            row += len(self.table)
+        if not 0 <= row < len(self.table):
+            raise IndexError('store row out of range')
+        return StoreView(self.table, row)
+
+
+class StoreTable:
+    """
+    The store list as a struct of arrays, addressed by row index.
+
+    store_ids is int64 when every id is a whole number and a fixed-width string array
+    otherwise; coordinates is an (N, 2) float64 array of [longitude, latitude], with
+    longitudes and latitudes as column views of it. Code that still wants store objects
+    gets StoreViews from get_stores; the rest can read the arrays directly.
+    The arrays may be memory-mapped and are treated as read-only.
+    """
+
+    def __init__(self, store_ids, coordinates):
+        self.store_ids: np.ndarray = self.get_id_array(store_ids)
+        self.coordinates: np.ndarray = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        self.longitudes: np.ndarray = self.coordinates[:, 0]
+        self.latitudes: np.ndarray = self.coordinates[:, 1]
+        #   What StoreViews read: indexing a memoryview gives a plain int or float without going through numpy.
+        self.id_values: typing.Sequence = (
+            memoryview(self.store_ids) if self.store_ids.dtype.kind in 'iu' else self.store_ids.tolist()
+        )
+        self.longitude_values: memoryview = memoryview(self.longitudes)
+        self.latitude_values: memoryview = memoryview(self.latitudes)
+        self.stores: typing.Optional[StoreList] = None
+        #   str(store_id): row, built on first use.
+        self.rows: typing.Optional[typing.Dict[str, int]] = None
+
+    @staticmethod
+    def get_id_array(store_ids) -> np.ndarray:
+        if isinstance(store_ids, np.ndarray) and store_ids.dtype.kind in 'iuU':
+            return store_ids
+        store_ids = list(store_ids)
+        try:
+            if all(int(store_id) == store_id for store_id in store_ids):
+                return np.array(store_ids, dtype=np.int64)
+        except (TypeError, ValueError):
+            pass
+        return np.array([str(store_id) for store_id in store_ids], dtype=np.str_)
+
+    @classmethod
+    def from_rows(cls, rows: typing.List[typing.Dict]) -> 'StoreTable':
+        """From {'store_id', 'longitude', 'latitude'} rows, e.g. a store_list query."""
+        return cls(
+            [row['store_id'] for row in rows],
+            [(row['longitude'], row['latitude']) for row in rows]
+        )
+
+    @classmethod
+    def from_store_points(cls, store_list: typing.List[StorePoint]) -> 'StoreTable':
+        table = getattr(store_list, 'table', None)
+        if table is not None:
+            return table
+        return cls([s.store_id for s in store_list], [(s.x, s.y) for s in store_list])
+
+    @classmethod
+    def in_search_order(cls, store_list: typing.List[StorePoint]) -> 'StoreTable':
+        """
+        The stores sorted by longitude, then id. The original KDTree(store_list, dim=2) sorted the
+        caller's list that way, in place, on its first split, so the finder has always swept
+        candidates, and the legacy scan paired stores, west to east. What a pass finds depends on
+        that order through its adaptive minimum size, so every list the finders sweep is built here.
+        """
+        table = cls.from_store_points(store_list)
+        order = np.lexsort((table.store_ids, table.longitudes))
+        if (order == np.arange(len(order))).all():
+            return table
+        return cls(table.store_ids[order], table.coordinates[order])
+
+    def __len__(self):
+        return len(self.store_ids)
+
+    def get_store(self, row: int) -> StorePoint:
+        return StoreView(self, row)
+
+    def get_stores(self) -> StoreList:
+        """The rows as StorePoints; StorePoint.get_coordinate_array and the indexes reach the table through it."""
+        if self.stores is None:
+            self.stores = StoreList(self)
+        return self.stores
+
+    def get_coordinates_by_id(self) -> typing.Dict[str, typing.Tuple[float, float]]:
+        """str(store_id): (longitude, latitude), straight from the arrays."""
+        return dict(zip(self.store_ids.astype(np.str_).tolist(), map(tuple, self.coordinates.tolist())))
+
+    def get_row(self, store_id) -> typing.Optional[int]:
+        if self.rows is None:
+            self.rows = {store_id: row for row, store_id in enumerate(self.store_ids.astype(np.str_).tolist())}
+        return self.rows.get(str(store_id))
@@ -0,0 +1,41 @@
+import typing
+
+from app.constellation.StorePoint import StorePoint
+
+
+class StoreView(StorePoint):
+    """
+    A StorePoint that is one row of a StoreTable, for code that still wants store objects.
+
+    It holds only the table and the row index; store_id, x and y are read from the table's
+    arrays on access, as plain Python values.
+    """
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row: int):
+        self.table = table
+        self.row: int = row
+
+    @property
+    def store_id(self) -> typing.Union[int, str]:
+        return self.table.id_values[self.row]
+
+    @property
+    def x(self) -> float:
+        return self.table.longitude_values[self.row]
+
+    @property
+    def y(self) -> float:
+        return self.table.latitude_values[self.row]
+
+    def __eq__(self, other):
+        if isinstance(other, StoreView):
+            return self.table is other.table and self.row == other.row
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.store_id)
+
+    def __reduce__(self):
+        #   Pickled on its own, e.g. to a worker process, a row travels as a plain StorePoint.
+        return StorePoint.from_values, (self.store_id, self.x, self.y)
@@ -1,6 +1,12 @@
+import contextlib
+import os
+import queue
+import threading
+import time
 import typing
+
 import pymysql
-import os
+import pymysql.cursors
 
 
 def get_sql_connection() -> pymysql.connections.Connection:
@@ -13,69 +19,202 @@ def get_sql_connection() -> pymysql.connections.Connection:
     return conn
 
 
+class ConnectionPool:
+    """
+    Per-process pool of persistent connections.
+
+    At most `size` connections are checked out at once; idle ones are kept for reuse.
+    A connection idle for longer than `ping_interval` seconds is pinged (and reconnected
+    if needed) before it is handed out, and one that failed mid-statement is dropped.
+    The pool notices when it has been inherited across a fork and starts afresh, so
+    child processes never share the parent's sockets.
+
+    `size` must be at least MINIMUM_SIZE: main.py's result writer holds a connection for
+    each flush transaction, and claiming stores or renewing leases must not wait on it.
+    """
+    MINIMUM_SIZE = 2
+    #   Errors that mean the connection itself is unusable.
+    CONNECTION_ERRORS = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
+    def __init__(self, size: int, ping_interval: float = 30):
+        if size < self.MINIMUM_SIZE:
+            raise ValueError('DB_POOL_SIZE must be at least %d, not %d' % (self.MINIMUM_SIZE, size))
+        self.size: int = size
+        self.ping_interval: float = ping_interval
+        self.reset()
+
+    def reset(self):
+        self.pid: int = os.getpid()
+        self.idle: queue.LifoQueue = queue.LifoQueue()
+        self.slots: threading.BoundedSemaphore = threading.BoundedSemaphore(self.size)
+
+    def acquire(self) -> pymysql.connections.Connection:
+        if self.pid != os.getpid():
+            self.reset()
+        self.slots.acquire()
+        try:
+            try:
+                connection, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                return get_sql_connection()
+            try:
+                if time.monotonic() - last_used > self.ping_interval:
+                    connection.ping(reconnect=True)
+            except self.CONNECTION_ERRORS:
+                connection = get_sql_connection()
+            return connection
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, connection: pymysql.connections.Connection, healthy: bool = True):
+        if self.pid != os.getpid():
+            return
+        if healthy:
+            self.idle.put((connection, time.monotonic()))
+        else:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+pool = ConnectionPool(int(os.environ.get('DB_POOL_SIZE', 4)))
+#   The connection of the transaction open on this thread, if any.
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def transaction() -> typing.Iterator[pymysql.cursors.Cursor]:
+    """
+    Run several statements on one connection and commit them together.
+    The helpers below join the open transaction when called inside the block.
+    """
+    if getattr(_local, 'connection', None) is not None:
+        #   Nested: fold into the outer transaction.
+        with get_cursor() as cursor:
+            yield cursor
+        return
+    connection = pool.acquire()
+    _local.connection = connection
+    healthy = True
+    try:
+        cursor = connection.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+        connection.commit()
+    except BaseException as e:
+        healthy = not isinstance(e, ConnectionPool.CONNECTION_ERRORS)
+        if healthy:
+            connection.rollback()
+        raise
+    finally:
+        _local.connection = None
+        pool.release(connection, healthy)
+
+
+@contextlib.contextmanager
+def get_cursor() -> typing.Iterator[pymysql.cursors.Cursor]:
+    """A cursor on the open transaction, or on a pooled connection committed when the block ends."""
+    connection = getattr(_local, 'connection', None)
+    if connection is not None:
+        cursor = connection.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+        return
+    connection = pool.acquire()
+    healthy = True
+    try:
+        cursor = connection.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+        #   Reads commit too, so the next statement on this connection gets a fresh snapshot.
+        connection.commit()
+    except BaseException as e:
+        healthy = not isinstance(e, ConnectionPool.CONNECTION_ERRORS)
+        if healthy:
+            connection.rollback()
+        raise
+    finally:
+        pool.release(connection, healthy)
+
+
 def get_row(statement, values=None) -> typing.Optional[typing.Dict]:
-    connection = get_sql_connection()
-    cursor = connection.cursor()
-    cursor.execute(statement, values)
-    result = cursor.fetchone()
-    columns = [x[0] for x in cursor.description]
-    cursor.close()
-    connection.close()
+    with get_cursor() as cursor:
+        cursor.execute(statement, values)
+        result = cursor.fetchone()
+        columns = [x[0] for x in cursor.description]
     if result is None:
         return None
     return dict(zip(columns, result))
 
 
 def get_all_rows(statement, values=None) -> typing.List[typing.Dict]:
-    connection = get_sql_connection()
-    cursor = connection.cursor()
-    cursor.execute(statement, values)
-    results = cursor.fetchall()
-    columns = [x[0] for x in cursor.description]
-    cursor.close()
-    connection.close()
+    with get_cursor() as cursor:
+        cursor.execute(statement, values)
+        results = cursor.fetchall()
+        columns = [x[0] for x in cursor.description]
     return [dict(zip(columns, row)) for row in results]
 
 
+def iterate_rows(statement, values=None, batch_size: int = 10000) -> typing.Iterator[typing.List[typing.Dict]]:
+    """
+    The rows of a large result in keyset pages. `statement` selects the rows with id above
+    %(last_id)s, ordered by id, at most %(limit)s of them. Each page is a short query of its own,
+    so no connection is held between batches and the caller can run other statements in between,
+    e.g. update the rows it has just read.
+    """
+    values = dict(values or {})
+    last_id = -1
+    while True:
+        rows = get_all_rows(statement, dict(values, last_id=last_id, limit=batch_size))
+        if len(rows) == 0:
+            return
+        yield rows
+        last_id = rows[-1]['id']
+
+
 def insert(statement, values):
-    connection = get_sql_connection()
-    cursor = connection.cursor()
-    cursor.execute(statement, values)
-    row_id = cursor.lastrowid
-    cursor.close()
-    connection.commit()
-    connection.close()
+    with get_cursor() as cursor:
+        cursor.execute(statement, values)
+        row_id = cursor.lastrowid
     return row_id
 
 
 def insert_many(statement, values):
-    connection = get_sql_connection()
-    cursor = connection.cursor()
-    cursor.executemany(statement, values)
-    row_id = cursor.lastrowid
-    cursor.close()
-    connection.commit()
-    connection.close()
+    with get_cursor() as cursor:
+        cursor.executemany(statement, values)
+        row_id = cursor.lastrowid
     return row_id
 
 
 def update(statement, value):
-    connection = get_sql_connection()
-    cursor = connection.cursor()
-    cursor.execute(statement, value)
-    rows_affected = cursor.rowcount
-    cursor.close()
-    connection.commit()
-    connection.close()
+    with get_cursor() as cursor:
+        cursor.execute(statement, value)
+        rows_affected = cursor.rowcount
     return rows_affected
 
 
 def update_many(statement, values):
-    connection = get_sql_connection()
-    cursor = connection.cursor()
-    cursor.executemany(statement, values)
-    rows_affected = cursor.rowcount
-    cursor.close()
-    connection.commit()
-    connection.close()
-    return rows_affected
\ No newline at end of file
+    with get_cursor() as cursor:
+        cursor.executemany(statement, values)
+        rows_affected = cursor.rowcount
+    return rows_affected
@@ -0,0 +1,127 @@
+import bisect
+import collections
+import http.server
+import os
+import tempfile
+import threading
+import typing
+
+
+class Metrics:
+    """
+    Process-local counters and histograms for the finder.
+
+    Hot paths bump `counters[name]` directly; histograms go through observe(). take()
+    returns what has accumulated since the last take and clears it, so forked workers can
+    ship their deltas back to the parent, which merge()s them and exposes the totals in
+    Prometheus text format, as a file and/or over HTTP.
+    """
+    PREFIX = 'constellation_'
+    #   name: (help, histogram buckets or None for a counter)
+    DEFINITIONS = {
+        'stores_processed': ('Anchor stores finished.', None),
+        'pairs_evaluated': ('Anchor/candidate pairs projected for a constellation.', None),
+        'boundary_rejects': ('Projections outside BOUNDARIES.', None),
+        'size_rejects': ('Projections no larger than the current minimum size.', None),
+        'mask_rejects': ('Vectorized candidates dropped by the boundary/size mask.', None),
+        'occupancy_rejects': ('Vectorized candidates dropped by the occupancy filter.', None),
+        'constellations_found': ('Constellations found.', None),
+        'duplicate_results': ('Found constellations dropped as already written.', None),
+        'suppressed_results': ('Found constellations dropped by spatial suppression.', None),
+        'kd_node_visits': ('KD-tree nodes visited by nearest store lookups.', None),
+        'matcher_depth': ('Template points looked up before the matcher stopped.', [1, 2, 3, 4, 5, 6, 8, 10, 12, 16]),
+        'store_seconds': ('Wall time per anchor store.', [1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]),
+        'db_write_seconds': ('Latency of one result flush.', [0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]),
+    }
+
+    def __init__(self):
+        self.lock: threading.Lock = threading.Lock()
+        self.counters: typing.Counter[str] = collections.Counter()
+        #   name: [per-bucket counts (last one is +Inf), sum]
+        self.histograms: typing.Dict[str, typing.List] = {}
+        self.totals: typing.Dict = {'counters': collections.Counter(), 'histograms': {}}
+
+    def observe(self, name: str, value: float):
+        buckets = self.DEFINITIONS[name][1]
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * (len(buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+
+    def take(self) -> typing.Dict:
+        """
+        Everything recorded since the last take, as plain data that pickles across processes.
+        Counters are only bumped from the thread that calls take; histograms may be observed from any.
+        """
+        with self.lock:
+            taken = {'counters': dict(self.counters), 'histograms': self.histograms}
+            self.counters = collections.Counter()
+            self.histograms = {}
+        return taken
+
+    def merge(self, taken: typing.Dict):
+        with self.lock:
+            self.totals['counters'].update(taken['counters'])
+            for name, (counts, total) in taken['histograms'].items():
+                histogram = self.totals['histograms'].get(name)
+                if histogram is None:
+                    histogram = self.totals['histograms'][name] = [[0] * len(counts), 0.0]
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+
+    def get_text(self) -> str:
+        """The merged totals in Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, (description, buckets) in self.DEFINITIONS.items():
+                metric = self.PREFIX + name
+                lines.append('# HELP %s %s' % (metric, description))
+                if buckets is None:
+                    lines.append('# TYPE %s counter' % metric)
+                    lines.append('%s_total %s' % (metric, self.totals['counters'].get(name, 0)))
+                    continue
+                lines.append('# TYPE %s histogram' % metric)
+                counts, total = self.totals['histograms'].get(name, [[0] * (len(buckets) + 1), 0.0])
+                cumulative = 0
+                for bound, count in zip(buckets + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append('%s_bucket{le="%s"} %s' % (metric, bound, cumulative))
+                lines.append('%s_sum %s' % (metric, total))
+                lines.append('%s_count %s' % (metric, cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        """Atomically replace `path`, e.g. for node_exporter's textfile collector."""
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, staging = tempfile.mkstemp(prefix='.metrics-', dir=directory)
+        with os.fdopen(handle, 'w') as output:
+            output.write(self.get_text())
+        os.replace(staging, path)
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> http.server.ThreadingHTTPServer:
+        """Serve the totals at http://host:port/metrics from a daemon thread."""
+        source = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = source.get_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='Metrics', daemon=True).start()
+        return server
+
+
+metrics = Metrics()
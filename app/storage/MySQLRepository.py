@@ -0,0 +1,85 @@
+import typing
+
+from app.constellation.ConstellationFinder import ConstellationFinder
+from app.constellation.StorePoint import StorePoint
+from app.constellation.StoreTable import StoreTable
+from app.db import get_all_rows, iterate_rows, pool, transaction, update_many
+from app.storage.StoreRepository import StoreRepository
+
+
+class MySQLRepository(StoreRepository):
+    """The production store_list database, through the app.db connection pool."""
+
+    def transaction(self) -> typing.ContextManager:
+        return transaction()
+
+    def get_stores(self) -> typing.List[StorePoint]:
+        return StoreTable.from_rows(StorePoint.get_store_rows()).get_stores()
+
+    def get_store_list_signature(self) -> typing.Dict:
+        return StorePoint.get_store_list_signature()
+
+    def get_checked_store_ids(self) -> typing.List:
+        return StorePoint.get_checked_store_ids()
+
+    def claim_store(self, exclude_ids: typing.Collection = ()) -> typing.Optional[StorePoint]:
+        return StorePoint.get_store(exclude_ids)
+
+    def set_many_as_processed(self, stores: typing.List[StorePoint]):
+        StorePoint.set_many_as_processed(stores)
+
+    def set_many_as_unprocessed(self, store_ids: typing.List):
+        StorePoint.set_many_as_unprocessed(store_ids)
+
+    def write_results(self, records: typing.List[typing.Dict]):
+        ConstellationFinder.write_constellations(records)
+
+    def iterate_unsized_constellations(self, batch_size: int) -> typing.Iterator[typing.List[typing.Dict]]:
+        return iterate_rows(
+            """
+            SELECT id, constellation_string
+            FROM cf_raw_constellations
+            WHERE size IS NULL AND id > %(last_id)s
+            ORDER BY id
+            LIMIT %(limit)s
+            """, batch_size=batch_size
+        )
+
+    def iterate_constellations(self, batch_size: int) -> typing.Iterator[typing.List[typing.Dict]]:
+        return iterate_rows(
+            """
+            SELECT id, constellation_name, constellation_string
+            FROM cf_raw_constellations
+            WHERE id > %(last_id)s
+            ORDER BY id
+            LIMIT %(limit)s
+            """, batch_size=batch_size
+        )
+
+    def delete_constellations(self, ids: typing.List):
+        if len(ids) == 0:
+            return
+        update_many(ConstellationFinder.DELETE_CONSTELLATION, [{'id': i} for i in ids])
+
+    def get_store_coordinates(self) -> typing.Dict[str, typing.List[float]]:
+        stores = get_all_rows(
+            """
+            SELECT id, latitude, longitude FROM store_list
+            """
+        )
+        return {str(s['id']): [s['longitude'], s['latitude']] for s in stores}
+
+    def set_sizes(self, sizes: typing.List[typing.Dict]):
+        if len(sizes) == 0:
+            return
+        update_many(
+            """
+            UPDATE cf_raw_constellations
+            SET size = %(size)s
+            WHERE id = %(id)s
+            """,
+            sizes
+        )
+
+    def close(self):
+        pool.close()
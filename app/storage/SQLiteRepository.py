@@ -0,0 +1,274 @@
+import contextlib
+import os
+import re
+import sqlite3
+import threading
+import typing
+
+from app.constellation.ConstellationFinder import ConstellationFinder
+from app.constellation.StoreLeases import StoreLeases
+from app.constellation.StorePoint import StorePoint
+from app.constellation.StoreTable import StoreTable
+from app.storage.StoreRepository import StoreRepository
+
+
+class SQLiteRepository(StoreRepository):
+    """
+    The finder's tables in a local SQLite file, for offline runs without MySQL.
+
+    store_list only holds the finder's universe (what StorePoint.get_stores returns),
+    loaded in bulk by load_stores or copied from another repository by import_stores.
+    The database runs in WAL mode, so the result writer and readers don't block each other.
+    One connection per process is shared by its threads under a lock; after a fork the
+    child opens its own.
+    """
+    CREATE_TABLES = [
+        """
+        CREATE TABLE IF NOT EXISTS store_list (
+            id INTEGER PRIMARY KEY,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            cell_latitude INTEGER NOT NULL,
+            cell_longitude INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS cf_stores_checked (
+            store_id INTEGER PRIMARY KEY,
+            checker_name TEXT NULL,
+            when_created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS cf_raw_constellations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            constellation_name TEXT NOT NULL,
+            constellation_string TEXT NOT NULL,
+            size REAL NULL,
+            when_created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS store_list_cell ON store_list (cell_latitude, cell_longitude)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS cf_raw_constellations_unsized ON cf_raw_constellations (size, when_created)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS cf_raw_constellations_pending ON cf_raw_constellations (size, id)
+        """,
+    ]
+    INSERT_STORE = """
+        INSERT OR REPLACE INTO store_list (
+            id, latitude, longitude, cell_latitude, cell_longitude
+        ) VALUES (
+            %(store_id)s, %(latitude)s, %(longitude)s, %(cell_latitude)s, %(cell_longitude)s
+        )
+        """
+    #   cf_stores_checked is keyed by store, so marking a store twice is harmless.
+    INSERT_CHECKED = StorePoint.INSERT_CHECKED.replace('INSERT INTO', 'INSERT OR IGNORE INTO')
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self.lock: threading.RLock = threading.RLock()
+        self.connection: typing.Optional[sqlite3.Connection] = None
+        self.pid: typing.Optional[int] = None
+        #   Transaction depth on the connection; nested blocks fold into the outer one.
+        self.depth: int = 0
+        self.create_tables()
+
+    def get_connection(self) -> sqlite3.Connection:
+        if self.connection is None or self.pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            #   Autocommit; transaction() issues BEGIN/COMMIT itself.
+            self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.pid = os.getpid()
+            self.depth = 0
+        return self.connection
+
+    @staticmethod
+    def get_statement(statement: str) -> str:
+        """MySQL %(name)s placeholders to SQLite :name."""
+        return re.sub(r'%\((\w+)\)s', r':\1', statement)
+
+    @contextlib.contextmanager
+    def transaction(self) -> typing.Iterator[sqlite3.Connection]:
+        with self.lock:
+            connection = self.get_connection()
+            if self.depth > 0:
+                self.depth += 1
+                try:
+                    yield connection
+                finally:
+                    self.depth -= 1
+                return
+            connection.execute('BEGIN IMMEDIATE')
+            self.depth = 1
+            try:
+                yield connection
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            finally:
+                self.depth = 0
+
+    def get_leases(self, worker_id: str, **kwargs) -> StoreLeases:
+        #   Leases completed by ResultSink then commit with the results they belong to.
+        return StoreLeases(worker_id, connection=self.get_connection(), lock=self.lock, **kwargs)
+
+    def execute(self, statement: str, values=None, many: bool = False) -> typing.List[typing.Dict]:
+        with self.transaction() as connection:
+            statement = self.get_statement(statement)
+            if many:
+                cursor = connection.executemany(statement, values)
+            else:
+                cursor = connection.execute(statement, values or {})
+            if cursor.description is None:
+                return []
+            columns = [x[0] for x in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def create_tables(self):
+        with self.transaction() as connection:
+            for statement in self.CREATE_TABLES:
+                connection.execute(statement)
+
+    def load_stores(self, stores: typing.List[StorePoint]):
+        """Replace store_list with `stores` in one bulk transaction."""
+        rows = [{
+            'store_id': s.store_id,
+            'latitude': s.y,
+            'longitude': s.x,
+            'cell_latitude': StoreLeases.get_cell(s.y),
+            'cell_longitude': StoreLeases.get_cell(s.x),
+        } for s in stores]
+        with self.transaction():
+            self.execute('DELETE FROM store_list')
+            self.execute(self.INSERT_STORE, rows, many=True)
+
+    def import_stores(self, source: StoreRepository):
+        """Copy the store universe and the checked stores from another repository, e.g. MySQL."""
+        stores = source.get_stores()
+        checked_store_ids = set(str(s) for s in source.get_checked_store_ids())
+        with self.transaction():
+            self.load_stores(stores)
+            self.set_many_as_processed([s for s in stores if s.get_store_id() in checked_store_ids])
+
+    def get_stores(self) -> typing.List[StorePoint]:
+        rows = self.execute(
+            """
+            SELECT id AS store_id, latitude, longitude
+            FROM store_list
+            ORDER BY id
+            """
+        )
+        return StoreTable.from_rows(rows).get_stores()
+
+    def get_store_list_signature(self) -> typing.Dict:
+        return self.execute('SELECT COUNT(*) AS row_count, MAX(id) AS max_id FROM store_list')[0]
+
+    def get_checked_store_ids(self) -> typing.List:
+        return [row['store_id'] for row in self.execute('SELECT store_id FROM cf_stores_checked')]
+
+    def claim_store(self, exclude_ids: typing.Collection = ()) -> typing.Optional[StorePoint]:
+        exclusion, values = StorePoint.get_exclusion('s.id', exclude_ids)
+        rows = self.execute(
+            """
+            SELECT s.id AS store_id, s.latitude, s.longitude
+            FROM store_list s
+            LEFT JOIN (
+                SELECT l.cell_latitude, l.cell_longitude, COUNT(*) AS checked_count
+                FROM cf_stores_checked c
+                JOIN store_list l ON l.id = c.store_id
+                GROUP BY l.cell_latitude, l.cell_longitude
+            ) AS coverage
+            ON coverage.cell_latitude = s.cell_latitude AND coverage.cell_longitude = s.cell_longitude
+            WHERE s.id NOT IN (SELECT store_id FROM cf_stores_checked)
+            %s
+            ORDER BY COALESCE(coverage.checked_count, 0), RANDOM()
+            LIMIT 1
+            """ % exclusion, values
+        )
+        if len(rows) == 0:
+            return None
+        return StorePoint(**rows[0])
+
+    def set_many_as_processed(self, stores: typing.List[StorePoint]):
+        if len(stores) == 0:
+            return
+        self.execute(self.INSERT_CHECKED, [s.get_checked_record() for s in stores], many=True)
+
+    def set_many_as_unprocessed(self, store_ids: typing.List):
+        if len(store_ids) == 0:
+            return
+        self.execute(StorePoint.DELETE_CHECKED, [{'store_id': str(store_id)} for store_id in store_ids], many=True)
+
+    def write_results(self, records: typing.List[typing.Dict]):
+        if len(records) == 0:
+            return
+        self.execute(ConstellationFinder.INSERT_CONSTELLATION, records, many=True)
+
+    def iterate_unsized_constellations(self, batch_size: int) -> typing.Iterator[typing.List[typing.Dict]]:
+        #   Keyset pages rather than an open cursor, so the caller can update the rows in between.
+        last_id = -1
+        while True:
+            rows = self.execute(
+                """
+                SELECT id, constellation_string
+                FROM cf_raw_constellations
+                WHERE size IS NULL AND id > %(last_id)s
+                ORDER BY id
+                LIMIT %(limit)s
+                """, {'last_id': last_id, 'limit': batch_size}
+            )
+            if len(rows) == 0:
+                return
+            yield rows
+            last_id = rows[-1]['id']
+
+    def iterate_constellations(self, batch_size: int) -> typing.Iterator[typing.List[typing.Dict]]:
+        last_id = -1
+        while True:
+            rows = self.execute(
+                """
+                SELECT id, constellation_name, constellation_string
+                FROM cf_raw_constellations
+                WHERE id > %(last_id)s
+                ORDER BY id
+                LIMIT %(limit)s
+                """, {'last_id': last_id, 'limit': batch_size}
+            )
+            if len(rows) == 0:
+                return
+            yield rows
+            last_id = rows[-1]['id']
+
+    def delete_constellations(self, ids: typing.List):
+        if len(ids) == 0:
+            return
+        self.execute(ConstellationFinder.DELETE_CONSTELLATION, [{'id': i} for i in ids], many=True)
+
+    def get_store_coordinates(self) -> typing.Dict[str, typing.List[float]]:
+        rows = self.execute('SELECT id, latitude, longitude FROM store_list')
+        return {str(row['id']): [row['longitude'], row['latitude']] for row in rows}
+
+    def set_sizes(self, sizes: typing.List[typing.Dict]):
+        if len(sizes) == 0:
+            return
+        self.execute(
+            """
+            UPDATE cf_raw_constellations
+            SET size = %(size)s
+            WHERE id = %(id)s
+            """, sizes, many=True
+        )
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None and self.pid == os.getpid():
+                self.connection.close()
+            self.connection = None
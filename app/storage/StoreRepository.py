@@ -0,0 +1,100 @@
+import abc
+import contextlib
+import typing
+
+from app.constellation.StoreLeases import StoreLeases
+from app.constellation.StorePoint import StorePoint
+
+
+class StoreRepository(abc.ABC):
+    """
+    The data access the finder needs, independent of the database behind it. An abstract base:
+    a backend missing any of it fails when constructed, not partway through a run.
+
+    MySQLRepository runs the existing queries over app.db; SQLiteRepository keeps the same
+    tables in a local file for offline batches. Everything inside a transaction() block
+    commits together.
+    """
+
+    @staticmethod
+    def from_url(url: str) -> 'StoreRepository':
+        """'mysql' for the app.db connection settings, 'sqlite:<path>' for a local database file."""
+        if url == 'mysql':
+            from app.storage.MySQLRepository import MySQLRepository
+            return MySQLRepository()
+        if url.startswith('sqlite:'):
+            from app.storage.SQLiteRepository import SQLiteRepository
+            return SQLiteRepository(url[len('sqlite:'):])
+        raise ValueError('Unknown storage %r; expected mysql or sqlite:<path>' % url)
+
+    def transaction(self) -> typing.ContextManager:
+        return contextlib.nullcontext()
+
+    def get_leases(self, worker_id: str, **kwargs) -> StoreLeases:
+        """StoreLeases over this database's cf_store_queue; `kwargs` as StoreLeases takes them."""
+        return StoreLeases(worker_id, **kwargs)
+
+    #   Stores
+    @abc.abstractmethod
+    def get_stores(self) -> typing.List[StorePoint]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_store_list_signature(self) -> typing.Dict:
+        raise NotImplementedError
+
+    #   Work
+    @abc.abstractmethod
+    def get_checked_store_ids(self) -> typing.List:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def claim_store(self, exclude_ids: typing.Collection = ()) -> typing.Optional[StorePoint]:
+        """
+        An unchecked store not in `exclude_ids`, preferring the least checked parts of the map;
+        None when all are done.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_many_as_processed(self, stores: typing.List[StorePoint]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_many_as_unprocessed(self, store_ids: typing.List):
+        """Take stores off cf_stores_checked, so they are claimed and searched again."""
+        raise NotImplementedError
+
+    #   Results
+    @abc.abstractmethod
+    def write_results(self, records: typing.List[typing.Dict]):
+        """Rows shaped like ConstellationFinder.get_constellation_record."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def iterate_unsized_constellations(self, batch_size: int) -> typing.Iterator[typing.List[typing.Dict]]:
+        """Every {'id', 'constellation_string'} row of cf_raw_constellations with no size, in batches."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def iterate_constellations(self, batch_size: int) -> typing.Iterator[typing.List[typing.Dict]]:
+        """Every {'id', 'constellation_name', 'constellation_string'} row of cf_raw_constellations, in batches."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_constellations(self, ids: typing.List):
+        """Deletes cf_raw_constellations rows by id."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_store_coordinates(self) -> typing.Dict[str, typing.List[float]]:
+        """[longitude, latitude] of every store, by string id, for resolving constellation_string."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_sizes(self, sizes: typing.List[typing.Dict]):
+        """Sets cf_raw_constellations.size from {'id', 'size'} rows."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
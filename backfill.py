@@ -0,0 +1,26 @@
+import argparse
+import os
+
+from app.ConstellationPuller import set_size_of_points
+from app.storage.StoreRepository import StoreRepository
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Fill in the size of every found constellation that has none.')
+    parser.add_argument('--storage', default=os.getenv('STORAGE', 'mysql'), help='mysql, or sqlite:<path> for a local database.')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Rows read, sized and updated at a time.')
+    parser.add_argument('--report-interval', type=float, default=10, help='Seconds between progress lines.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+    repository = StoreRepository.from_url(args.storage)
+    try:
+        set_size_of_points(repository, args.batch_size, args.report_interval)
+    finally:
+        repository.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import json
+import sys
+
+from app.benchmark.Benchmark import Benchmark
+from app.benchmark.Engines import Engines
+from app.benchmark.EquivalenceHarness import EquivalenceHarness
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the constellation pipeline on synthetic stores.')
+    parser.add_argument('--stores', type=int, default=20000, help='Number of synthetic stores.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the store generator and sampling.')
+    parser.add_argument('--anchors', type=int, default=1, help='Anchor stores per engine run.')
+    parser.add_argument('--operations', type=int, default=1000, help='Queries/candidates per micro benchmark.')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed repetitions of each benchmark.')
+    parser.add_argument('--engines', default=','.join(Engines.ENGINES), help='Comma separated engines to run.')
+    parser.add_argument('--no-micro', action='store_true', help='Only run the ConstellationsFinder.run benchmarks.')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout.')
+    parser.add_argument('--baseline', help='Compare against this JSON report and fail on regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against the baseline, as a fraction.')
+    parser.add_argument('--equivalence', action='store_true', help='Check every engine finds what its reference finds, ultimately the shipped baseline search, report what each semantic option changes, then exit.')
+    args = parser.parse_args()
+    args.engines = [engine for engine in args.engines.split(',') if engine]
+    unknown = [engine for engine in args.engines if engine not in Engines.ENGINES]
+    if unknown:
+        parser.error('unknown engines: %s' % ', '.join(unknown))
+    return args
+
+
+def main() -> int:
+    args = get_arguments()
+    benchmark = Benchmark(args.stores, args.seed, args.anchors, args.operations, args.repeat)
+    if args.equivalence:
+        #   intended_differences are what the semantic options are for, so only mismatches fail.
+        equivalence = EquivalenceHarness(benchmark.engines, benchmark.anchors).run(args.engines)
+        print(json.dumps(equivalence, indent=2))
+        return 1 if equivalence['mismatches'] else 0
+
+    report = benchmark.run(args.engines, micro=not args.no_micro)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            report['regressions'] = Benchmark.check_regressions(report, json.load(baseline), args.tolerance)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 1 if report.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+import argparse
+import os
+
+from app.consellation.consellation_finder import ConsellationFinder
+from app.consellation.shards import ShardCheckpoint, parse_shard
+from app.constellation.Constellation import Constellation
+from app.constellation.StoreSnapshot import StoreSnapshot
+from app.storage.StoreRepository import StoreRepository
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Exhaustive all-pairs constellation scan, split into resumable shards.')
+    parser.add_argument('--storage', default=os.getenv('STORAGE', 'mysql'), help='mysql, or sqlite:<path> for a local database.')
+    parser.add_argument('--shard', default='1/1', help='Scan the k-th of M equal-work slices of the store pairs, as k/M.')
+    parser.add_argument('--constellations', help='Comma separated constellation names; all by default.')
+    parser.add_argument('--output', help='Where found constellations go; points-k-of-M.txt by default.')
+    parser.add_argument('--checkpoint', help='Progress file; <output>.checkpoint.json by default.')
+    parser.add_argument('--checkpoint-interval', type=float, default=60, help='Save progress at least this often, in seconds.')
+    args = parser.parse_args()
+    try:
+        args.shard = parse_shard(args.shard)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.output is None:
+        #   Never the legacy points.txt, whose existing rows a fresh scan would be mixed into.
+        args.output = 'points-%s-of-%s.txt' % args.shard
+    args.checkpoint = args.checkpoint or args.output + '.checkpoint.json'
+    return args
+
+
+def main():
+    args = get_arguments()
+    repository = StoreRepository.from_url(args.storage)
+    constellations = Constellation.get_constellations()
+    if args.constellations:
+        names = args.constellations.split(',')
+        constellations = [c for c in constellations if c.name in names]
+    store_list, store_kd_tree = StoreSnapshot.get_stores_and_index(repository)
+    checkpoint = ShardCheckpoint(args.checkpoint, '%s/%s' % args.shard, repository.get_store_list_signature())
+    if checkpoint.exists and os.path.exists(args.output):
+        #   Drop whatever was written after the last checkpoint; those rows are scanned again.
+        os.truncate(args.output, checkpoint.get_output_size())
+    else:
+        #   A scan from the start; rows left by a run that crashed before its first checkpoint go too.
+        open(args.output, 'w').close()
+    try:
+        with open(args.output, 'a', encoding='utf-8', buffering=1 << 20) as output:
+            for constellation in constellations:
+                finder = ConsellationFinder(
+                    constellation.name, constellation.points,
+                    shard=args.shard,
+                    output=output,
+                    checkpoint=checkpoint,
+                    checkpoint_interval=args.checkpoint_interval
+                )
+                finder.store_list, finder.store_kd_tree = store_list, store_kd_tree
+                finder.run()
+    finally:
+        repository.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,54 @@
-from app.constellation.Constellation import Constellation
-from app.constellation.ConstellationsFinder import ConstellationsFinder
-from app.constellation.KDTree import KDTree
-from app.constellation.StorePoint import StorePoint
-
-store_list = StorePoint.get_stores()
-store_lookup = KDTree(store_list, dim=2)
-constellations = Constellation.get_constellations()
-store_to_examine = StorePoint.get_store()
-
-while store_to_examine is not None:
-    ConstellationsFinder(
-        store_to_examine=store_to_examine,
-        constellations=constellations,
-        store_list=store_list,
-        store_lookup=store_lookup
-    ).run()
-    store_to_examine = StorePoint.get_store()
\ No newline at end of file
+import argparse
+import os
+import signal
+
+from app.SearchRunner import SearchOptions, SearchRunner
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--storage', default=os.getenv('STORAGE', 'mysql'), help='mysql, or sqlite:<path> for a local database.')
+    parser.add_argument('--import-stores', action='store_true', help='Copy stores and checked stores from MySQL into the --storage SQLite database, then exit.')
+    parser.add_argument('--vectorized', action='store_true', help='Project candidates in numpy batches.')
+    parser.add_argument('--prune', action='store_true', help='Only project candidates in the feasible region (implies --vectorized).')
+    parser.add_argument('--occupancy-filter', action='store_true', help='Drop candidates with a template point where no store is, by grid occupancy (implies --vectorized).')
+    parser.add_argument('--largest-first', action='store_true', help='Visit candidates furthest from the anchor first and stop once none can beat the minimum size.')
+    parser.add_argument('--fused', action='store_true', help='Sweep the stores once per anchor for all constellations instead of once per constellation.')
+    parser.add_argument('--planar-lookup', action='store_true', help='Match stores by nearest longitude/latitude instead of great circle distance.')
+    parser.add_argument('--grid-lookup', action='store_true', help='Match stores through a uniform grid sized to the tolerance instead of a KD-tree; same results.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes.')
+    parser.add_argument('--lease-batch', type=int, default=0, help='Claim stores through cf_store_queue leases, N at a time.')
+    parser.add_argument('--coverage-scheduler', action='store_true', help='Hand out stores from an in-memory coverage grid instead of querying for each one.')
+    parser.add_argument('--seed-leases', action='store_true', help='Create and fill cf_store_queue, then exit.')
+    parser.add_argument('--flush-stores', type=int, default=50, help='Write results once this many stores are finished.')
+    parser.add_argument('--flush-interval', type=float, default=5, help='Write results at least this often, in seconds.')
+    parser.add_argument('--dedup', action='store_true', help='Skip constellations whose name and stores this process has already written.')
+    parser.add_argument('--dedup-capacity', type=int, default=10000000, help='Results the --dedup filter is sized for.')
+    parser.add_argument('--dedup-error-rate', type=float, default=1e-6, help='Chance of --dedup wrongly skipping a new result.')
+    parser.add_argument('--suppress-degrees', type=float, default=0, help='With --dedup, keep only the largest of each constellation per grid cell this many degrees across.')
+    parser.add_argument('--checkpoint-interval', type=float, default=0, help='Save per-constellation progress at least this often, in seconds, so restarts resume mid-store (MySQL only).')
+    parser.add_argument('--metrics-file', help='Keep Prometheus text metrics in this file, e.g. for a textfile collector.')
+    parser.add_argument('--metrics-port', type=int, default=0, help='Serve Prometheus metrics at http://127.0.0.1:PORT/metrics.')
+    parser.add_argument('--profile-every', type=int, default=0, help='Run every Nth store of each process under cProfile.')
+    parser.add_argument('--profile-dir', default='profiles', help='Where --profile-every dumps its .pstats files.')
+    options = SearchOptions(**vars(parser.parse_args()))
+    try:
+        options.validate()
+    except ValueError as e:
+        parser.error(str(e))
+    return options
+
+
+def stop(signum, frame):
+    #   Unwind through SearchRunner.run's finally so buffered results are flushed.
+    raise SystemExit(128 + signum)
+
+
+def main():
+    options = get_arguments()
+    signal.signal(signal.SIGTERM, stop)
+    SearchRunner(options).run()
+
+
+if __name__ == '__main__':
+    main()
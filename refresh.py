@@ -0,0 +1,69 @@
+import argparse
+import os
+
+from app.constellation.ArrayKDTree import ArrayKDTree
+from app.constellation.Constellation import Constellation
+from app.constellation.ConstellationFinder import ConstellationFinder
+from app.constellation.IncrementalSearch import IncrementalSearch
+from app.constellation.OccupancyFilter import OccupancyFilter
+from app.constellation.StorePoint import StorePoint
+from app.constellation.StoreSnapshot import StoreSnapshot
+from app.storage.StoreRepository import StoreRepository
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Bring the results of checked stores up to date after store_list changes.')
+    parser.add_argument('--storage', default=os.getenv('STORAGE', 'mysql'), help='mysql, or sqlite:<path> for a local database.')
+    parser.add_argument('--snapshot', default=os.getenv('STORE_SNAPSHOT'), help='Store snapshot of the list the results were found with; rewritten afterwards.')
+    parser.add_argument('--occupancy-filter', action='store_true', help='Re-search through the occupancy filter, as main.py --occupancy-filter.')
+    parser.add_argument('--largest-first', action='store_true', help='Re-search as main.py --largest-first; must match how the results were found.')
+    parser.add_argument('--fused', action='store_true', help='Re-search as main.py --fused.')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Results read at a time while finding the ones to replace.')
+    args = parser.parse_args()
+    if not args.snapshot:
+        parser.error('--snapshot (or $STORE_SNAPSHOT) is needed to know what changed')
+    if args.fused and args.occupancy_filter:
+        parser.error('--fused applies to the scalar search and cannot be combined with --occupancy-filter')
+    return args
+
+
+def get_finder_options(args, search: IncrementalSearch, constellations):
+    store_list = search.new_table.get_stores()
+    options = {
+        'store_list': store_list,
+        'store_lookup': search.new_lookup,
+        'largest_first': args.largest_first,
+        'fused': args.fused,
+    }
+    if args.occupancy_filter or args.largest_first:
+        options['store_coordinates'] = StorePoint.get_coordinate_array(store_list)
+    if args.occupancy_filter:
+        options.update(
+            vectorized=True,
+            candidate_index=ArrayKDTree.from_store_points(store_list),
+            occupancy_filter=OccupancyFilter(
+                options['store_coordinates'], constellations,
+                ConstellationFinder.ACCEPTABLE_DISTANCE, ConstellationFinder.BOUNDARIES
+            )
+        )
+    return options
+
+
+def main():
+    args = get_arguments()
+    repository = StoreRepository.from_url(args.storage)
+    try:
+        snapshot = StoreSnapshot(args.snapshot)
+        constellations = Constellation.get_constellations()
+        #   Read before the stores, so a change made meanwhile leaves the snapshot stale rather than wrong.
+        signature = repository.get_store_list_signature()
+        search = IncrementalSearch.from_snapshot(snapshot, repository, constellations)
+        search.run(repository, get_finder_options(args, search, constellations), args.batch_size)
+        store_list = search.new_table.get_stores()
+        snapshot.write(store_list, ArrayKDTree.from_store_points(store_list), signature)
+    finally:
+        repository.close()
+
+
+if __name__ == '__main__':
+    main()
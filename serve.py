@@ -0,0 +1,46 @@
+import argparse
+import os
+import signal
+
+from app.QueryService import QueryService
+from app.benchmark.Engines import Engines
+from app.constellation.StoreSnapshot import StoreSnapshot
+from app.storage.StoreRepository import StoreRepository
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Answer constellation queries over HTTP from warm, in-memory indexes.')
+    parser.add_argument('--storage', default=os.getenv('STORAGE', 'mysql'), help='mysql, or sqlite:<path> for a local database.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+    parser.add_argument('--engine', default=QueryService.ENGINE, choices=sorted(Engines.ENGINES), help='ConstellationsFinder configuration to search with.')
+    parser.add_argument('--workers', type=int, default=1, help='Forked processes to search in; 1 searches in the request threads.')
+    return parser.parse_args()
+
+
+def stop(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def main():
+    args = get_arguments()
+    repository = StoreRepository.from_url(args.storage)
+    try:
+        store_list, _ = StoreSnapshot.get_stores_and_index(repository)
+    finally:
+        repository.close()
+    service = QueryService(store_list, args.engine)
+    if args.workers > 1:
+        service.start_workers(args.workers)
+    server = service.serve(args.port, args.host)
+    signal.signal(signal.SIGTERM, stop)
+    print('serving %d stores with %s on http://%s:%d/find' % (len(store_list), args.engine, args.host, args.port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import collections
+import contextlib
+import random
+
+from app.benchmark.Engines import Engines
+from app.benchmark.SyntheticStores import SyntheticStores
+from app.constellation.ArrayKDTree import ArrayKDTree
+from app.constellation.ConstellationsFinder import ConstellationsFinder
+from app.constellation.IncrementalSearch import IncrementalSearch
+from app.constellation.StorePoint import StorePoint
+from app.constellation.StoreSnapshot import StoreSnapshot
+from app.storage.SQLiteRepository import SQLiteRepository
+
+
+class TrackingRepository(SQLiteRepository):
+    """Knows whether a transaction is open, so the test can check nothing searches inside one."""
+
+    def __init__(self, path: str):
+        self.in_transaction = False
+        super().__init__(path)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with super().transaction() as connection:
+            outer = self.in_transaction
+            self.in_transaction = True
+            try:
+                yield connection
+            finally:
+                self.in_transaction = outer
+
+
+def get_results(repository):
+    return collections.Counter(
+        (r['constellation_name'], r['constellation_string'], r['size'])
+        for r in repository.execute('SELECT constellation_name, constellation_string, size FROM cf_raw_constellations')
+    )
+
+
+def test_refresh_matches_a_full_run(tmp_path, monkeypatch):
+    generator = random.Random(7)
+    old_list = [StorePoint.from_values(s.store_id, s.x, s.y) for s in SyntheticStores(1500, 7).get_stores()]
+    repository = TrackingRepository(str(tmp_path / 'stores.db'))
+    repository.load_stores(old_list)
+    old_list = repository.get_stores()
+    snapshot = StoreSnapshot(str(tmp_path / 'snapshot'))
+    snapshot.write(old_list, ArrayKDTree.from_store_points(old_list), repository.get_store_list_signature())
+
+    #   The full search of some anchors, as main.py would have written it.
+    anchors = generator.sample(old_list, 20)
+    engines = Engines(old_list)
+    for anchor in anchors:
+        repository.write_results(engines.get_results('scalar', anchor))
+    repository.set_many_as_processed(anchors)
+    used = sorted({int(i) for r in get_results(repository) for i in r[1].split('|')})
+    assert len(used) > 0
+
+    #   Delete stores, some that results name; add stores next to found ones; move a few, one an anchor.
+    stores = {s.store_id: s for s in old_list}
+    for store_id in generator.sample(used, 5) + generator.sample(sorted(stores), 5):
+        stores.pop(store_id, None)
+    next_id = max(stores) + 1
+    for _ in range(10):
+        near = stores[generator.choice([i for i in used if i in stores])]
+        offset = generator.choice([0.01, 0.05, 0.2])
+        stores[next_id] = StorePoint.from_values(
+            next_id, near.x + generator.uniform(-offset, offset), near.y + generator.uniform(-offset, offset)
+        )
+        next_id += 1
+    moved = generator.sample(sorted(stores), 4) + [next(a.store_id for a in anchors if a.store_id in stores)]
+    for store_id in moved:
+        store = stores[store_id]
+        stores[store_id] = StorePoint.from_values(store_id, store.x + 0.02, store.y - 0.01)
+    repository.load_stores(sorted(stores.values(), key=lambda s: s.store_id))
+
+    #   Searching must not hold the write transaction.
+    run = ConstellationsFinder.run
+
+    def run_outside_transaction(finder):
+        assert not repository.in_transaction
+        return run(finder)
+
+    monkeypatch.setattr(ConstellationsFinder, 'run', run_outside_transaction)
+    search = IncrementalSearch.from_snapshot(snapshot, repository, engines.constellations)
+    totals = search.run(repository, report=lambda message: None)
+    monkeypatch.undo()
+    assert totals['passes'] > 0
+
+    #   What a from-scratch run over the new list finds from the anchors still checked.
+    new_list = repository.get_stores()
+    new_engines = Engines(new_list)
+    checked = {str(store_id) for store_id in repository.get_checked_store_ids()}
+    #   Moved and deleted anchors come off cf_stores_checked.
+    assert checked == {a.get_store_id() for a in anchors if a.store_id in stores and a.store_id not in moved}
+    expected = collections.Counter()
+    for store in new_list:
+        if store.get_store_id() in checked:
+            for r in new_engines.get_results('scalar', store):
+                expected[(r['constellation_name'], r['constellation_string'], r['size'])] += 1
+    assert get_results(repository) == expected
+    repository.close()
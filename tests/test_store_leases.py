@@ -0,0 +1,201 @@
+import sqlite3
+import threading
+
+import pytest
+
+from app.constellation.StoreLeases import StoreLeases
+from app.constellation.StorePoint import StorePoint
+from app.storage.SQLiteRepository import SQLiteRepository
+
+
+class Clock:
+    def __init__(self, now: float = 1000):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def get_stores(count: int = 40):
+    #   Spread over a few 1x1 degree cells.
+    return [
+        StorePoint(store_id=i, latitude=40 + (i % 4) * 0.9, longitude=-100 + (i % 5) * 1.1)
+        for i in range(1, count + 1)
+    ]
+
+
+def get_leases(path, worker_id: str, clock=None, **kwargs) -> StoreLeases:
+    connection = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+    return StoreLeases(
+        worker_id, connection=connection, clock=clock or Clock(), renew_interval=3600, **kwargs
+    )
+
+
+def get_queue(leases: StoreLeases):
+    rows, _ = leases.execute('SELECT * FROM cf_store_queue ORDER BY store_id')
+    return rows
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / 'leases.db'
+
+
+def test_seed_is_idempotent(path):
+    leases = get_leases(path, 'seed')
+    leases.create_tables()
+    stores = get_stores()
+    leases.seed(stores, checked_store_ids=[1, 2])
+    first = get_queue(leases)
+    coverage, _ = leases.execute('SELECT * FROM cf_cell_coverage ORDER BY cell_latitude, cell_longitude')
+
+    leases.create_tables()
+    leases.seed(stores, checked_store_ids=[1, 2])
+    assert get_queue(leases) == first
+    assert leases.execute('SELECT * FROM cf_cell_coverage ORDER BY cell_latitude, cell_longitude')[0] == coverage
+    assert [row['store_id'] for row in first] == list(range(3, 41))
+
+    #   Seeding again only adds the new store, ranked after its cell's queued stores.
+    new_store = StorePoint(store_id=41, latitude=40, longitude=-100)
+    leases.seed(stores + [new_store], checked_store_ids=[1, 2])
+    queue = get_queue(leases)
+    assert queue[:-1] == first
+    cell = [row for row in first if (row['cell_latitude'], row['cell_longitude']) == (40, -100)]
+    assert queue[-1]['store_id'] == 41
+    assert queue[-1]['spread_rank'] == max(row['spread_rank'] for row in cell) + 1
+
+
+def test_concurrent_claims_do_not_overlap(path):
+    seeder = get_leases(path, 'seed')
+    seeder.create_tables()
+    seeder.seed(get_stores(200), checked_store_ids=[])
+    workers = [get_leases(path, 'worker-%s' % i, batch_size=7) for i in range(4)]
+    claimed = {worker.worker_id: [] for worker in workers}
+    start = threading.Barrier(len(workers))
+
+    def claim_all(worker: StoreLeases):
+        start.wait()
+        store = worker.get_store()
+        while store is not None:
+            claimed[worker.worker_id].append(store.store_id)
+            store = worker.get_store()
+
+    threads = [threading.Thread(target=claim_all, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    store_ids = [store_id for ids in claimed.values() for store_id in ids]
+    assert len(store_ids) == len(set(store_ids))
+    assert sorted(store_ids) == list(range(1, 201))
+    #   Each store is leased to the worker that got it.
+    for row in get_queue(seeder):
+        assert row['store_id'] in claimed[row['worker_id']]
+    for worker in workers:
+        worker.stopped.set()
+
+
+def test_expired_leases_are_reclaimed(path):
+    clock = Clock()
+    first = get_leases(path, 'first', clock=clock, batch_size=5, lease_seconds=60)
+    first.create_tables()
+    first.seed(get_stores(10), checked_store_ids=[])
+    second = get_leases(path, 'second', clock=clock, batch_size=10, lease_seconds=600)
+
+    held = {s.store_id for s in first.claim(5)}
+    assert len(held) == 5
+    assert {s.store_id for s in second.claim(10)}.isdisjoint(held)
+    assert second.claim(10) == []
+
+    clock.now += 61
+    assert second.reclaim_expired() == 5
+    assert {s.store_id for s in second.claim(10)} == held
+    #   The first worker lost its leases, so it can neither renew nor release them.
+    assert first.renew(held) == 0
+    assert first.release(held) == 0
+    first.stopped.set()
+    second.stopped.set()
+
+
+def test_expired_leases_can_be_claimed_without_reclaiming(path):
+    clock = Clock()
+    first = get_leases(path, 'first', clock=clock, lease_seconds=60)
+    first.create_tables()
+    first.seed(get_stores(3), checked_store_ids=[])
+    second = get_leases(path, 'second', clock=clock, lease_seconds=60)
+
+    held = {s.store_id for s in first.claim(3)}
+    clock.now += 30
+    assert first.renew(held) == 3
+    clock.now += 45
+    assert second.claim(3) == []
+    clock.now += 30
+    assert {s.store_id for s in second.claim(3)} == held
+    first.stopped.set()
+    second.stopped.set()
+
+
+def test_release_and_complete(path):
+    clock = Clock()
+    leases = get_leases(path, 'worker', clock=clock, batch_size=4)
+    leases.create_tables()
+    stores = get_stores(4)
+    leases.seed(stores, checked_store_ids=[])
+    other = get_leases(path, 'other', clock=clock, batch_size=4)
+
+    claimed = leases.claim(4)
+    assert len(claimed) == 4
+    done, given_back = claimed[0], claimed[1:]
+    leases.complete(done)
+    assert done.store_id not in leases.held
+
+    #   Only the holder can release; completed stores stay done.
+    assert other.release([s.store_id for s in claimed]) == 0
+    assert leases.release([s.store_id for s in claimed]) == 3
+    rows = {row['store_id']: row for row in get_queue(leases)}
+    assert rows[done.store_id]['when_processed'] == clock.now
+    assert all(rows[s.store_id]['worker_id'] is None for s in given_back)
+
+    coverage, _ = other.execute(
+        'SELECT checked_count FROM cf_cell_coverage WHERE cell_latitude = %(cell_latitude)s AND cell_longitude = %(cell_longitude)s',
+        {'cell_latitude': StoreLeases.get_cell(done.y), 'cell_longitude': StoreLeases.get_cell(done.x)}
+    )
+    assert coverage[0]['checked_count'] == 1
+    assert {s.store_id for s in other.claim(4)} == {s.store_id for s in given_back}
+
+    #   close() hands back whatever is still held.
+    other.close()
+    assert all(row['worker_id'] is None for row in get_queue(leases) if row['when_processed'] is None)
+    leases.close()
+
+
+def test_repository_leases_complete_in_the_flush_transaction(path):
+    repository = SQLiteRepository(str(path))
+    stores = get_stores(6)
+    repository.load_stores(stores)
+    leases = repository.get_leases('worker', batch_size=6, renew_interval=3600)
+    leases.create_tables()
+    with repository.transaction():
+        leases.seed(repository.get_stores(), repository.get_checked_store_ids())
+
+    claimed = leases.claim(6)
+    assert len(claimed) == 6
+    with pytest.raises(RuntimeError):
+        with repository.transaction():
+            repository.set_many_as_processed(claimed[:2])
+            for store in claimed[:2]:
+                leases.complete(store)
+            raise RuntimeError('flush failed')
+    assert repository.get_checked_store_ids() == []
+    assert all(row['when_processed'] is None for row in get_queue(leases))
+
+    with repository.transaction():
+        repository.set_many_as_processed(claimed[:2])
+        for store in claimed[:2]:
+            leases.complete(store)
+    assert sorted(repository.get_checked_store_ids()) == sorted(s.store_id for s in claimed[:2])
+    done = [row['store_id'] for row in get_queue(leases) if row['when_processed'] is not None]
+    assert sorted(done) == sorted(s.store_id for s in claimed[:2])
+    leases.close()
+    repository.close()